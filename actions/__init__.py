@@ -1,4 +1,4 @@
-from .base import register_action, get_action, list_actions
-from .mark_as_read import execute
-from .mark_as_unread import execute
-from .move_message import execute
+from .base import register_action, get_action, list_actions, LabelDelta
+from .mark_as_read import label_delta
+from .mark_as_unread import label_delta
+from .move_message import label_delta
@@ -1,8 +1,54 @@
+from dataclasses import dataclass
+
 # Global action registry
 _action_registry = {}
 
+
+@dataclass(frozen=True)
+class LabelDelta:
+    """Gmail labels an action adds to and removes from a message."""
+
+    add: frozenset = frozenset()
+    remove: frozenset = frozenset()
+
+    @classmethod
+    def combine(cls, deltas) -> "LabelDelta":
+        """Net change of several deltas. A label both added and removed cancels out."""
+
+        add = frozenset().union(*(delta.add for delta in deltas))
+        remove = frozenset().union(*(delta.remove for delta in deltas))
+        conflicting = add & remove
+        return cls(add=add - conflicting, remove=remove - conflicting)
+
+    def without_noops(self, is_read=None, label_ids=None) -> "LabelDelta":
+        """Drop changes the message already has according to the stored state."""
+
+        add, remove = set(self.add), set(self.remove)
+        if label_ids is not None:
+            current = set(label_ids) - {"UNREAD"}  # is_read is the authority for UNREAD
+            add -= current
+            remove &= current | {"UNREAD"}
+        if is_read is True:
+            remove.discard("UNREAD")
+        elif is_read is False:
+            add.discard("UNREAD")
+        return LabelDelta(add=frozenset(add), remove=frozenset(remove))
+
+    def is_empty(self) -> bool:
+        return not self.add and not self.remove
+
+    def read_state(self):
+        """is_read after applying this delta, or None if it doesn't touch UNREAD."""
+
+        if "UNREAD" in self.add:
+            return False
+        if "UNREAD" in self.remove:
+            return True
+        return None
+
+
 def register_action(name: str):
-    """Decorator to register action."""
+    """Decorator to register action. Actions return the LabelDelta to apply."""
 
     def decorator(func):
         _action_registry[name] = func
@@ -1 +1,2 @@
-from .gmail_auth import GmailAuthenticator
\ No newline at end of file
+from .gmail_auth import GmailAuthenticator
+from .credential_provider import CredentialProvider, SharedCredentials, get_credential_provider
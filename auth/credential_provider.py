@@ -0,0 +1,148 @@
+import threading
+from datetime import datetime, timedelta, timezone
+
+from google.auth import credentials as google_credentials
+
+from auth.gmail_auth import GmailAuthenticator
+from config import Config
+from utils import get_logger
+
+logger = get_logger(__name__)
+
+# Wait before trying a failed background refresh again
+REFRESH_RETRY_SECONDS = 30
+
+_providers = {}
+_providers_lock = threading.Lock()
+
+
+class CredentialProvider:
+    """
+    One account's OAuth credentials, shared by all its workers and clients.
+    A background thread refreshes the token CREDENTIAL_REFRESH_MARGIN_SECONDS
+    before it expires, so requests don't wait on a refresh or a 401. Refreshes
+    are serialized by a lock, and the new credentials replace the old in one
+    assignment, so reading the current token never blocks. Clients use
+    SharedCredentials, which always send the current token.
+    """
+
+    def __init__(self, authenticator: GmailAuthenticator, margin_seconds: int = None):
+        self.authenticator = authenticator
+        if margin_seconds is None:
+            margin_seconds = Config.CREDENTIAL_REFRESH_MARGIN_SECONDS
+        self.margin = timedelta(seconds=margin_seconds)
+        self.current = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self) -> "CredentialProvider":
+        """Authenticate if needed and start the background refresher."""
+
+        with self._lock:
+            if self.current is None:
+                self.current = self.authenticator.authenticate()
+            if self._thread is None and self.current.refresh_token:
+                self._thread = threading.Thread(
+                    target=self._refresh_loop,
+                    name=f"credential-refresh-{self.authenticator.account_id}",
+                    daemon=True,
+                )
+                self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def credentials(self) -> "SharedCredentials":
+        """Credentials to build a Gmail service with."""
+
+        return SharedCredentials(self)
+
+    def refresh(self, stale_token: str = None):
+        """
+        Refresh now and return the new credentials. With stale_token, nothing is
+        done if another thread already replaced that token.
+        """
+
+        with self._lock:
+            if stale_token is not None and self.current.token != stale_token:
+                return self.current
+            self.current = self.authenticator.refresh()
+            return self.current
+
+    def _refresh_due_in(self) -> float:
+        """Seconds until the current token should be refreshed."""
+
+        expiry = self.current.expiry  # naive UTC, as google-auth keeps it
+        if expiry is None:
+            return self.margin.total_seconds()
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        return (expiry - self.margin - now).total_seconds()
+
+    def _refresh_loop(self) -> None:
+        while not self._stop.wait(max(self._refresh_due_in(), 0)):
+            if self.current.expiry is None:
+                continue
+            try:
+                self.refresh(stale_token=self.current.token)
+                logger.info(f"Refreshed token of {self.authenticator.account_id} ahead of expiry")
+            except Exception as e:
+                logger.warning(f"Background token refresh failed: {e}. Retrying.")
+                if self._stop.wait(REFRESH_RETRY_SECONDS):
+                    return
+
+
+class SharedCredentials(google_credentials.Credentials):
+    """
+    google-auth credentials that read the provider's current token on every
+    request. A refresh requested by the HTTP client (on a 401, or if the
+    background refresher fell behind) goes through the provider's lock, and
+    is skipped if another thread has already replaced the token it used.
+    """
+
+    def __init__(self, provider: CredentialProvider):
+        super().__init__()
+        self.provider = provider
+        self._used = threading.local()
+
+    @property
+    def expired(self) -> bool:
+        return self.provider.current.expired
+
+    @property
+    def valid(self) -> bool:
+        return self.provider.current.valid
+
+    def refresh(self, request) -> None:
+        self.provider.refresh(stale_token=getattr(self._used, "token", None))
+
+    def before_request(self, request, method, url, headers) -> None:
+        current = self.provider.current
+        if not current.valid:
+            current = self.provider.refresh(stale_token=current.token)
+        self._used.token = current.token
+        current.apply(headers)
+
+    def apply(self, headers, token=None) -> None:
+        self.provider.current.apply(headers, token=token)
+
+
+def get_credential_provider(
+    account_id: str = Config.DEFAULT_ACCOUNT, interactive: bool = True
+) -> CredentialProvider:
+    """
+    Started provider for an account, shared by everything in the process that
+    uses it. Its first caller decides whether it may open a browser, so asking
+    for the account again in the other mode is an error.
+    """
+
+    with _providers_lock:
+        if account_id not in _providers:
+            authenticator = GmailAuthenticator(account_id, interactive=interactive)
+            _providers[account_id] = CredentialProvider(authenticator)
+        provider = _providers[account_id]
+        if provider.authenticator.interactive != interactive:
+            mode = "interactive" if provider.authenticator.interactive else "non-interactive"
+            raise ValueError(f"Credentials of account {account_id} are already {mode}")
+    return provider.start()
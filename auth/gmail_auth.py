@@ -1,12 +1,15 @@
+import copy
+import os
 import pickle
-
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
+import tempfile
+from typing import TYPE_CHECKING
 
 from config import Config
 from utils import get_logger
 
+if TYPE_CHECKING:
+    from google.oauth2.credentials import Credentials
+
 logger = get_logger(__name__)
 
 
@@ -16,14 +19,20 @@ class GmailAuthenticator:
     This class have all the authentication logic.
     """
 
-    def __init__(self):
+    def __init__(self, account_id: str = Config.DEFAULT_ACCOUNT, interactive: bool = True):
+        self.account_id = account_id
         self.credentials_path = Config.CREDENTIALS_PATH
-        self.token_path = Config.TOKEN_PATH
+        self.token_path = Config.token_path(account_id)
         self.scopes = Config.GMAIL_SCOPES
+        self.interactive = interactive
         self._credentials = None
 
-    def authenticate(self) -> Credentials:
-        """Authenticate and return valid credentials."""
+    def authenticate(self) -> "Credentials":
+        """
+        Authenticate and return valid credentials.
+        Non-interactive authenticators (background account workers) raise instead
+        of opening a browser when the account has no usable token.
+        """
 
         if self._credentials and self._credentials.valid:
             return self._credentials
@@ -35,18 +44,36 @@ class GmailAuthenticator:
             if self._credentials.expired and self._credentials.refresh_token:
                 try:
                     logger.info("Refreshing expired credentials")
-                    self._credentials.refresh(Request())
-                    self._save_token()
-                    logger.info("Credentials refreshed successfully")
-                    return self._credentials
+                    return self.refresh()
                 except Exception as e:
                     logger.warning(f"Token refresh failed: {e}. Re-authenticating.")
                     self._credentials = None
         if not self._credentials:  # Run OAuth flow if needed
+            if not self.interactive:
+                raise PermissionError(
+                    f"No valid token for account {self.account_id} at {self.token_path}. "
+                    f"Run with --account {self.account_id} to authorize it."
+                )
             self._credentials = self._run_oauth_flow()
             self._save_token()
         return self._credentials
 
+    def refresh(self) -> "Credentials":
+        """
+        Refresh into a new credentials object, save it and return it. The old
+        object is never modified, so threads still holding it see a consistent
+        token while the refresh runs.
+        """
+
+        from google.auth.transport.requests import Request
+
+        credentials = copy.copy(self._credentials)
+        credentials.refresh(Request())
+        self._credentials = credentials
+        self._save_token()
+        logger.info("Credentials refreshed successfully")
+        return credentials
+
     def _load_token(self):
         """Load credentials from token file."""
 
@@ -63,19 +90,29 @@ class GmailAuthenticator:
             return None
 
     def _save_token(self) -> None:
-        """Save credentials to token file."""
+        """Save credentials to token file atomically."""
 
         try:
-            with self.token_path.open("wb") as token_file:
-                pickle.dump(self._credentials, token_file)
-                logger.info(f"Token saved to {self.token_path}")
+            self.token_path.parent.mkdir(parents=True, exist_ok=True)
+            # write a temporary file and rename it, so readers never see half a token
+            fd, tmp_path = tempfile.mkstemp(dir=self.token_path.parent, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as token_file:
+                    pickle.dump(self._credentials, token_file)
+                os.replace(tmp_path, self.token_path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+            logger.info(f"Token saved to {self.token_path}")
         except Exception as e:
             logger.error(f"Failed to save token: {e}")
             raise
 
-    def _run_oauth_flow(self) -> Credentials:
+    def _run_oauth_flow(self) -> "Credentials":
         """Run the OAuth authorization flow."""
 
+        from google_auth_oauthlib.flow import InstalledAppFlow
+
         if not self.credentials_path.exists():
             raise FileNotFoundError(
                 f"Credentials file not found at {self.credentials_path}. "
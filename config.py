@@ -12,10 +12,26 @@ class Config:
     TOKEN_PATH = BASE_DIR / "token.pkl"
     CREDENTIALS_PATH = BASE_DIR / "credentials.json"
     RULES_FILE = BASE_DIR / "rules.json"
+    CONDITION_STATS_FILE = BASE_DIR / "condition_stats.json"
+    TOKEN_DIR = BASE_DIR / "tokens"
+    RAW_CACHE_DIR = Path(os.getenv("RAW_CACHE_DIR", BASE_DIR / "raw_cache"))
+
+    # Accounts (mailboxes). The default account keeps using TOKEN_PATH.
+    DEFAULT_ACCOUNT = "default"
+    ACCOUNTS = [
+        account.strip()
+        for account in os.getenv("ACCOUNTS", DEFAULT_ACCOUNT).split(",")
+        if account.strip()
+    ]
+    MAX_CONCURRENT_ACCOUNTS = int(os.getenv("MAX_CONCURRENT_ACCOUNTS", "4"))
+    # Gmail allows 250 quota units per user per second
+    ACCOUNT_QUOTA_UNITS_PER_SECOND = int(os.getenv("ACCOUNT_QUOTA_UNITS_PER_SECOND", "250"))
 
     # Gmail API
     GMAIL_SCOPES = ["https://www.googleapis.com/auth/gmail.modify"]
     GMAIL_API_VERSION = "v1"
+    # Tokens are refreshed in the background this long before they expire
+    CREDENTIAL_REFRESH_MARGIN_SECONDS = int(os.getenv("CREDENTIAL_REFRESH_MARGIN_SECONDS", "600"))
 
     # DB config
     DATABASE_USER = os.getenv("DATABASE_USER")
@@ -23,23 +39,88 @@ class Config:
     DATABASE_HOST = os.getenv("DATABASE_HOST")
     DATABASE_PORT = os.getenv("DATABASE_PORT")
     DATABASE_NAME = os.getenv("DATABASE_NAME")
+    # "psycopg2" or "psycopg" (psycopg 3: pipelined executemany, prepared statements)
+    DATABASE_DRIVER = os.getenv("DATABASE_DRIVER", "psycopg2")
+    DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+    DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+    DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30"))
+    DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+    # psycopg 3 prepares a statement server-side after this many executions (empty disables)
+    _prepare_threshold = os.getenv("DB_PREPARE_THRESHOLD", "2")
+    DB_PREPARE_THRESHOLD = int(_prepare_threshold) if _prepare_threshold else None
+    del _prepare_threshold
+
+    # Message body storage (MAX_BODY_BYTES = 0 means no cap)
+    MAX_BODY_BYTES = int(os.getenv("MAX_BODY_BYTES", "0"))
+    BODY_COMPRESSION_LEVEL = int(os.getenv("BODY_COMPRESSION_LEVEL", "3"))
+
+    # Raw Gmail payloads kept on disk so --reparse can rebuild emails without the API
+    RAW_MESSAGE_CACHE = os.getenv("RAW_MESSAGE_CACHE", "false").lower() == "true"
+    RAW_CACHE_SEGMENT_BYTES = int(os.getenv("RAW_CACHE_SEGMENT_BYTES", str(256 * 1024 * 1024)))
+    REPARSE_BATCH_SIZE = 1000
+
+    # Monthly partitioning of the emails table by received_at (set before --init-db)
+    EMAIL_PARTITIONING = os.getenv("EMAIL_PARTITIONING", "false").lower() == "true"
+    PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", "3"))
 
     # Email fetching configuration
     FETCH_BATCH_SIZE = 100
     MAX_RESULTS_PER_QUERY = 500
+    # Syncs a failed message is retried in before it is given up on
+    SYNC_RETRY_ATTEMPTS = int(os.getenv("SYNC_RETRY_ATTEMPTS", "5"))
+
+    # Backfill: date-range shards listed and fetched in parallel
+    BACKFILL_WORKERS = int(os.getenv("BACKFILL_WORKERS", "4"))
+    BACKFILL_SHARD_MESSAGES = int(os.getenv("BACKFILL_SHARD_MESSAGES", "5000"))
+    BACKFILL_START_YEAR = int(os.getenv("BACKFILL_START_YEAR", "2004"))
 
     # Processing configuration
     RULE_PROCESSING_BATCH_SIZE = 500
+    # Failed evaluations after which an email is left alone until the rules change
+    RULE_MAX_ATTEMPTS = int(os.getenv("RULE_MAX_ATTEMPTS", "3"))
+    # Guards for matches_regex conditions
+    REGEX_MAX_PATTERN_LENGTH = int(os.getenv("REGEX_MAX_PATTERN_LENGTH", "500"))
+    REGEX_MAX_INPUT_CHARS = int(os.getenv("REGEX_MAX_INPUT_CHARS", "100000"))
+    # Memoized string condition results per run (0 disables)
+    CONDITION_CACHE_SIZE = int(os.getenv("CONDITION_CACHE_SIZE", "50000"))
+    # Write fetched batches on the asyncpg engine, overlapping with the next download
+    ASYNC_INGEST = os.getenv("ASYNC_INGEST", "false").lower() == "true"
+    # Evaluate rules while fetching instead of in a second pass
+    FUSED_PROCESSING = os.getenv("FUSED_PROCESSING", "false").lower() == "true"
+    WORKER_POLL_SECONDS = float(os.getenv("WORKER_POLL_SECONDS", "10"))
+
+    # Action outbox dispatching
+    OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "500"))
+    OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+    OUTBOX_RETRY_DELAY_SECONDS = int(os.getenv("OUTBOX_RETRY_DELAY_SECONDS", "30"))
+    OUTBOX_LEASE_SECONDS = int(os.getenv("OUTBOX_LEASE_SECONDS", "300"))
+    # Sent entries are deleted after this many days (0 keeps them)
+    OUTBOX_DONE_RETENTION_DAYS = int(os.getenv("OUTBOX_DONE_RETENTION_DAYS", "7"))
 
     # Logging config
     LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
     LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    LOG_FILE = "logs/app.log"
+    LOG_JSON = os.getenv("LOG_JSON", "false").lower() == "true"
+    LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", "100"))
+    # Per-email log lines: keep this fraction, and at most this many per second (0 = no limit)
+    LOG_EMAIL_SAMPLE_RATE = float(os.getenv("LOG_EMAIL_SAMPLE_RATE", "1.0"))
+    LOG_EMAIL_RATE_LIMIT = int(os.getenv("LOG_EMAIL_RATE_LIMIT", "0"))
+
+    @classmethod
+    def token_path(cls, account_id: str):
+        """Token file for an account."""
+
+        if account_id == cls.DEFAULT_ACCOUNT:
+            return cls.TOKEN_PATH
+        return cls.TOKEN_DIR / f"{account_id}.pkl"
 
     @classmethod
-    def get_db_url(cls) -> str:
+    def get_db_url(cls, driver: str = None) -> str:
         """Returns database URL."""
+        driver = driver or cls.DATABASE_DRIVER
         return (
-            f"postgresql://{cls.DATABASE_USER}:{cls.DATABASE_PASSWORD}"
+            f"postgresql+{driver}://{cls.DATABASE_USER}:{cls.DATABASE_PASSWORD}"
             f"@{cls.DATABASE_HOST}:{cls.DATABASE_PORT}/{cls.DATABASE_NAME}"
         )
 
@@ -1,2 +1,10 @@
-from .models import Email, Base
-from .manager import DatabaseManager, db_manager, get_db_session
\ No newline at end of file
+from .models import (
+    Email,
+    EmailBody,
+    RulesetVersion,
+    ActionOutbox,
+    AccountSyncState,
+    BackfillCheckpoint,
+    Base,
+)
+from .manager import DatabaseManager, db_manager, get_db_session, get_async_db_session
\ No newline at end of file
@@ -0,0 +1,32 @@
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # zlib is used when zstandard is not installed
+    zstandard = None
+
+from config import Config
+
+ZSTD = "zstd"
+ZLIB = "zlib"
+
+
+def compress(data: bytes) -> tuple[str, bytes]:
+    """Compress data and return (codec, compressed bytes)."""
+
+    if zstandard is not None:
+        compressor = zstandard.ZstdCompressor(level=Config.BODY_COMPRESSION_LEVEL)
+        return ZSTD, compressor.compress(data)
+    return ZLIB, zlib.compress(data, min(Config.BODY_COMPRESSION_LEVEL, 9))
+
+
+def decompress(codec: str, data: bytes) -> bytes:
+    """Decompress data written by compress()."""
+
+    if codec == ZSTD:
+        if zstandard is None:
+            raise RuntimeError("zstandard is required to read zstd compressed bodies")
+        return zstandard.ZstdDecompressor().decompress(data)
+    if codec == ZLIB:
+        return zlib.decompress(data)
+    raise ValueError(f"Unknown compression codec: {codec}")
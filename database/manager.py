@@ -1,11 +1,13 @@
-from contextlib import contextmanager
+from contextlib import asynccontextmanager, contextmanager
 
-from sqlalchemy import create_engine
+from sqlalchemy import Text, create_engine, inspect
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy import text
+from sqlalchemy.schema import AddConstraint, CreateColumn
 
 from config import Config
-from database import Base
+from database import Base, Email, EmailBody
+from database.partitions import ensure_upcoming_partitions
 from utils import get_logger
 
 logger = get_logger(__name__)
@@ -15,21 +17,44 @@ class DatabaseManager:
     """This class is to manage the database connection and sessions."""
 
     def __init__(self):
-        """Initialize db manager."""
-
-        self.database_url = Config.get_db_url()
-        self.engine = create_engine(
-            self.database_url,
-            pool_size=5,
-            max_overflow=10,
-            pool_pre_ping=True
-        )
-        self.SessionLocal = sessionmaker(
-            bind=self.engine,
-            autocommit=False,
-            autoflush=False,
-            expire_on_commit=False,
-        )
+        """Initialize db manager. The engine is created on first use."""
+
+        self._engine = None
+        self._session_factory = None
+        self._async_engine = None
+        self._async_session_factory = None
+
+    @property
+    def database_url(self) -> str:
+        return Config.get_db_url()
+
+    @property
+    def engine(self):
+        if self._engine is None:
+            connect_args = {}
+            if Config.DATABASE_DRIVER == "psycopg":
+                connect_args["prepare_threshold"] = Config.DB_PREPARE_THRESHOLD
+            self._engine = create_engine(
+                self.database_url,
+                pool_size=Config.DB_POOL_SIZE,
+                max_overflow=Config.DB_MAX_OVERFLOW,
+                pool_timeout=Config.DB_POOL_TIMEOUT,
+                pool_recycle=Config.DB_POOL_RECYCLE,
+                pool_pre_ping=True,
+                connect_args=connect_args,
+            )
+        return self._engine
+
+    @property
+    def SessionLocal(self):
+        if self._session_factory is None:
+            self._session_factory = sessionmaker(
+                bind=self.engine,
+                autocommit=False,
+                autoflush=False,
+                expire_on_commit=False,
+            )
+        return self._session_factory
 
     @contextmanager
     def get_session(self):
@@ -46,16 +71,158 @@ class DatabaseManager:
         finally:
             session.close()
 
+    @property
+    def async_engine(self):
+        """asyncpg engine for async code, sharing the pool settings. Created on first use."""
+
+        if self._async_engine is None:
+            from sqlalchemy.ext.asyncio import create_async_engine
+
+            self._async_engine = create_async_engine(
+                Config.get_db_url("asyncpg"),
+                pool_size=Config.DB_POOL_SIZE,
+                max_overflow=Config.DB_MAX_OVERFLOW,
+                pool_timeout=Config.DB_POOL_TIMEOUT,
+                pool_recycle=Config.DB_POOL_RECYCLE,
+                pool_pre_ping=True,
+            )
+        return self._async_engine
+
+    @property
+    def AsyncSessionLocal(self):
+        if self._async_session_factory is None:
+            from sqlalchemy.ext.asyncio import async_sessionmaker
+
+            self._async_session_factory = async_sessionmaker(
+                bind=self.async_engine,
+                autoflush=False,
+                expire_on_commit=False,
+            )
+        return self._async_session_factory
+
+    @asynccontextmanager
+    async def get_async_session(self):
+        """Async counterpart of get_session: commits on success, rolls back on exception."""
+
+        session = self.AsyncSessionLocal()
+        try:
+            yield session
+            await session.commit()
+        except Exception as e:
+            await session.rollback()
+            logger.error(f"Database session error: {e}")
+            raise
+        finally:
+            await session.close()
+
+    async def dispose_async(self) -> None:
+        """Close the async pool (it is bound to the event loop that created it)."""
+
+        if self._async_engine is not None:
+            await self._async_engine.dispose()
+            self._async_engine = None
+            self._async_session_factory = None
+
     def init_db(self) -> None:
         """Create all database tables."""
 
         try:
             Base.metadata.create_all(bind=self.engine)
+            self._add_missing_columns()
+            self._widen_folded_columns()
+            self._migrate_primary_keys()
+            self._migrate_legacy_bodies()
+            if Config.EMAIL_PARTITIONING:
+                with self.get_session() as session:
+                    ensure_upcoming_partitions(session)
             logger.info("Database tables initialized successfully")
         except Exception as e:
             logger.error(f"Failed to initialize db: {e}")
             raise
 
+    def _add_missing_columns(self) -> None:
+        """Add columns introduced after a table was created (create_all skips existing tables)."""
+
+        inspector = inspect(self.engine)
+        with self.engine.begin() as conn:
+            for table in Base.metadata.sorted_tables:
+                if not inspector.has_table(table.name):
+                    continue
+                existing = {column["name"] for column in inspector.get_columns(table.name)}
+                for column in table.columns:
+                    if column.name in existing:
+                        continue
+                    column_ddl = CreateColumn(column).compile(dialect=self.engine.dialect)
+                    conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column_ddl}"))
+                    for index in table.indexes:
+                        if column in index.columns:
+                            index.create(conn, checkfirst=True)
+                    logger.info(f"Added column {table.name}.{column.name}")
+
+    def _widen_folded_columns(self) -> None:
+        """Turn folded columns created as VARCHAR into TEXT (no table rewrite in Postgres)."""
+
+        columns = {column["name"]: column["type"] for column in inspect(self.engine).get_columns("emails")}
+        with self.engine.begin() as conn:
+            for name in ("sender_folded", "subject_folded"):
+                if name in columns and not isinstance(columns[name], Text):
+                    conn.execute(text(f"ALTER TABLE emails ALTER COLUMN {name} TYPE TEXT"))
+                    logger.info(f"Column emails.{name} is now TEXT")
+
+    def _migrate_primary_keys(self) -> None:
+        """Rebuild primary keys created before emails were keyed by account."""
+
+        inspector = inspect(self.engine)
+        with self.engine.begin() as conn:
+            for table in (Email.__table__, EmailBody.__table__):
+                current = inspector.get_pk_constraint(table.name)
+                expected = [column.name for column in table.primary_key.columns]
+                if current["constrained_columns"] == expected:
+                    continue
+                # CASCADE also drops the old email_bodies -> emails(id) foreign key
+                conn.execute(
+                    text(f"ALTER TABLE {table.name} DROP CONSTRAINT {current['name']} CASCADE")
+                )
+                conn.execute(text(f"ALTER TABLE {table.name} ADD PRIMARY KEY ({', '.join(expected)})"))
+                logger.info(f"Primary key of {table.name} is now ({', '.join(expected)})")
+            for constraint in EmailBody.__table__.foreign_key_constraints:
+                existing = inspector.get_foreign_keys(EmailBody.__tablename__)
+                if any(fk["referred_columns"] == ["account_id", "id"] for fk in existing):
+                    continue
+                conn.execute(AddConstraint(constraint))
+
+    def _migrate_legacy_bodies(self, batch_size: int = 1000) -> None:
+        """Move bodies from the old emails.message column into email_bodies."""
+
+        columns = {column["name"] for column in inspect(self.engine).get_columns("emails")}
+        if "message" not in columns:
+            return
+        logger.info("Moving message bodies into email_bodies")
+        with self.get_session() as session:
+            moved = 0
+            while True:
+                rows = session.execute(
+                    text(
+                        "SELECT e.account_id, e.id, e.message FROM emails e "
+                        "LEFT JOIN email_bodies b "
+                        "ON b.account_id = e.account_id AND b.email_id = e.id "
+                        "WHERE e.message IS NOT NULL AND b.email_id IS NULL "
+                        "LIMIT :limit"
+                    ),
+                    {"limit": batch_size},
+                ).all()
+                if not rows:
+                    break
+                for account_id, email_id, message in rows:
+                    body = EmailBody.from_text(message)
+                    body.account_id = account_id
+                    body.email_id = email_id
+                    session.add(body)
+                session.commit()
+                moved += len(rows)
+            session.execute(text("ALTER TABLE emails DROP COLUMN message"))
+        logger.info(f"Moved {moved} message bodies")
+
     def health_check(self) -> bool:
         """Check if the db connection is healthy."""
 
@@ -67,9 +234,13 @@ class DatabaseManager:
             logger.error(f"Database health check failed: {e}")
             return False
 
-# Global database manager instance
+# Global database manager instance (cheap to create, connects lazily)
 db_manager = DatabaseManager()
 
 
 def get_db_session():
     return db_manager.get_session()
+
+
+def get_async_db_session():
+    return db_manager.get_async_session()
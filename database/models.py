@@ -1,9 +1,141 @@
 from datetime import datetime, timezone
-from sqlalchemy import Column, String, Boolean, DateTime, Text
-from sqlalchemy.orm import declarative_base
+from sqlalchemy import (
+    Column,
+    String,
+    Boolean,
+    DateTime,
+    Integer,
+    LargeBinary,
+    ForeignKey,
+    ForeignKeyConstraint,
+    Index,
+    JSON,
+    Text,
+    PrimaryKeyConstraint,
+    UniqueConstraint,
+)
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.orm import declarative_base, relationship
+
+from config import Config
+from database.compression import compress, decompress
+from utils.text import fold
 
 Base = declarative_base()
 
+# Gmail message ids are only unique within a mailbox, so the account is part of the key.
+# Partitioned tables need the partition key in every unique constraint,
+# so in partitioning mode received_at joins the primary key.
+EMAIL_KEY_COLUMNS = ("account_id", "id")
+if Config.EMAIL_PARTITIONING:
+    EMAIL_KEY_COLUMNS += ("received_at",)
+
+
+def _email_table_args():
+    # GIN indexes so rules and queries can test array membership (`@>`, `&&`)
+    array_indexes = tuple(
+        Index(f"ix_emails_{column}", column, postgresql_using="gin")
+        for column in ("to_addresses", "cc_addresses", "label_ids")
+    )
+    if Config.EMAIL_PARTITIONING:
+        return (
+            PrimaryKeyConstraint(*EMAIL_KEY_COLUMNS),
+            *array_indexes,
+            {"postgresql_partition_by": "RANGE (received_at)"},
+        )
+    return (PrimaryKeyConstraint(*EMAIL_KEY_COLUMNS), *array_indexes)
+
+
+def _email_foreign_key(ondelete: str = "CASCADE"):
+    """
+    FK from (account_id, email_id) to emails, omitted when partitioned
+    ((account_id, id) alone is not unique there).
+    """
+
+    if Config.EMAIL_PARTITIONING:
+        return ()
+    return (
+        ForeignKeyConstraint(
+            ["account_id", "email_id"], ["emails.account_id", "emails.id"], ondelete=ondelete
+        ),
+    )
+
+
+def _account_column():
+    return Column(
+        String(255),
+        nullable=False,
+        default=Config.DEFAULT_ACCOUNT,
+        server_default=Config.DEFAULT_ACCOUNT,
+    )
+
+
+class AccountSyncState(Base):
+    """Per-account sync position, so each mailbox fetches only what is new to it."""
+
+    __tablename__ = "account_sync_state"
+
+    account_id = Column(String(255), primary_key=True)
+    last_received_at = Column(DateTime(timezone=True), nullable=True)
+    last_synced_at = Column(DateTime(timezone=True), nullable=True)
+    failed_ids = Column(
+        JSON, nullable=True, comment="Message id -> failed fetch attempts, retried next sync"
+    )
+
+
+BACKFILL_RUNNING = "running"
+BACKFILL_DONE = "done"
+
+
+class BackfillCheckpoint(Base):
+    """
+    Progress of a full-mailbox backfill: the Gmail page token of the next page
+    to list, committed after each page is stored, so an interrupted backfill
+    resumes at that page instead of re-listing the mailbox.
+    """
+
+    __tablename__ = "backfill_checkpoints"
+    __table_args__ = (UniqueConstraint("account_id", "query"),)
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    account_id = _account_column()
+    query = Column(String(255), nullable=False, default="", comment="Gmail search query listed")
+    page_token = Column(Text, nullable=True, comment="Next page to list; NULL from the start")
+    pages_done = Column(Integer, nullable=False, default=0)
+    messages_done = Column(Integer, nullable=False, default=0)
+    failed_ids = Column(JSON, nullable=False, default=list, comment="Messages to retry")
+    status = Column(String(16), nullable=False, default=BACKFILL_RUNNING)
+    created_at = Column(
+        DateTime(timezone=True),
+        default=lambda: datetime.now(timezone.utc),
+        nullable=False,
+    )
+    updated_at = Column(
+        DateTime(timezone=True),
+        default=lambda: datetime.now(timezone.utc),
+        onupdate=lambda: datetime.now(timezone.utc),
+        nullable=False,
+    )
+
+
+class RulesetVersion(Base):
+    """
+    A distinct set of rules, identified by the hashes of its rules.
+    Emails point at the version they were evaluated against, so after a rules
+    change only rules missing from that version need evaluating.
+    """
+
+    __tablename__ = "ruleset_versions"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    fingerprint = Column(String(64), unique=True, nullable=False)
+    rule_hashes = Column(JSON, nullable=False)
+    created_at = Column(
+        DateTime(timezone=True),
+        default=lambda: datetime.now(timezone.utc),
+        nullable=False,
+    )
+
 
 class Email(Base):
     """
@@ -12,13 +144,28 @@ class Email(Base):
     """
 
     __tablename__ = "emails"
+    __table_args__ = _email_table_args()
 
+    account_id = _account_column()
     id = Column(
-        String(255), primary_key=True, comment="Gmail message ID (unique identifier)"
+        String(255), nullable=False, comment="Gmail message ID (unique identifier)"
     )
     sender = Column(String(500), nullable=False, index=True)
     subject = Column(String(1000), nullable=False)
-    message = Column(Text, nullable=True)
+    # Normalized copies written at ingest so rules don't re-lowercase per run.
+    # Unbounded: casefolding can lengthen text (ß -> ss)
+    sender_folded = Column(Text, nullable=True)
+    subject_folded = Column(Text, nullable=True)
+    sender_address = Column(String(320), nullable=True, index=True)
+    sender_domain = Column(String(255), nullable=True, index=True)
+    # Headers, casefolded; recipients are bare addresses
+    list_id = Column(String(500), nullable=True, index=True)
+    reply_to = Column(String(320), nullable=True, index=True)
+    to_addresses = Column(ARRAY(String(320)), nullable=True)
+    cc_addresses = Column(ARRAY(String(320)), nullable=True)
+    thread_id = Column(String(255), nullable=True, index=True)
+    # Gmail label ids as fetched (and as changed by dispatched actions)
+    label_ids = Column(ARRAY(String(255)), nullable=True)
     received_at = Column(
         DateTime(timezone=True),
         nullable=False,
@@ -34,6 +181,20 @@ class Email(Base):
         index=True,
     )
     processed = Column(Boolean, default=False, nullable=False, index=True)
+    ruleset_version_id = Column(
+        Integer,
+        ForeignKey("ruleset_versions.id"),
+        nullable=True,
+        index=True,
+        comment="Ruleset version this email was last evaluated against",
+    )
+    rule_failures = Column(
+        Integer,
+        default=0,
+        server_default="0",
+        nullable=False,
+        comment="Failed rule evaluations since the rules last changed",
+    )
     created_at = Column(
         DateTime(timezone=True),
         default=lambda: datetime.now(timezone.utc),
@@ -45,6 +206,31 @@ class Email(Base):
         onupdate=lambda: datetime.now(timezone.utc),
         nullable=False,
     )
+    body = relationship(
+        "EmailBody",
+        primaryjoin="and_(Email.account_id == foreign(EmailBody.account_id), "
+        "Email.id == foreign(EmailBody.email_id))",
+        uselist=False,
+        lazy="select",
+        cascade="all, delete-orphan",
+    )
+    __mapper_args__ = {"primary_key": [account_id, id]}
+
+    @property
+    def message(self):
+        """Message body text. The body row is loaded and decompressed on first access."""
+
+        return self.body.text if self.body is not None else None
+
+    @message.setter
+    def message(self, value) -> None:
+        self.body = EmailBody.from_text(value) if value is not None else None
+
+    @property
+    def message_folded(self):
+        """Casefolded message body."""
+
+        return self.body.folded_text if self.body is not None else None
 
     def __repr__(self) -> str:
         """String representation for debugging."""
@@ -55,3 +241,113 @@ class Email(Base):
             f"subject='{self.subject[:30]}...', "
             f"received_at='{self.received_at}')>"
         )
+
+
+class EmailBody(Base):
+    """
+    Message body kept out of the emails table so metadata scans stay small.
+    Stored compressed, and cut at Config.MAX_BODY_BYTES when set.
+    """
+
+    __tablename__ = "email_bodies"
+    __table_args__ = (PrimaryKeyConstraint("account_id", "email_id"), *_email_foreign_key())
+
+    account_id = _account_column()
+    email_id = Column(String(255), nullable=False)
+    codec = Column(String(16), nullable=False)
+    data = Column(LargeBinary, nullable=False)
+    folded_data = Column(LargeBinary, nullable=True, comment="Casefolded body, same codec")
+    size = Column(Integer, nullable=False, comment="Uncompressed size in bytes")
+    truncated = Column(Boolean, default=False, nullable=False)
+
+    @classmethod
+    def from_text(cls, text: str) -> "EmailBody":
+        """Build a compressed body, applying the size cap."""
+
+        raw = text.encode("utf-8")
+        truncated = False
+        if Config.MAX_BODY_BYTES and len(raw) > Config.MAX_BODY_BYTES:
+            raw = raw[: Config.MAX_BODY_BYTES]
+            text = raw.decode("utf-8", errors="ignore")
+            truncated = True
+        codec, data = compress(raw)
+        folded = fold(text)
+        _, folded_data = compress(folded.encode("utf-8"))
+        body = cls(
+            codec=codec,
+            data=data,
+            folded_data=folded_data,
+            size=len(raw),
+            truncated=truncated,
+        )
+        body._text = text
+        body._folded_text = folded
+        return body
+
+    @property
+    def text(self) -> str:
+        """Decompressed body, cached on the instance."""
+
+        if getattr(self, "_text", None) is None:
+            self._text = decompress(self.codec, self.data).decode("utf-8", errors="ignore")
+        return self._text
+
+    @property
+    def folded_text(self) -> str:
+        """Decompressed casefolded body, cached on the instance."""
+
+        if getattr(self, "_folded_text", None) is None:
+            if self.folded_data is None:  # rows stored before folding was added
+                self._folded_text = fold(self.text)
+            else:
+                self._folded_text = decompress(self.codec, self.folded_data).decode(
+                    "utf-8", errors="ignore"
+                )
+        return self._folded_text
+
+
+OUTBOX_PENDING = "pending"
+OUTBOX_IN_FLIGHT = "in_flight"
+OUTBOX_DONE = "done"
+OUTBOX_FAILED = "failed"
+
+
+class ActionOutbox(Base):
+    """
+    Label changes decided during rule processing, waiting to be sent to Gmail.
+    Written in the same transaction that marks the email processed, and drained
+    by ActionDispatcher. The idempotency key stops the same change being queued twice.
+    """
+
+    __tablename__ = "action_outbox"
+    __table_args__ = (
+        Index("ix_action_outbox_claim", "account_id", "status", "next_attempt_at"),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    idempotency_key = Column(String(64), unique=True, nullable=False)
+    account_id = _account_column()
+    email_id = Column(String(255), nullable=False, index=True)
+    add_labels = Column(JSON, nullable=False, default=list)
+    remove_labels = Column(JSON, nullable=False, default=list)
+    source = Column(JSON, nullable=True, comment="Rule actions that produced this entry")
+    status = Column(String(16), nullable=False, default=OUTBOX_PENDING)
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(
+        DateTime(timezone=True),
+        default=lambda: datetime.now(timezone.utc),
+        nullable=False,
+    )
+    lease_expires_at = Column(DateTime(timezone=True), nullable=True)
+    last_error = Column(Text, nullable=True)
+    created_at = Column(
+        DateTime(timezone=True),
+        default=lambda: datetime.now(timezone.utc),
+        nullable=False,
+    )
+    updated_at = Column(
+        DateTime(timezone=True),
+        default=lambda: datetime.now(timezone.utc),
+        onupdate=lambda: datetime.now(timezone.utc),
+        nullable=False,
+    )
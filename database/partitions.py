@@ -0,0 +1,155 @@
+from datetime import datetime, timezone
+
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+
+from config import Config
+from utils import get_logger
+
+logger = get_logger(__name__)
+
+PARENT_TABLE = "emails"
+BODY_TABLE = "email_bodies"
+BODY_COLUMNS = ("account_id", "email_id", "codec", "data", "folded_data", "size", "truncated")
+ARCHIVE_SCHEMA = "archive"
+
+# Partitions known to exist in this process, so ingest doesn't re-issue DDL per batch.
+# A partition created in a transaction is only known once that transaction commits.
+_known_partitions = set()
+_PENDING_KEY = "pending_partitions"
+
+
+def month_start(value: datetime) -> datetime:
+    """First instant of the month containing value, in UTC."""
+
+    value = value.astimezone(timezone.utc)
+    return datetime(value.year, value.month, 1, tzinfo=timezone.utc)
+
+
+def add_months(value: datetime, months: int) -> datetime:
+    index = value.year * 12 + value.month - 1 + months
+    return value.replace(year=index // 12, month=index % 12 + 1)
+
+
+def partition_name(month: datetime) -> str:
+    return f"{PARENT_TABLE}_y{month.year}m{month.month:02d}"
+
+
+def ensure_partition(session: Session, month: datetime) -> str:
+    """Create the partition covering month if it does not exist."""
+
+    month = month_start(month)
+    name = partition_name(month)
+    pending = session.info.setdefault(_PENDING_KEY, set())
+    if name in _known_partitions or name in pending:
+        return name
+    # Workers creating the same month at once can both fail the IF NOT EXISTS
+    # check and collide in the catalog; the lock is held until the batch commits
+    session.execute(text("SELECT pg_advisory_xact_lock(hashtext(:name))"), {"name": name})
+    session.execute(
+        text(
+            f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {PARENT_TABLE} "
+            f"FOR VALUES FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')"
+        )
+    )
+    pending.add(name)
+    return name
+
+
+@event.listens_for(Session, "after_commit")
+def _remember_created_partitions(session: Session) -> None:
+    _known_partitions.update(session.info.pop(_PENDING_KEY, ()))
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _forget_created_partitions(session: Session, previous_transaction) -> None:
+    # the CREATE TABLE was rolled back too
+    session.info.pop(_PENDING_KEY, None)
+
+
+def ensure_partitions_for(session: Session, dates) -> None:
+    """Make sure a partition exists for each of the given dates."""
+
+    for month in {month_start(date) for date in dates}:
+        ensure_partition(session, month)
+
+
+def ensure_upcoming_partitions(session: Session, months_ahead: int = None) -> None:
+    """Create partitions from the current month up to months_ahead."""
+
+    if months_ahead is None:
+        months_ahead = Config.PARTITION_MONTHS_AHEAD
+    current = month_start(datetime.now(timezone.utc))
+    for offset in range(months_ahead + 1):
+        ensure_partition(session, add_months(current, offset))
+
+
+def list_partitions(session: Session) -> list:
+    """Return (name, month) of the attached partitions, oldest first."""
+
+    rows = session.execute(
+        text(
+            "SELECT child.relname FROM pg_inherits "
+            "JOIN pg_class parent ON parent.oid = pg_inherits.inhparent "
+            "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+            "WHERE parent.relname = :parent"
+        ),
+        {"parent": PARENT_TABLE},
+    ).scalars()
+    partitions = []
+    for name in rows:
+        try:
+            year, month = name[len(PARENT_TABLE) + 2 :].split("m")
+            partitions.append((name, datetime(int(year), int(month), 1, tzinfo=timezone.utc)))
+        except ValueError:
+            logger.warning(f"Ignoring partition with unexpected name: {name}")
+    return sorted(partitions, key=lambda partition: partition[1])
+
+
+def apply_retention(session: Session, keep_months: int, archive: bool = False) -> list:
+    """
+    Detach partitions older than keep_months. Archived partitions are moved to
+    the archive schema and their bodies to archive.email_bodies; otherwise both
+    are dropped. Either way the bodies leave the hot email_bodies table.
+    """
+
+    cutoff = add_months(month_start(datetime.now(timezone.utc)), -keep_months)
+    removed = []
+    if archive:
+        session.execute(text(f"CREATE SCHEMA IF NOT EXISTS {ARCHIVE_SCHEMA}"))
+        session.execute(
+            text(
+                f"CREATE TABLE IF NOT EXISTS {ARCHIVE_SCHEMA}.{BODY_TABLE} "
+                f"(LIKE {BODY_TABLE} INCLUDING ALL)"
+            )
+        )
+    for name, month in list_partitions(session):
+        if month >= cutoff:
+            continue
+        session.execute(text(f"ALTER TABLE {PARENT_TABLE} DETACH PARTITION {name}"))
+        if archive:
+            columns = ", ".join(BODY_COLUMNS)
+            session.execute(
+                text(
+                    f"INSERT INTO {ARCHIVE_SCHEMA}.{BODY_TABLE} ({columns}) "
+                    f"SELECT {', '.join(f'b.{column}' for column in BODY_COLUMNS)} "
+                    f"FROM {BODY_TABLE} b JOIN {name} p "
+                    "ON b.account_id = p.account_id AND b.email_id = p.id "
+                    "ON CONFLICT DO NOTHING"
+                )
+            )
+        session.execute(
+            text(
+                f"DELETE FROM {BODY_TABLE} b USING {name} p "
+                "WHERE b.account_id = p.account_id AND b.email_id = p.id"
+            )
+        )
+        if archive:
+            session.execute(text(f"ALTER TABLE {name} SET SCHEMA {ARCHIVE_SCHEMA}"))
+            logger.info(f"Archived partition {name} to {ARCHIVE_SCHEMA}.{name}")
+        else:
+            session.execute(text(f"DROP TABLE {name}"))
+            logger.info(f"Dropped partition {name}")
+        _known_partitions.discard(name)
+        removed.append(name)
+    return removed
@@ -1,9 +1,14 @@
+import asyncio
 import sys
 
-from auth import GmailAuthenticator
-from services import GmailClient, EmailStore
-from rules import RuleProcessor
+from auth import get_credential_provider
+from services import GmailClient, EmailStore, ActionDispatcher
+from services.backfill import MailboxBackfill, ShardedBackfill
+from services.supervisor import AccountSupervisor
+from rules import RuleProcessor, RuleLoader
+from rules.simulation import simulate, stream_email_batches
 from database import db_manager
+from database.partitions import apply_retention
 from config import Config
 from utils import parse_arguments, get_logger
 
@@ -27,13 +32,78 @@ def setup_database() -> bool:
         return False
 
 
-def fetch_emails_step(gmail_client: GmailClient) -> bool:
-    """Fetch and store emails from Gmail."""
+def retention_step(keep_months: int, archive: bool) -> bool:
+    """Detach email partitions older than keep_months."""
+
+    if not Config.EMAIL_PARTITIONING:
+        logger.error("Retention requires EMAIL_PARTITIONING=true")
+        return False
+    try:
+        with db_manager.get_session() as session:
+            removed = apply_retention(session, keep_months, archive=archive)
+        logger.info(f"Retention complete: {len(removed)} partitions removed")
+        return True
+    except Exception as e:
+        logger.error(f"Retention failed: {e}")
+        return False
+
+
+def dry_run_step(rules_file: str = None, account_id: str = None) -> bool:
+    """Report how many stored emails each rule would match, without acting."""
+
+    try:
+        rule_loader = RuleLoader(rules_file=rules_file)
+        rules = rule_loader.load_rules()
+        logger.info(f"Dry-run of {len(rules)} rules over stored emails...")
+        with db_manager.get_session() as session:
+            batches = stream_email_batches(
+                session,
+                rule_loader.referenced_fields(),
+                account_id=account_id,
+                since=rule_loader.earliest_match_date(),
+            )
+            report = simulate(rules, batches)
+        logger.info(f"Dry-run complete:\n{report}")
+        return True
+    except Exception as e:
+        logger.error(f"Dry-run failed: {e}")
+        return False
+
+
+def reparse_step(account_ids: list) -> bool:
+    """Rebuild stored emails of the accounts from their raw message cache."""
+
+    try:
+        for account_id in account_ids:
+            logger.info(f"Reparsing cached messages of account {account_id}...")
+            success_count, failure_count = EmailStore.reparse(account_id)
+            if failure_count > 0:
+                logger.warning(f"Some cached messages failed to parse: {failure_count} failures")
+        return True
+    except Exception as e:
+        logger.error(f"Reparse failed: {e}")
+        return False
+
+
+async def _afetch_and_store(store: EmailStore):
+    try:
+        return await store.afetch_and_store()
+    finally:
+        await db_manager.dispose_async()
+
+
+def fetch_emails_step(
+    gmail_client: GmailClient, fused: bool = False, use_async: bool = False
+) -> bool:
+    """Fetch and store emails from Gmail, evaluating rules on the way if fused."""
 
     try:
-        logger.info("Fetching emails.")
-        store = EmailStore(gmail_client)
-        success_count, failure_count = store.fetch_and_store()
+        logger.info("Fetching emails." + (" Rules are applied while fetching." if fused else ""))
+        store = EmailStore(gmail_client, processor=RuleProcessor(gmail_client) if fused else None)
+        if use_async:
+            success_count, failure_count = asyncio.run(_afetch_and_store(store))
+        else:
+            success_count, failure_count = store.fetch_and_store()
         logger.info(f"Successfully fetched emails count - {success_count}.")
         if failure_count > 0:
             logger.warning(f"Some emails failed to fetch: {failure_count} failures")
@@ -43,6 +113,29 @@ def fetch_emails_step(gmail_client: GmailClient) -> bool:
         return False
 
 
+def backfill_step(gmail_client: GmailClient, fused: bool = False) -> bool:
+    """Fetch the whole mailbox, resuming from the last stored page."""
+
+    try:
+        if Config.BACKFILL_WORKERS > 1:
+            logger.info(f"Backfilling mailbox with {Config.BACKFILL_WORKERS} workers...")
+            backfill = ShardedBackfill(gmail_client, fused=fused)
+            stats = backfill.run()
+            if backfill.errors:
+                logger.error(f"{len(backfill.errors)} backfill shards failed")
+                return False
+        else:
+            logger.info("Backfilling mailbox...")
+            processor = RuleProcessor(gmail_client) if fused else None
+            stats = MailboxBackfill(gmail_client, processor=processor).run()
+        if stats.messages_failed > 0:
+            logger.warning(f"Some emails failed to fetch: {stats.messages_failed} failures")
+        return True
+    except Exception as e:
+        logger.error(f"Backfill failed: {e}")
+        return False
+
+
 def process_rules_step(gmail_client: GmailClient) -> bool:
     """Apply rules to stored emails."""
 
@@ -58,7 +151,54 @@ def process_rules_step(gmail_client: GmailClient) -> bool:
         return False
 
 
-def main(fetch_only: bool = False, process_only: bool = False) -> int:
+def dispatch_actions_step(gmail_client: GmailClient) -> bool:
+    """Send queued actions to Gmail."""
+
+    try:
+        logger.info("Dispatching queued actions...")
+        stats = ActionDispatcher(gmail_client).dispatch()
+        if stats.entries_failed > 0:
+            logger.warning(f"Some actions failed: {stats.entries_failed} failures")
+        return True
+    except Exception as e:
+        logger.error(f"Action dispatch failed: {e}")
+        return False
+
+
+def worker_step(gmail_client: GmailClient) -> bool:
+    """Evaluate rules and dispatch actions continuously."""
+
+    try:
+        processor = RuleProcessor(gmail_client)
+        processor.run_worker(dispatcher=ActionDispatcher(gmail_client))
+        return True
+    except Exception as e:
+        logger.error(f"Rule worker failed: {e}")
+        return False
+
+
+def all_accounts_step(fetch: bool, process: bool, dispatch: bool, fused: bool = False) -> bool:
+    """Run the workflow for every configured account."""
+
+    logger.info(f"Running {len(Config.ACCOUNTS)} accounts: {', '.join(Config.ACCOUNTS)}")
+    results = AccountSupervisor(Config.ACCOUNTS).run(fetch, process, dispatch, fused=fused)
+    failed = [result.account_id for result in results.values() if not result.ok]
+    if failed:
+        logger.error(f"Accounts with errors: {', '.join(failed)}")
+    return not failed
+
+
+def main(
+    fetch_only: bool = False,
+    process_only: bool = False,
+    dispatch_only: bool = False,
+    account_id: str = Config.DEFAULT_ACCOUNT,
+    all_accounts: bool = False,
+    worker: bool = False,
+    fused: bool = Config.FUSED_PROCESSING,
+    use_async: bool = Config.ASYNC_INGEST,
+    backfill: bool = False,
+) -> int:
     """Main application workflow."""
 
     logger.info("-----Gmail Rule Engine Starting-----")
@@ -70,25 +210,50 @@ def main(fetch_only: bool = False, process_only: bool = False) -> int:
         logger.error(f"Env validation failed - {e}")
         return 1
 
+    if all_accounts:
+        if not all_accounts_step(
+            fetch=not (process_only or dispatch_only),
+            process=not (fetch_only or dispatch_only),
+            dispatch=not fetch_only,
+            fused=fused,
+        ):
+            return 1
+        logger.info("-----Gmail Rule Engine Completed Successfully-----")
+        return 0
+
     try:
-        logger.info("Authenticating with Gmail...")
-        authenticator = GmailAuthenticator()
-        credentials = authenticator.authenticate()
-        gmail_client = GmailClient(credentials)
+        logger.info(f"Authenticating with Gmail (account {account_id})...")
+        credentials = get_credential_provider(account_id).credentials()
+        gmail_client = GmailClient(credentials, account_id=account_id)
         logger.info("Authentication successful")
     except Exception as e:
         logger.error(f"Gmail authentication failed: {e}")
         return 1
 
-    if not process_only:
-        if not fetch_emails_step(gmail_client):
+    if worker:
+        return 0 if worker_step(gmail_client) else 1
+
+    if backfill:
+        if not backfill_step(gmail_client, fused=fused and not fetch_only):
+            logger.error("Backfill failed; run it again to resume.")
+            return 1
+    elif not (process_only or dispatch_only):
+        # fused evaluation only when this run also processes rules
+        if not fetch_emails_step(
+            gmail_client, fused=fused and not fetch_only, use_async=use_async
+        ):
             logger.error("Email fetching step failed. Continuing anyway...")
 
-    if not fetch_only:
+    if not (fetch_only or dispatch_only):
         if not process_rules_step(gmail_client):
             logger.error("Rule processing step failed.")
             return 1
 
+    if not fetch_only:
+        if not dispatch_actions_step(gmail_client):
+            logger.error("Action dispatch step failed.")
+            return 1
+
     logger.info("-----Gmail Rule Engine Completed Successfully-----")
     return 0
 
@@ -106,6 +271,26 @@ if __name__ == "__main__":
             logger.error("Database initialization failed")
             sys.exit(1)
 
+    if args.retention_months is not None:
+        sys.exit(0 if retention_step(args.retention_months, args.archive) else 1)
+
+    if args.reparse:
+        account_ids = Config.ACCOUNTS if args.all_accounts else [args.account or Config.DEFAULT_ACCOUNT]
+        sys.exit(0 if reparse_step(account_ids) else 1)
+
+    if args.dry_run:
+        sys.exit(0 if dry_run_step(args.rules, args.account) else 1)
+
     # Run main func
-    exit_code = main(fetch_only=args.fetch_only, process_only=args.process_only)
+    exit_code = main(
+        fetch_only=args.fetch_only,
+        process_only=args.process_only,
+        dispatch_only=args.dispatch_only,
+        account_id=args.account or Config.DEFAULT_ACCOUNT,
+        all_accounts=args.all_accounts,
+        worker=args.worker,
+        fused=args.fused or Config.FUSED_PROCESSING,
+        use_async=args.async_fetch or Config.ASYNC_INGEST,
+        backfill=args.backfill,
+    )
     sys.exit(exit_code)
@@ -1,9 +1,13 @@
+import hashlib
+import json
 from abc import ABC, abstractmethod
 from enum import Enum
 from typing import Any
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 
 from database import Email
+from rules.regex import RegexScanner, validate_pattern
+from utils import fold, parse_sender
 
 
 class PredicateType(str, Enum):
@@ -17,9 +21,53 @@ class FieldType(str, Enum):
     """Email fields that can be used in conditions."""
 
     SENDER = "sender"
+    SENDER_ADDRESS = "sender_address"
+    SENDER_DOMAIN = "sender_domain"
     SUBJECT = "subject"
     MESSAGE = "message"
     RECEIVED_AT = "received_at"
+    LIST_ID = "list_id"
+    REPLY_TO = "reply_to"
+    THREAD_ID = "thread_id"
+    TO = "to"
+    CC = "cc"
+    LABELS = "labels"
+
+
+# Casefolded copies stored at ingest. sender_address/sender_domain are folded already.
+FOLDED_FIELDS = {
+    FieldType.SENDER.value: "sender_folded",
+    FieldType.SUBJECT.value: "subject_folded",
+    FieldType.MESSAGE.value: "message_folded",
+}
+SENDER_PARTS = (FieldType.SENDER_ADDRESS.value, FieldType.SENDER_DOMAIN.value)
+# Fields stored as arrays; a condition holds if any element satisfies it
+# (for does_not_contain/not_equals: if no element violates it)
+ARRAY_FIELDS = {
+    FieldType.TO.value: "to_addresses",
+    FieldType.CC.value: "cc_addresses",
+    FieldType.LABELS.value: "label_ids",
+}
+
+# Relative cost of evaluating a condition on each field (the body is decompressed and long)
+FIELD_COSTS = {
+    FieldType.RECEIVED_AT.value: 1,
+    FieldType.SENDER_ADDRESS.value: 2,
+    FieldType.SENDER_DOMAIN.value: 2,
+    FieldType.LIST_ID.value: 2,
+    FieldType.REPLY_TO.value: 2,
+    FieldType.THREAD_ID.value: 2,
+    FieldType.SENDER.value: 3,
+    FieldType.TO.value: 3,
+    FieldType.CC.value: 3,
+    FieldType.LABELS.value: 3,
+    FieldType.SUBJECT.value: 4,
+    FieldType.MESSAGE.value: 20,
+}
+# Rules re-sort their conditions every this many evaluations
+REORDER_INTERVAL = 256
+# Counts are halved past this, so old observations fade
+MAX_OBSERVATIONS = 10000
 
 
 class Condition(ABC):
@@ -29,6 +77,8 @@ class Condition(ABC):
         self.field = field
         self.predicate = predicate
         self.value = value
+        self.evaluations = 0
+        self.passes = 0
 
     @abstractmethod
     def evaluate(self, email: Email):
@@ -37,18 +87,95 @@ class Condition(ABC):
     def get_field_value(self, email: Email):
         return getattr(email, self.field, None)
 
+    def earliest_match_date(self, now: datetime):
+        """Oldest received_at this condition can match, or None if unbounded."""
+
+        return None
+
+    def cost(self) -> float:
+        """Estimated relative cost of one evaluation."""
+
+        return FIELD_COSTS.get(self.field, 5)
+
+    def pass_rate(self) -> float:
+        """Observed share of evaluations that matched (smoothed, 0.5 with no data)."""
+
+        return (self.passes + 1) / (self.evaluations + 2)
+
+    def observe(self, result: bool) -> None:
+        self.evaluations += 1
+        if result:
+            self.passes += 1
+        if self.evaluations > MAX_OBSERVATIONS:
+            self.evaluations //= 2
+            self.passes //= 2
+
+    def referenced_fields(self) -> set:
+        """Email attributes this condition reads."""
+
+        return {self.field}
+
 
 class StringCondition(Condition):
 
+    # Shared ConditionCache, attached by RuleLoader
+    cache = None
+
+    def __init__(self, field: str, predicate: str, value: Any):
+        super().__init__(field, predicate, value)
+        values = value if isinstance(value, list) else [value]
+        self.values = [fold(v) for v in values]  # folded once at load
+
+    def get_field_value(self, email: Email):
+        """Return the casefolded field, falling back to folding the raw value."""
+
+        if self.field in ARRAY_FIELDS:
+            elements = getattr(email, ARRAY_FIELDS[self.field], None)
+            return None if elements is None else tuple(fold(element) for element in elements)
+        folded_attr = FOLDED_FIELDS.get(self.field)
+        if folded_attr:
+            folded = getattr(email, folded_attr, None)
+            if folded is not None:
+                return folded
+        field_value = getattr(email, self.field, None)
+        if field_value is None and self.field in SENDER_PARTS and email.sender:
+            address, domain = parse_sender(email.sender)
+            return address if self.field == FieldType.SENDER_ADDRESS else domain
+        return fold(field_value) if field_value is not None else None
+
+    def referenced_fields(self) -> set:
+        if self.field in ARRAY_FIELDS:
+            return {self.field, ARRAY_FIELDS[self.field]}
+        if self.field in SENDER_PARTS:
+            return {self.field, FieldType.SENDER.value}
+        folded_attr = FOLDED_FIELDS.get(self.field)
+        if folded_attr and self.field != FieldType.MESSAGE:
+            return {self.field, folded_attr}
+        return {self.field}
+
     def evaluate(self, email: Email) -> bool:
 
         field_value = self.get_field_value(email)
         if field_value is None:
             return False
-        field_value = str(field_value).lower()
-        values = self.value if isinstance(self.value, list) else [self.value]
-        values = [str(v).lower() for v in values]
-
+        if self.cache is not None:
+            return self.cache.lookup(self, field_value)
+        return self.match_value(field_value)
+
+    def match_value(self, field_value) -> bool:
+        """Result for a casefolded field value (a tuple for array fields)."""
+
+        values = self.values
+        if isinstance(field_value, tuple):
+            if self.predicate == "contains":
+                return any(v in element for element in field_value for v in values)
+            elif self.predicate == "does_not_contain":
+                return all(v not in element for element in field_value for v in values)
+            elif self.predicate == "equals":
+                return any(element in values for element in field_value)
+            elif self.predicate == "not_equals":
+                return all(element not in values for element in field_value)
+            return False
         if self.predicate == "contains":
             return any(v in field_value for v in values)
         elif self.predicate == "does_not_contain":
@@ -60,6 +187,33 @@ class StringCondition(Condition):
         return False
 
 
+class RegexCondition(StringCondition):
+    """
+    `matches_regex`: the field matches any of the patterns (case-insensitive).
+    Patterns are validated and compiled once at load; when the rules are loaded
+    together, patterns on the same field share one RegexScanner.
+    """
+
+    def __init__(self, field: str, predicate: str, value: Any):
+        Condition.__init__(self, field, predicate, value)
+        self.values = value if isinstance(value, list) else [value]  # not folded: \S != \s
+        for pattern in self.values:
+            validate_pattern(pattern)
+        self.attach_scanner(RegexScanner(field))
+
+    def cost(self) -> float:
+        return super().cost() * 2
+
+    def attach_scanner(self, scanner: RegexScanner) -> None:
+        self.scanner = scanner
+        self.pattern_ids = frozenset(scanner.add(pattern) for pattern in self.values)
+
+    def match_value(self, field_value) -> bool:
+        if isinstance(field_value, tuple):
+            return any(self.match_value(element) for element in field_value)
+        return not self.pattern_ids.isdisjoint(self.scanner.scan(field_value))
+
+
 class DateCondition(Condition):
 
     def __init__(self, field: str, predicate: str, value: int, unit: str):
@@ -87,29 +241,110 @@ class DateCondition(Condition):
             return delta > self.value
         return False
 
+    def earliest_match_date(self, now: datetime):
+        """Only `less_than` puts a lower bound on received_at."""
+
+        if self.field != FieldType.RECEIVED_AT or self.predicate != "less_than":
+            return None
+        if self.unit == "days":
+            return now - timedelta(days=self.value)
+        if self.unit == "months":
+            # months delta < value  =>  received in or after month (now - value + 1)
+            index = now.year * 12 + now.month - 1 - self.value + 1
+            return datetime(index // 12, index % 12 + 1, 1, tzinfo=timezone.utc)
+        return None
 
-class Rule:
-    """This class repr a single rule with conditions & actions."""
 
-    def __init__(self, predicate, conditions, actions, description):
+class Rule:
+    """
+    This class repr a single rule with conditions & actions.
+    Conditions are evaluated cheapest-and-most-decisive first: for `All`, the
+    order minimises cost per rejection, for `Any` cost per match, using each
+    condition's cost estimate and observed pass rate. The result is the same
+    in any order; only the work done to reach it changes.
+    """
+
+    def __init__(self, predicate, conditions, actions, description, rule_hash=None):
         self.predicate = predicate
         self.conditions = conditions
         self.actions = actions
         self.description = description
+        self.rule_hash = rule_hash
+        self._evaluations = 0
+        self.reorder()
+
+    def reorder(self) -> None:
+        """Sort the evaluation order by expected cost to decide the rule."""
+
+        if self.predicate == PredicateType.ALL:
+            def key(condition):
+                return condition.cost() / (1 - condition.pass_rate())
+        else:
+            def key(condition):
+                return condition.cost() / condition.pass_rate()
+        self.evaluation_order = sorted(self.conditions, key=key)  # stable: ties keep file order
+
+    def condition_stats(self) -> list:
+        """[evaluations, passes] per condition, in definition order."""
+
+        return [[condition.evaluations, condition.passes] for condition in self.conditions]
+
+    def load_condition_stats(self, stats: list) -> None:
+        """Restore counts saved by condition_stats() and reorder."""
+
+        if len(stats) != len(self.conditions):
+            return
+        for condition, (evaluations, passes) in zip(self.conditions, stats):
+            condition.evaluations, condition.passes = evaluations, passes
+        self.reorder()
+
+    def referenced_fields(self) -> set:
+        """Email attributes read by any of this rule's conditions."""
+
+        fields = set()
+        for condition in self.conditions:
+            fields |= condition.referenced_fields()
+        return fields
+
+    def earliest_match_date(self, now: datetime):
+        """Oldest received_at this rule can match, or None if unbounded."""
+
+        bounds = [condition.earliest_match_date(now) for condition in self.conditions]
+        if self.predicate == PredicateType.ALL:
+            bounds = [bound for bound in bounds if bound is not None]
+            return max(bounds) if bounds else None
+        if not bounds or None in bounds:
+            return None
+        return min(bounds)
 
     def matches(self, email: Email) -> bool:
         """Check if the email matching this rule."""
 
         if not self.conditions:
             return False
-        if self.predicate == PredicateType.ALL:
-            return all([condition.evaluate(email) for condition in self.conditions])
-        else:
-            # Assuming the predicate is "any".
-            for condition in self.conditions:
-                if condition.evaluate(email):
-                    return True
-            return False
+        self._evaluations += 1
+        if self._evaluations % REORDER_INTERVAL == 0:
+            self.reorder()
+        # All stops at the first failing condition, Any at the first passing one
+        decisive = self.predicate != PredicateType.ALL
+        for condition in self.evaluation_order:
+            result = bool(condition.evaluate(email))
+            condition.observe(result)
+            if result == decisive:
+                return decisive
+        return not decisive
+
+
+def compute_rule_hash(rule_dict: dict) -> str:
+    """Stable hash of what a rule does. The description is not part of it."""
+
+    definition = {
+        "predicate": rule_dict.get("predicate"),
+        "conditions": rule_dict.get("conditions"),
+        "actions": rule_dict.get("actions"),
+    }
+    encoded = json.dumps(definition, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
 
 
 class ConditionCreator:
@@ -127,5 +362,7 @@ class ConditionCreator:
         if "unit" in condition_dict:  # Date conditions have unit
             unit = condition_dict["unit"]
             return DateCondition(field, predicate, value, unit)
+        elif predicate == "matches_regex":
+            return RegexCondition(field, predicate, value)
         else:
             return StringCondition(field, predicate, value)
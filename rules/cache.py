@@ -0,0 +1,61 @@
+from collections import OrderedDict
+
+from config import Config
+from rules.base import FieldType, StringCondition
+
+# Bodies rarely repeat and would make large keys
+UNCACHED_FIELDS = {FieldType.MESSAGE.value}
+
+
+class ConditionCache:
+    """
+    Bounded LRU of string condition results keyed by (condition, field value).
+    Most mail comes from a few senders and repeats subjects, so those
+    evaluations become a dictionary lookup. Lives as long as its rules (one run).
+    """
+
+    def __init__(self, max_size: int = None):
+        self.max_size = Config.CONDITION_CACHE_SIZE if max_size is None else max_size
+        self.hits = 0
+        self.misses = 0
+        self._results = OrderedDict()
+
+    def lookup(self, condition: StringCondition, value: str) -> bool:
+        """Cached result of condition.match_value(value)."""
+
+        key = (id(condition), value)
+        result = self._results.get(key)
+        if result is not None:
+            self.hits += 1
+            self._results.move_to_end(key)
+            return result
+        self.misses += 1
+        result = condition.match_value(value)
+        self._results[key] = result
+        if len(self._results) > self.max_size:
+            self._results.popitem(last=False)
+        return result
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"Condition cache: {self.hits} hits, {self.misses} misses "
+            f"({self.hit_rate:.0%} hit rate), {len(self._results)} entries"
+        )
+
+
+def attach_condition_cache(rules: list, max_size: int = None):
+    """Share one cache between the cacheable string conditions of rules."""
+
+    cache = ConditionCache(max_size)
+    if cache.max_size <= 0:
+        return None
+    for rule in rules:
+        for condition in rule.conditions:
+            if isinstance(condition, StringCondition) and condition.field not in UNCACHED_FIELDS:
+                condition.cache = cache
+    return cache
@@ -0,0 +1,142 @@
+import re
+from bisect import bisect_right
+from collections import defaultdict
+from datetime import datetime, timezone
+
+from rules.base import (
+    DateCondition,
+    FieldType,
+    PredicateType,
+    RegexCondition,
+    StringCondition,
+)
+from rules.regex import RegexScanner
+
+# Indexed conditions, most selective first; an All rule is filed under its best one
+EQUALS, KEYWORDS, DATE = 0, 1, 2
+
+
+def _index_kind(condition):
+    """How a condition can be looked up, or None if every email is a candidate."""
+
+    if isinstance(condition, RegexCondition):
+        return None
+    if isinstance(condition, StringCondition):
+        if condition.predicate == "equals":
+            return EQUALS
+        if condition.predicate == "contains":
+            return KEYWORDS
+        return None
+    if isinstance(condition, DateCondition):
+        if condition.field == FieldType.RECEIVED_AT and condition.predicate == "less_than":
+            return DATE
+    return None
+
+
+class RuleIndex:
+    """
+    Finds the rules an email could match without evaluating every rule.
+    Each rule is filed under conditions it can't match without:
+    - `equals` values in a hash table per field
+    - `contains` keywords in one keyword scanner per field (all keywords on
+      a field are found in a single pass)
+    - `received_at less_than` windows in a list sorted by lower bound
+    An `All` rule is filed under its most selective indexable condition; an
+    `Any` rule under all of its conditions, or always a candidate if one of
+    them can't be indexed. Candidates still get fully evaluated.
+    """
+
+    # Date windows are recomputed this often; older bounds only admit more rules
+    DATE_REFRESH_SECONDS = 60
+
+    def __init__(self, rules: list):
+        self.rules = list(rules)
+        self.always = set()
+        self.equals = defaultdict(lambda: defaultdict(set))  # field -> value -> rules
+        self.keywords = {}  # field -> RegexScanner
+        self.keyword_rules = defaultdict(lambda: defaultdict(set))  # field -> keyword -> rules
+        self.dated = []  # (position, condition)
+        self._readers = {}
+        self._date_bounds = []
+        self._date_positions = []
+        self._dates_computed_at = None
+
+        for position, rule in enumerate(self.rules):
+            entries = self._entries(rule)
+            if entries is None:
+                self.always.add(position)
+                continue
+            for kind, condition in entries:
+                self._file(position, kind, condition)
+
+    def _entries(self, rule) -> list:
+        """Conditions to file the rule under, or None if it must always be evaluated."""
+
+        kinds = [(_index_kind(condition), condition) for condition in rule.conditions]
+        if not kinds:
+            return None
+        if rule.predicate == PredicateType.ALL:
+            indexable = [entry for entry in kinds if entry[0] is not None]
+            if not indexable:
+                return None
+            return [min(indexable, key=lambda entry: entry[0])]
+        if any(kind is None for kind, _ in kinds):
+            return None
+        return kinds
+
+    def _file(self, position: int, kind: int, condition) -> None:
+        field = condition.field
+        self._readers.setdefault(field, StringCondition(field, "equals", ""))
+        if kind == EQUALS:
+            for value in condition.values:
+                self.equals[field][value].add(position)
+        elif kind == KEYWORDS:
+            scanner = self.keywords.setdefault(field, RegexScanner(field, max_input_chars=None))
+            for value in condition.values:
+                keyword = scanner.add(re.escape(value))
+                self.keyword_rules[field][keyword].add(position)
+        else:
+            self.dated.append((position, condition))
+
+    def _refresh_dates(self, now: datetime) -> None:
+        if (
+            self._dates_computed_at is not None
+            and (now - self._dates_computed_at).total_seconds() < self.DATE_REFRESH_SECONDS
+        ):
+            return
+        bounds = sorted(
+            (condition.earliest_match_date(now), position) for position, condition in self.dated
+        )
+        self._date_bounds = [bound for bound, _ in bounds]
+        self._date_positions = [position for _, position in bounds]
+        self._dates_computed_at = now
+
+    def candidates(self, email, rules: list = None) -> list:
+        """Rules (from rules, default all) that email could match, in rule order."""
+
+        found = set(self.always)
+        for field, values in self.equals.items():
+            value = self._readers[field].get_field_value(email)
+            for element in value if isinstance(value, tuple) else (value,):
+                if element is not None and element in values:
+                    found |= values[element]
+        for field, scanner in self.keywords.items():
+            value = self._readers[field].get_field_value(email)
+            if value is None:
+                continue
+            if isinstance(value, tuple):  # keywords never contain the separator
+                value = "\x00".join(value)
+            for keyword in scanner.scan(value):
+                found |= self.keyword_rules[field][keyword]
+        if self.dated and email.received_at is not None:
+            self._refresh_dates(datetime.now(timezone.utc))
+            received_at = email.received_at
+            if received_at.tzinfo is None:
+                received_at = received_at.replace(tzinfo=timezone.utc)
+            found.update(self._date_positions[: bisect_right(self._date_bounds, received_at)])
+
+        matched = [self.rules[position] for position in sorted(found)]
+        if rules is None:
+            return matched
+        allowed = {id(rule) for rule in rules}
+        return [rule for rule in matched if id(rule) in allowed]
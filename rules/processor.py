@@ -1,12 +1,20 @@
-from dataclasses import dataclass
+import hashlib
+import json
+import time
+from dataclasses import dataclass, field
 
-from database import Email
+from sqlalchemy import or_, select, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import load_only, selectinload
+
+from database import Email, RulesetVersion, ActionOutbox
 from database import get_db_session
 from services import GmailClient
 from rules import RuleLoader
-from actions import get_action
+from rules.index import RuleIndex
+from actions import get_action, LabelDelta
 from config import Config
-from utils import get_logger
+from utils import get_logger, PER_EMAIL
 
 logger = get_logger(__name__)
 
@@ -17,85 +25,337 @@ class ProcessingStats:
 
     emails_processed: int = 0
     emails_matched: int = 0
-    actions_executed: int = 0
-    actions_successful: int = 0
+    rules_evaluated: int = 0
+    actions_queued: int = 0
+    label_changes_elided: int = 0
     actions_failed: int = 0
 
     def __str__(self) -> str:
         return (
             f"Processed: {self.emails_processed} emails\n"
             f"Matched: {self.emails_matched} emails\n"
-            f"Executed actions: {self.actions_executed}\n"
-            f"Success actions: {self.actions_successful}\n"
+            f"Rule evaluations: {self.rules_evaluated}\n"
+            f"Queued label changes: {self.actions_queued}\n"
+            f"Elided label changes: {self.label_changes_elided}\n"
             f"Failed actions: {self.actions_failed}\n"
         )
 
 
+@dataclass
+class EmailOutcome:
+    """Rules an email matched and the net label change they produce."""
+
+    matched_rules: list = field(default_factory=list)
+    sources: list = field(default_factory=list)
+    delta: LabelDelta = None
+
+
 class RuleProcessor:
-    """This class is to process the emails according to the rules."""
+    """
+    This class is to process the emails according to the rules.
+    The actions of all rules an email matches are merged into one label change,
+    queued in the action outbox in the same transaction that marks the email
+    processed; ActionDispatcher sends them to Gmail.
+    """
 
     def __init__(self, gmail_client: GmailClient):
         self.gmail_client = gmail_client
-        self.rules = RuleLoader(gmail_client=gmail_client).load_rules()
+        self.rule_loader = RuleLoader(gmail_client=gmail_client)
+        self.rules = self.rule_loader.load_rules()
+        self.rule_index = RuleIndex(self.rules)
         self.stats = ProcessingStats()
+        self.ruleset_version = None
+        self._version_hashes = {}
+        self._stale_version_ids = []
 
     def process_emails(self):
+        """Process one batch of pending emails."""
 
         if not self.rules:
             logger.warning("No rules configured")
             return self.stats
-        # Process in batches
+        self.process_batch()
+        self.rule_loader.save_condition_stats()
+        logger.info(f"Processing complete:\n{self.stats}")
+        if self.rule_loader.condition_cache is not None:
+            logger.info(str(self.rule_loader.condition_cache))
+        return self.stats
+
+    def process_batch(self) -> int:
+        """
+        Claim a batch of pending emails and evaluate it. Returns how many were claimed.
+        Rows are locked with SKIP LOCKED until the commit, so concurrent workers
+        take disjoint batches; a worker that dies mid-batch rolls back and its
+        emails become claimable again.
+        """
+
+        if not self.rules:
+            return 0
         with get_db_session() as session:
-            query = session.query(Email).filter(Email.processed == False)
-            emails = query.limit(Config.RULE_PROCESSING_BATCH_SIZE).all()
+            if self.ruleset_version is None:
+                self._load_versions(session)
+            emails = session.execute(self.pending_emails_statement()).scalars().all()
 
             logger.info(f"Found {len(emails)} emails to process")
 
             for email in emails:
-                self._process_single_email(email)
+                self._process_single_email(
+                    session, email, self._pending_rules(session, email)
+                )
             session.commit()
+        return len(emails)
 
-        logger.info(f"Processing complete:\n{self.stats}")
+    def process_fetched_email(self, session, email: Email) -> None:
+        """
+        Evaluate an email that is about to be stored (fused fetch mode).
+        Queues its actions in session and marks it processed; the caller writes
+        the email in the same transaction.
+        """
+
+        if not self.rules:
+            return
+        if self.ruleset_version is None:
+            # committed on its own so a failed fetch batch can't roll it back
+            with get_db_session() as version_session:
+                self._load_versions(version_session)
+        self._process_single_email(session, email, self.rules)
+
+    def pending_emails_statement(self):
+        """
+        SELECT claiming the next batch of this account's pending emails:
+        unprocessed ones first, then those evaluated against a ruleset version
+        that lacks some of the current rules.
+        """
+
+        pending = Email.processed == False
+        if self._stale_version_ids:
+            pending = or_(pending, Email.ruleset_version_id.in_(self._stale_version_ids))
+        stmt = (
+            select(Email)
+            .options(*self._load_options())
+            .where(
+                Email.account_id == self.gmail_client.account_id,
+                pending,
+                # emails that keep failing would otherwise be claimed again forever
+                Email.rule_failures < Config.RULE_MAX_ATTEMPTS,
+            )
+            .order_by(Email.processed)
+        )
+        earliest = self.rule_loader.earliest_match_date()
+        if earliest is not None:  # older mail can't match; prunes old partitions
+            stmt = stmt.where(Email.received_at >= earliest)
+        return stmt.limit(Config.RULE_PROCESSING_BATCH_SIZE).with_for_update(
+            of=Email, skip_locked=True
+        )
+
+    async def apending_emails(self, session) -> list:
+        """Async version of the pending-email query, for an AsyncSession."""
+
+        if self.ruleset_version is None:
+            await session.run_sync(self._load_versions)
+        result = await session.execute(self.pending_emails_statement())
+        return result.scalars().all()
+
+    def run_worker(self, dispatcher=None, poll_seconds: float = None, stop_when_idle: bool = False):
+        """
+        Keep claiming and evaluating batches (and draining the outbox, if a
+        dispatcher is given). Sleeps poll_seconds when there is nothing to do.
+        Any number of workers can run against the same database.
+        """
+
+        if poll_seconds is None:
+            poll_seconds = Config.WORKER_POLL_SECONDS
+        logger.info("Rule worker started")
+        try:
+            while True:
+                claimed = self.process_batch()
+                dispatched = dispatcher.dispatch_batch() if dispatcher else False
+                if claimed or dispatched:
+                    continue
+                if stop_when_idle:
+                    break
+                time.sleep(poll_seconds)
+        except KeyboardInterrupt:
+            logger.info("Rule worker interrupted")
+        self.rule_loader.save_condition_stats()
+        logger.info(f"Rule worker stopped:\n{self.stats}")
+        if self.rule_loader.condition_cache is not None:
+            logger.info(str(self.rule_loader.condition_cache))
         return self.stats
 
-    def _process_single_email(self, email: Email) -> None:
-        """Process a single email with al rules."""
+    def _load_options(self) -> list:
+        """
+        Load only the columns the rules read (plus what actions need).
+        Other columns are deferred and fetched on access.
+        """
+
+        fields = self.rule_loader.referenced_fields()
+        columns = Email.__table__.columns
+        attrs = [
+            Email.account_id,
+            Email.id,
+            Email.is_read,
+            Email.label_ids,
+            Email.processed,
+            Email.ruleset_version_id,
+            Email.rule_failures,
+        ]
+        attrs += [getattr(Email, field) for field in sorted(fields) if field in columns]
+        options = [load_only(*attrs)]
+        if "message" in fields:
+            options.append(selectinload(Email.body))  # one query per batch
+        return options
+
+    def _get_ruleset_version(self, session) -> RulesetVersion:
+        """Get or create the version row for the loaded rules."""
+
+        hashes = sorted({rule.rule_hash for rule in self.rules})
+        fingerprint = hashlib.sha256("\n".join(hashes).encode("utf-8")).hexdigest()
+        first_version = session.query(RulesetVersion.id).first() is None
+        created = session.execute(
+            insert(RulesetVersion)
+            .values(fingerprint=fingerprint, rule_hashes=hashes)
+            .on_conflict_do_nothing(index_elements=["fingerprint"])
+        ).rowcount
+        version = session.query(RulesetVersion).filter_by(fingerprint=fingerprint).one()
+        if created:
+            # New rules may no longer fail on emails given up on before
+            session.query(Email).filter(Email.rule_failures > 0).update(
+                {Email.rule_failures: 0}, synchronize_session=False
+            )
+        if first_version:
+            # Mail processed before versions existed is taken as evaluated against these rules
+            session.query(Email).filter(
+                Email.processed == True, Email.ruleset_version_id.is_(None)
+            ).update({Email.ruleset_version_id: version.id}, synchronize_session=False)
+        self._version_hashes[version.id] = set(hashes)
+        return version
+
+    def _load_versions(self, session) -> None:
+        """
+        Get the current ruleset version and sort the others: emails on a version
+        that already covers every current rule are restamped in one UPDATE, and
+        versions that miss some are left for pending_emails_statement to claim.
+        """
+
+        self.ruleset_version = self._get_ruleset_version(session)
+        current = self._version_hashes[self.ruleset_version.id]
+        covered = []
+        self._stale_version_ids = []
+        for version_id, hashes in session.query(RulesetVersion.id, RulesetVersion.rule_hashes):
+            self._version_hashes[version_id] = set(hashes or [])
+            if version_id == self.ruleset_version.id:
+                continue
+            if current <= self._version_hashes[version_id]:
+                covered.append(version_id)
+            else:
+                self._stale_version_ids.append(version_id)
+        if covered:
+            session.execute(
+                update(Email)
+                .where(
+                    Email.account_id == self.gmail_client.account_id,
+                    Email.ruleset_version_id.in_(covered),
+                )
+                .values(ruleset_version_id=self.ruleset_version.id)
+                .execution_options(synchronize_session=False)
+            )
+
+    def _pending_rules(self, session, email: Email) -> list:
+        """Rules this email has not been evaluated against yet."""
+
+        if not email.processed or email.ruleset_version_id is None:
+            return self.rules
+        version_id = email.ruleset_version_id
+        if version_id not in self._version_hashes:
+            hashes = session.query(RulesetVersion.rule_hashes).filter_by(id=version_id).scalar()
+            self._version_hashes[version_id] = set(hashes or [])
+        evaluated = self._version_hashes[version_id]
+        return [rule for rule in self.rules if rule.rule_hash not in evaluated]
+
+    def _process_single_email(self, session, email: Email, rules: list) -> None:
+        """Process a single email with the given rules."""
 
         self.stats.emails_processed += 1
-        matched_any_rule = False
         try:
-            for rule in self.rules:
-                if rule.matches(email):
-                    matched_any_rule = True
-                    logger.info(
-                        f"Email {email.id[:10]}... matched rule: {rule.description}"
-                    )
-                    for action_dict in rule.actions: # Execute actions
-                        self._execute_action(email, action_dict)
-            if matched_any_rule:
+            outcome = self.evaluate_email(email, self.rule_index.candidates(email, rules))
+            if outcome.matched_rules:
                 self.stats.emails_matched += 1
+                self._enqueue(session, email, outcome)
             email.processed = True
+            email.ruleset_version_id = self.ruleset_version.id
+            email.rule_failures = 0
         except Exception as e:
             logger.error(f"Error processing email {email.id}: {e}")
+            email.rule_failures = (email.rule_failures or 0) + 1
+
+    def evaluate_email(self, email: Email, rules: list) -> EmailOutcome:
+        """
+        Match rules and merge their actions into one net label change.
+        Contradictory changes cancel out and changes the stored state
+        already reflects are dropped.
+        """
 
-    def _execute_action(self, email: Email, action_dict: dict) -> None:
-        """Execute a single action on an email."""
+        outcome = EmailOutcome()
+        deltas = []
+        for rule in rules:
+            self.stats.rules_evaluated += 1
+            if not rule.matches(email):
+                continue
+            outcome.matched_rules.append(rule)
+            logger.info(
+                f"Email {email.id[:10]}... matched rule: {rule.description}",
+                extra=PER_EMAIL,
+            )
+            for action_dict in rule.actions:
+                delta = self._resolve_action(email, action_dict)
+                if delta is not None:
+                    deltas.append(delta)
+                    outcome.sources.append(action_dict)
+        if deltas:
+            outcome.delta = LabelDelta.combine(deltas).without_noops(
+                is_read=email.is_read, label_ids=email.label_ids
+            )
+            requested = sum(len(delta.add) + len(delta.remove) for delta in deltas)
+            net = len(outcome.delta.add) + len(outcome.delta.remove)
+            self.stats.label_changes_elided += requested - net
+        return outcome
+
+    def _resolve_action(self, email: Email, action_dict: dict):
+        """Resolve an action to its label change."""
 
         action_name = action_dict.get("action")
-        self.stats.actions_executed += 1
-        # Get action executor
         action_func = get_action(action_name)
         if not action_func:
             logger.error(f"Unknown action: {action_name}")
             self.stats.actions_failed += 1
-            return
-        # Execute action
-        try:
-            success = action_func(self.gmail_client, email, action_dict)
-            if success:
-                self.stats.actions_successful += 1
-            else:
-                self.stats.actions_failed += 1
-        except Exception as e:
-            logger.error(f"Action '{action_name}' failed for email {email.id}: {e}")
+            return None
+        delta = action_func(self.gmail_client, action_dict)
+        if delta is None:
+            logger.warning(f"Action '{action_name}' could not be resolved for email {email.id}")
             self.stats.actions_failed += 1
+        return delta
+
+    def _enqueue(self, session, email: Email, outcome: EmailOutcome) -> None:
+        """Queue the email's net label change in the outbox, if there is one."""
+
+        if outcome.delta is None or outcome.delta.is_empty():
+            return
+        rule_hashes = ",".join(sorted(rule.rule_hash for rule in outcome.matched_rules))
+        delta_json = json.dumps([sorted(outcome.delta.add), sorted(outcome.delta.remove)])
+        key = hashlib.sha256(
+            f"{email.account_id}|{email.id}|{rule_hashes}|{delta_json}".encode("utf-8")
+        )
+        session.execute(
+            insert(ActionOutbox)
+            .values(
+                idempotency_key=key.hexdigest(),
+                account_id=email.account_id,
+                email_id=email.id,
+                add_labels=sorted(outcome.delta.add),
+                remove_labels=sorted(outcome.delta.remove),
+                source=outcome.sources,
+            )
+            .on_conflict_do_nothing(index_elements=["idempotency_key"])
+        )
+        self.stats.actions_queued += 1
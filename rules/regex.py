@@ -0,0 +1,117 @@
+import re
+from collections import OrderedDict
+
+from config import Config
+
+# Quantified group that itself contains a quantifier, e.g. (a+)+ or (\w*x)*
+_NESTED_QUANTIFIER = re.compile(r"\((?:[^()\\]|\\.)*[+*}](?:[^()\\]|\\.)*\)(?:[+*]|\{\d*,)")
+_BACKREFERENCE = re.compile(r"\\[1-9]|\(\?P=")
+# Named groups clash when two patterns share a name in the merged alternation,
+# and conditionals refer to group numbers that merging shifts
+_GROUP_REFERENCE = re.compile(r"(?<!\\)\(\?(?:P<|\()")
+
+# Combined patterns kept per scanner, keyed by the patterns still unmatched
+_MAX_COMPILED = 32
+
+
+def validate_pattern(pattern: str) -> None:
+    """
+    Reject patterns that are too long, invalid, prone to catastrophic
+    backtracking, or that can't be merged into an alternation.
+    """
+
+    if not isinstance(pattern, str) or not pattern:
+        raise ValueError("Regex value must be a non-empty string")
+    if len(pattern) > Config.REGEX_MAX_PATTERN_LENGTH:
+        raise ValueError(
+            f"Regex longer than {Config.REGEX_MAX_PATTERN_LENGTH} characters: {pattern[:40]}..."
+        )
+    if _NESTED_QUANTIFIER.search(pattern):
+        raise ValueError(f"Regex has nested quantifiers (catastrophic backtracking): {pattern}")
+    if _BACKREFERENCE.search(pattern):
+        raise ValueError(f"Regex backreferences are not supported: {pattern}")
+    if _GROUP_REFERENCE.search(pattern):
+        raise ValueError(f"Regex named groups and conditionals are not supported: {pattern}")
+    try:
+        alone = re.compile(pattern, re.IGNORECASE)
+        wrapped = re.compile(f"(?P<r0>{pattern})", re.IGNORECASE)
+    except re.error as e:
+        raise ValueError(f"Invalid regex {pattern!r}: {e}")
+    if wrapped.groups != alone.groups + 1:
+        # e.g. "a)|(b", which only compiles by closing the wrapping group
+        raise ValueError(f"Regex is not one balanced expression: {pattern}")
+
+
+class RegexScanner:
+    """
+    All regexes used on one field, merged into a single alternation of named
+    groups so the field is scanned once per email instead of once per pattern.
+    An alternation reports at most one pattern per position, so patterns hidden
+    behind an earlier match are found by rescanning without the ones already
+    matched; most mail matches nothing and needs a single pass.
+    """
+
+    def __init__(self, field: str, max_input_chars: int = Config.REGEX_MAX_INPUT_CHARS):
+        self.field = field
+        self.max_input_chars = max_input_chars  # None scans the whole field
+        self.patterns = []
+        self._compiled = OrderedDict()
+        self._last_text = None
+        self._last_matches = frozenset()
+
+    def add(self, pattern: str) -> int:
+        """Register a pattern and return its index."""
+
+        if pattern in self.patterns:
+            return self.patterns.index(pattern)
+        self.patterns.append(pattern)
+        self._compiled.clear()
+        self._last_text = None
+        return len(self.patterns) - 1
+
+    def _combined(self, remaining: tuple):
+        regex = self._compiled.get(remaining)
+        if regex is None:
+            alternation = "|".join(f"(?P<r{i}>{self.patterns[i]})" for i in remaining)
+            regex = re.compile(alternation, re.IGNORECASE)
+            self._compiled[remaining] = regex
+            if len(self._compiled) > _MAX_COMPILED:
+                self._compiled.popitem(last=False)
+        else:
+            self._compiled.move_to_end(remaining)
+        return regex
+
+    def scan(self, text: str) -> frozenset:
+        """Indexes of the patterns found in text. The last result is reused."""
+
+        if text is self._last_text or text == self._last_text:
+            return self._last_matches
+        scanned = text[: self.max_input_chars] if self.max_input_chars else text
+        found = set()
+        remaining = tuple(range(len(self.patterns)))
+        while remaining:
+            new = {
+                int(match.lastgroup[1:])
+                for match in self._combined(remaining).finditer(scanned)
+                if match.lastgroup is not None  # only if a pattern escaped its group
+            }
+            if not new:
+                break
+            found |= new
+            remaining = tuple(i for i in remaining if i not in found)
+        self._last_text = text
+        self._last_matches = frozenset(found)
+        return self._last_matches
+
+
+def build_regex_scanners(rules: list) -> dict:
+    """Attach one shared scanner per field to every regex condition of rules."""
+
+    scanners = {}
+    for rule in rules:
+        for condition in rule.conditions:
+            if getattr(condition, "predicate", None) != "matches_regex":
+                continue
+            scanner = scanners.setdefault(condition.field, RegexScanner(condition.field))
+            condition.attach_scanner(scanner)
+    return scanners
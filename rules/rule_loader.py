@@ -1,12 +1,20 @@
 import json
-from jsonschema import validate, ValidationError
-
-from .base import Rule, ConditionCreator, PredicateType
+import os
+import threading
+from pathlib import Path
+from datetime import datetime, timezone
+
+from .base import Rule, ConditionCreator, PredicateType, compute_rule_hash
+from .regex import build_regex_scanners
+from .cache import attach_condition_cache
 from config import Config
 from utils import get_logger
 
 logger = get_logger(__name__)
 
+# Account workers in one process share the stats file
+_stats_lock = threading.Lock()
+
 
 RULE_SCHEMA = {
     "type": "object",
@@ -30,9 +38,17 @@ RULE_SCHEMA = {
                                     "type": "string",
                                     "enum": [
                                         "sender",
+                                        "sender_address",
+                                        "sender_domain",
                                         "subject",
                                         "message",
                                         "received_at",
+                                        "list_id",
+                                        "reply_to",
+                                        "thread_id",
+                                        "to",
+                                        "cc",
+                                        "labels",
                                     ],
                                 },
                                 "predicate": {
@@ -42,6 +58,7 @@ RULE_SCHEMA = {
                                         "does_not_contain",
                                         "equals",
                                         "not_equals",
+                                        "matches_regex",
                                         "less_than",
                                         "greater_than",
                                     ],
@@ -81,16 +98,19 @@ RULE_SCHEMA = {
 class RuleLoader:
     """Loads rules from JSON file."""
 
-    def __init__(self, gmail_client=None):
+    def __init__(self, gmail_client=None, rules_file=None):
         self.gmail_client = gmail_client
-        self.rules_file = Config.RULES_FILE
+        self.rules_file = Path(rules_file) if rules_file else Config.RULES_FILE
         self._cached_rules = None
+        self.condition_cache = None
 
     def load_rules(self):
         """Load rules from JSON."""
 
         if self._cached_rules is not None:
             return self._cached_rules
+        from jsonschema import validate, ValidationError  # slow import
+
         logger.info(f"Loading rules from {self.rules_file}")
         if not self.rules_file.exists():
             raise FileNotFoundError(f"Rules file not found: {self.rules_file}.")
@@ -113,10 +133,69 @@ class RuleLoader:
             except Exception as e:
                 logger.error(f"Failed to parse rule {idx + 1}: {e}")
 
+        build_regex_scanners(rules)  # one scan per field for all regex conditions
+        self._load_condition_stats(rules)
+        self.condition_cache = attach_condition_cache(rules)
         logger.info(f"Loaded {len(rules)} rules successfully")
         self._cached_rules = rules
         return rules
 
+    def _load_condition_stats(self, rules: list) -> None:
+        """Restore pass rates from earlier runs so conditions start well ordered."""
+
+        stats_file = Config.CONDITION_STATS_FILE
+        if not stats_file.exists():
+            return
+        try:
+            saved = json.loads(stats_file.read_text())
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable condition stats {stats_file}: {e}")
+            return
+        for rule in rules:
+            if rule.rule_hash in saved:
+                rule.load_condition_stats(saved[rule.rule_hash])
+
+    def save_condition_stats(self) -> None:
+        """Persist observed pass rates, keyed by rule hash, for the next run."""
+
+        rules = self._cached_rules or []
+        if not any(condition.evaluations for rule in rules for condition in rule.conditions):
+            return
+        stats_file = Config.CONDITION_STATS_FILE
+        with _stats_lock:
+            try:
+                saved = json.loads(stats_file.read_text()) if stats_file.exists() else {}
+            except (OSError, ValueError):
+                saved = {}
+            for rule in rules:
+                saved[rule.rule_hash] = rule.condition_stats()
+            tmp_file = stats_file.with_suffix(".tmp")
+            try:
+                tmp_file.write_text(json.dumps(saved))
+                os.replace(tmp_file, stats_file)
+            except OSError as e:
+                logger.warning(f"Could not save condition stats: {e}")
+
+    def referenced_fields(self) -> set:
+        """Email attributes referenced by the loaded rules."""
+
+        fields = set()
+        for rule in self.load_rules():
+            fields |= rule.referenced_fields()
+        return fields
+
+    def earliest_match_date(self):
+        """
+        Oldest received_at any loaded rule can match, or None if some rule
+        has no date bound. Lets processing skip old partitions.
+        """
+
+        now = datetime.now(timezone.utc)
+        bounds = [rule.earliest_match_date(now) for rule in self.load_rules()]
+        if not bounds or None in bounds:
+            return None
+        return min(bounds)
+
     def get_rule_obj(self, rule_dict: dict) -> Rule:
         """Convert dictionary into Rule object."""
 
@@ -127,6 +206,10 @@ class RuleLoader:
                 condition = ConditionCreator.create(cond_dict)
                 conditions.append(condition)
             except Exception as e:
+                # Dropping a condition of an All rule, or a rejected regex, would
+                # make the rule match mail it was written to leave alone
+                if predicate == PredicateType.ALL or cond_dict.get("predicate") == "matches_regex":
+                    raise ValueError(f"Invalid condition: {e}")
                 logger.warning(f"Skipping invalid condition: {e}")
 
         if not conditions:
@@ -145,4 +228,5 @@ class RuleLoader:
             conditions=conditions,
             actions=actions,
             description=rule_dict.get("description", ""),
+            rule_hash=compute_rule_hash(rule_dict),
         )
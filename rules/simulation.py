@@ -0,0 +1,272 @@
+"""
+Dry-run of rules over stored mail with vectorized (Arrow) evaluation.
+Emails are streamed from Postgres in record batches and each condition is
+evaluated as one compute kernel over a column, so no ORM objects are built
+and no actions are executed.
+"""
+
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import func, select
+
+from database import Email, EmailBody
+from rules.base import (
+    ARRAY_FIELDS,
+    DateCondition,
+    FieldType,
+    PredicateType,
+    RegexCondition,
+    StringCondition,
+    SENDER_PARTS,
+)
+from utils import get_logger, fold, parse_sender
+
+logger = get_logger(__name__)
+
+# Column each condition field is evaluated on (already casefolded)
+SIMULATION_COLUMNS = {
+    FieldType.SENDER.value: "sender",
+    FieldType.SENDER_ADDRESS.value: "sender_address",
+    FieldType.SENDER_DOMAIN.value: "sender_domain",
+    FieldType.SUBJECT.value: "subject",
+    FieldType.MESSAGE.value: "message",
+    FieldType.RECEIVED_AT.value: "received_at",
+    FieldType.LIST_ID.value: "list_id",
+    FieldType.REPLY_TO.value: "reply_to",
+    FieldType.THREAD_ID.value: "thread_id",
+    FieldType.TO.value: "to",
+    FieldType.CC.value: "cc",
+    FieldType.LABELS.value: "labels",
+}
+# Array fields are streamed as one string, each element wrapped in this separator,
+# so contains/equals stay substring tests
+ELEMENT_SEPARATOR = "\x00"
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.compute
+    except ImportError:
+        raise RuntimeError("pyarrow is required for --dry-run (pip install pyarrow)")
+    return pyarrow, pyarrow.compute
+
+
+@dataclass
+class RuleSimulation:
+    """Matches of one rule in a dry-run."""
+
+    description: str
+    matches: int = 0
+    sample_ids: list = field(default_factory=list)
+
+
+@dataclass
+class SimulationReport:
+    """Per-rule match counts of a dry-run."""
+
+    emails_scanned: int = 0
+    rules: list = field(default_factory=list)
+
+    def __str__(self) -> str:
+        lines = [f"Scanned: {self.emails_scanned} emails"]
+        for result in self.rules:
+            lines.append(f"{result.matches:>10}  {result.description}")
+            if result.sample_ids:
+                lines.append(f"{'':>10}  e.g. {', '.join(result.sample_ids)}")
+        return "\n".join(lines) + "\n"
+
+
+def condition_mask(condition, batch, now: datetime):
+    """Boolean array of the rows in batch matching condition (nulls never match)."""
+
+    pa, pc = _pyarrow()
+    column = batch.column(SIMULATION_COLUMNS[condition.field])
+    if isinstance(condition, RegexCondition):
+        return pc.fill_null(_regex_mask(condition, column), False)
+    if isinstance(condition, StringCondition):
+        values = condition.values
+        if condition.predicate in ("contains", "does_not_contain"):
+            mask = pc.match_substring(column, values[0])
+            for value in values[1:]:
+                mask = pc.or_(mask, pc.match_substring(column, value))
+            if condition.predicate == "does_not_contain":
+                mask = pc.invert(mask)
+        elif condition.predicate in ("equals", "not_equals") and condition.field in ARRAY_FIELDS:
+            mask = pc.match_substring(column, f"{ELEMENT_SEPARATOR}{values[0]}{ELEMENT_SEPARATOR}")
+            for value in values[1:]:
+                element = f"{ELEMENT_SEPARATOR}{value}{ELEMENT_SEPARATOR}"
+                mask = pc.or_(mask, pc.match_substring(column, element))
+            if condition.predicate == "not_equals":
+                mask = pc.invert(mask)
+        elif condition.predicate in ("equals", "not_equals"):
+            mask = pc.is_in(column, value_set=pa.array(values, type=pa.string()))
+            if condition.predicate == "not_equals":
+                mask = pc.invert(mask)
+            mask = pc.if_else(pc.is_null(column), False, mask)
+        else:
+            return pa.nulls(len(batch), pa.bool_()).fill_null(False)
+        return pc.fill_null(mask, False)
+
+    if isinstance(condition, DateCondition):
+        mask = _date_mask(condition, column, now)
+        return pc.fill_null(mask, False)
+    return pa.nulls(len(batch), pa.bool_()).fill_null(False)
+
+
+def _regex_mask(condition: RegexCondition, column):
+    """RE2 kernel when the patterns are RE2-compatible, Python's re otherwise."""
+
+    pa, pc = _pyarrow()
+    try:
+        mask = pc.match_substring_regex(column, condition.values[0], ignore_case=True)
+        for pattern in condition.values[1:]:
+            mask = pc.or_(mask, pc.match_substring_regex(column, pattern, ignore_case=True))
+        return mask
+    except pa.ArrowInvalid:  # e.g. lookarounds
+        return pa.array(
+            [
+                None if value is None
+                else not condition.pattern_ids.isdisjoint(condition.scanner.scan(value))
+                for value in column.to_pylist()
+            ],
+            type=pa.bool_(),
+        )
+
+
+def _date_mask(condition: DateCondition, column, now: datetime):
+    """Same semantics as DateCondition.evaluate, as timestamp/month comparisons."""
+
+    pa, pc = _pyarrow()
+    if condition.unit == "days":
+        # whole days elapsed < value  <=>  received after now - value days
+        if condition.predicate == "less_than":
+            return pc.greater(column, pa.scalar(now - timedelta(days=condition.value), column.type))
+        if condition.predicate == "greater_than":
+            bound = now - timedelta(days=condition.value + 1)
+            return pc.less_equal(column, pa.scalar(bound, column.type))
+    elif condition.unit == "months":
+        months = pc.add(pc.multiply(pc.year(column), 12), pc.month(column))
+        elapsed = pc.subtract(now.year * 12 + now.month, months)
+        if condition.predicate == "less_than":
+            return pc.less(elapsed, condition.value)
+        if condition.predicate == "greater_than":
+            return pc.greater(elapsed, condition.value)
+    return pa.nulls(len(column), pa.bool_())
+
+
+def rule_mask(rule, batch, now: datetime):
+    """Boolean array of the rows in batch matching rule."""
+
+    pa, pc = _pyarrow()
+    if not rule.conditions:
+        return pa.array([False] * len(batch))
+    combine = pc.and_ if rule.predicate == PredicateType.ALL else pc.or_
+    mask = condition_mask(rule.conditions[0], batch, now)
+    for condition in rule.conditions[1:]:
+        mask = combine(mask, condition_mask(condition, batch, now))
+    return mask
+
+
+def simulate(rules: list, batches, sample_size: int = 5, now: datetime = None) -> SimulationReport:
+    """Count matches of each rule over an iterable of record batches."""
+
+    _, pc = _pyarrow()
+    now = now or datetime.now(timezone.utc)
+    report = SimulationReport(
+        rules=[RuleSimulation(rule.description or f"Rule {i + 1}") for i, rule in enumerate(rules)]
+    )
+    for batch in batches:
+        report.emails_scanned += len(batch)
+        ids = batch.column("id")
+        for rule, result in zip(rules, report.rules):
+            mask = rule_mask(rule, batch, now)
+            result.matches += pc.sum(mask).as_py() or 0
+            if len(result.sample_ids) < sample_size:
+                matched = pc.filter(ids, mask).slice(0, sample_size - len(result.sample_ids))
+                result.sample_ids.extend(matched.to_pylist())
+    return report
+
+
+def stream_email_batches(session, fields: set, batch_size: int = 10000,
+                         account_id: str = None, since: datetime = None):
+    """
+    Yield Arrow record batches of the columns the given fields need, streamed
+    with a server-side cursor. String columns are the stored casefolded copies.
+    """
+
+    pa, _ = _pyarrow()
+    columns = {"id": Email.id}
+    if FieldType.SENDER.value in fields:
+        columns["sender"] = func.coalesce(Email.sender_folded, func.lower(Email.sender))
+    if FieldType.SUBJECT.value in fields:
+        columns["subject"] = func.coalesce(Email.subject_folded, func.lower(Email.subject))
+    if FieldType.RECEIVED_AT.value in fields:
+        columns["received_at"] = Email.received_at
+    for field in (FieldType.LIST_ID.value, FieldType.REPLY_TO.value, FieldType.THREAD_ID.value):
+        if field in fields:
+            columns[field] = getattr(Email, field)
+    for field, column in ARRAY_FIELDS.items():
+        if field in fields:
+            columns[field] = getattr(Email, column)
+    if fields & set(SENDER_PARTS):
+        columns["sender_address"] = Email.sender_address
+        columns["sender_domain"] = Email.sender_domain
+        columns["raw_sender"] = Email.sender
+    with_message = FieldType.MESSAGE.value in fields
+    if with_message:
+        columns["codec"] = EmailBody.codec
+        columns["data"] = EmailBody.data
+        columns["folded_data"] = EmailBody.folded_data
+
+    query = select(*[column.label(name) for name, column in columns.items()])
+    if with_message:
+        query = query.select_from(Email).outerjoin(
+            EmailBody,
+            (EmailBody.account_id == Email.account_id) & (EmailBody.email_id == Email.id),
+        )
+    if account_id is not None:
+        query = query.where(Email.account_id == account_id)
+    if since is not None:
+        query = query.where(Email.received_at >= since)
+
+    result = session.execute(query.execution_options(yield_per=batch_size))
+    for rows in result.partitions():
+        data = {name: [] for name in columns}
+        for row in rows:
+            for name, value in row._mapping.items():
+                data[name].append(value)
+        yield _to_record_batch(pa, data)
+
+
+def _to_record_batch(pa, data: dict):
+    """Build the batch, deriving what older rows didn't store at ingest."""
+
+    if "raw_sender" in data:
+        raw = data.pop("raw_sender")
+        for i, sender in enumerate(raw):
+            if data["sender_address"][i] is None and sender:
+                data["sender_address"][i], data["sender_domain"][i] = parse_sender(sender)
+    if "codec" in data:
+        codecs, blobs, folded = data.pop("codec"), data.pop("data"), data.pop("folded_data")
+        data["message"] = [
+            None if codec is None
+            else EmailBody(codec=codec, data=blob, folded_data=folded_blob).folded_text
+            for codec, blob, folded_blob in zip(codecs, blobs, folded)
+        ]
+    for field in ARRAY_FIELDS:
+        if field in data:
+            data[field] = [
+                None if elements is None
+                else ELEMENT_SEPARATOR
+                + "".join(f"{fold(element)}{ELEMENT_SEPARATOR}" for element in elements)
+                for elements in data[field]
+            ]
+    arrays = {}
+    for name, values in data.items():
+        if name == "received_at":
+            arrays[name] = pa.array(values, type=pa.timestamp("us", tz="UTC"))
+        else:
+            arrays[name] = pa.array(values, type=pa.string())
+    return pa.RecordBatch.from_pydict(arrays)
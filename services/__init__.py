@@ -1,2 +1,3 @@
 from .gmail_client import GmailClient
-from .email_store import EmailStore
\ No newline at end of file
+from .email_store import EmailStore
+from .action_dispatcher import ActionDispatcher
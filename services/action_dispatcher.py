@@ -0,0 +1,244 @@
+from collections import defaultdict
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import and_, or_, text
+
+from actions import LabelDelta
+from database import Email, ActionOutbox
+from database import get_db_session
+from database.models import OUTBOX_PENDING, OUTBOX_IN_FLIGHT, OUTBOX_DONE, OUTBOX_FAILED
+from services import GmailClient
+from services.gmail_client import TRANSPORT_ERRORS
+from config import Config
+from utils import get_logger, PER_EMAIL
+
+logger = get_logger(__name__)
+
+# Gmail batchModify accepts at most this many message ids
+MAX_BATCH_MODIFY_IDS = 1000
+# Minimum time between purges of sent entries by one dispatcher
+PURGE_INTERVAL_SECONDS = 60 * 60
+
+
+@dataclass
+class DispatchStats:
+    """Statistics for outbox dispatching."""
+
+    entries_sent: int = 0
+    entries_retried: int = 0
+    entries_failed: int = 0
+    entries_purged: int = 0
+    api_calls: int = 0
+
+    def __str__(self) -> str:
+        return (
+            f"Sent: {self.entries_sent} outbox entries\n"
+            f"Retried later: {self.entries_retried}\n"
+            f"Failed: {self.entries_failed}\n"
+            f"Purged: {self.entries_purged}\n"
+            f"API calls: {self.api_calls}\n"
+        )
+
+
+@dataclass(frozen=True)
+class OutboxEntry:
+    """Detached copy of a claimed outbox row."""
+
+    id: int
+    email_id: str
+    delta: LabelDelta
+    attempts: int
+
+
+class ActionDispatcher:
+    """
+    Drains the action outbox into Gmail.
+    Entries are claimed with a lease (SKIP LOCKED, so several dispatchers can run),
+    grouped by identical label change and sent with batchModify.
+    Failed entries are retried with backoff until OUTBOX_MAX_ATTEMPTS. Sent
+    entries are deleted once they are OUTBOX_DONE_RETENTION_DAYS old.
+    """
+
+    def __init__(self, gmail_client: GmailClient):
+        self.gmail_client = gmail_client
+        self.stats = DispatchStats()
+        self._last_purge = None
+
+    def dispatch(self) -> DispatchStats:
+        """Send claimable outbox entries until none are left."""
+
+        while self.dispatch_batch():
+            pass
+        logger.info(f"Dispatch complete:\n{self.stats}")
+        return self.stats
+
+    def dispatch_batch(self) -> bool:
+        """Claim and send one batch. Returns False when nothing was claimable."""
+
+        entries = self._claim_batch()
+        if not entries:
+            if self._last_purge is None or time.monotonic() - self._last_purge >= PURGE_INTERVAL_SECONDS:
+                self.purge_done()
+            return False
+        self._send(entries)
+        return True
+
+    def purge_done(self) -> int:
+        """Delete this account's sent entries older than OUTBOX_DONE_RETENTION_DAYS."""
+
+        self._last_purge = time.monotonic()
+        if Config.OUTBOX_DONE_RETENTION_DAYS <= 0:
+            return 0
+        cutoff = datetime.now(timezone.utc) - timedelta(days=Config.OUTBOX_DONE_RETENTION_DAYS)
+        with get_db_session() as session:
+            purged = (
+                session.query(ActionOutbox)
+                .filter(
+                    ActionOutbox.account_id == self.gmail_client.account_id,
+                    ActionOutbox.status == OUTBOX_DONE,
+                    ActionOutbox.updated_at < cutoff,
+                )
+                .delete(synchronize_session=False)
+            )
+        if purged:
+            logger.info(f"Purged {purged} sent outbox entries")
+        self.stats.entries_purged += purged
+        return purged
+
+    def _claim_batch(self) -> list:
+        """Lease a batch of due entries, including ones whose lease expired."""
+
+        now = datetime.now(timezone.utc)
+        with get_db_session() as session:
+            rows = (
+                session.query(ActionOutbox)
+                .filter(
+                    ActionOutbox.account_id == self.gmail_client.account_id,
+                    or_(
+                        and_(
+                            ActionOutbox.status == OUTBOX_PENDING,
+                            ActionOutbox.next_attempt_at <= now,
+                        ),
+                        and_(
+                            ActionOutbox.status == OUTBOX_IN_FLIGHT,
+                            ActionOutbox.lease_expires_at < now,
+                        ),
+                    ),
+                )
+                .order_by(ActionOutbox.id)
+                .limit(Config.OUTBOX_BATCH_SIZE)
+                .with_for_update(skip_locked=True)
+                .all()
+            )
+            lease_expires_at = now + timedelta(seconds=Config.OUTBOX_LEASE_SECONDS)
+            entries = []
+            for row in rows:
+                row.status = OUTBOX_IN_FLIGHT
+                row.lease_expires_at = lease_expires_at
+                row.attempts += 1
+                delta = LabelDelta(frozenset(row.add_labels), frozenset(row.remove_labels))
+                entries.append(OutboxEntry(row.id, row.email_id, delta, row.attempts))
+        return entries
+
+    def _send(self, entries: list) -> None:
+        """Send entries grouped by identical label change."""
+
+        groups = defaultdict(list)
+        for entry in entries:
+            groups[entry.delta].append(entry)
+
+        for delta, group in groups.items():
+            for start in range(0, len(group), MAX_BATCH_MODIFY_IDS):
+                chunk = group[start : start + MAX_BATCH_MODIFY_IDS]
+                self.stats.api_calls += 1
+                try:
+                    sent = self.gmail_client.batch_modify_messages(
+                        [entry.email_id for entry in chunk], delta.add, delta.remove
+                    )
+                except TRANSPORT_ERRORS as e:
+                    # not caused by any one entry, so no per-message fallback
+                    logger.warning(f"batchModify of {len(chunk)} entries failed: {e}")
+                    for entry in chunk:
+                        self._mark_failed(entry, f"transport error: {e}")
+                    continue
+                if sent:
+                    self._mark_done(chunk, delta)
+                else:
+                    self._send_individually(chunk, delta)
+
+    def _send_individually(self, entries: list, delta: LabelDelta) -> None:
+        """Retry a failed batch one message at a time to isolate bad entries."""
+
+        for entry in entries:
+            self.stats.api_calls += 1
+            try:
+                sent = self.gmail_client.modify_message(
+                    entry.email_id, add_labels=list(delta.add), remove_labels=list(delta.remove)
+                )
+            except TRANSPORT_ERRORS as e:
+                self._mark_failed(entry, f"transport error: {e}")
+                continue
+            if sent:
+                self._mark_done([entry], delta)
+            else:
+                self._mark_failed(entry, "modify_message failed")
+
+    def _mark_done(self, entries: list, delta: LabelDelta) -> None:
+        """Mark entries sent and mirror the read state and labels locally."""
+
+        ids = [entry.id for entry in entries]
+        email_ids = [entry.email_id for entry in entries]
+        with get_db_session() as session:
+            session.query(ActionOutbox).filter(ActionOutbox.id.in_(ids)).update(
+                {ActionOutbox.status: OUTBOX_DONE, ActionOutbox.lease_expires_at: None},
+                synchronize_session=False,
+            )
+            read_state = delta.read_state()
+            if read_state is not None:
+                session.query(Email).filter(
+                    Email.account_id == self.gmail_client.account_id,
+                    Email.id.in_(email_ids),
+                ).update(
+                    {Email.is_read: read_state}, synchronize_session=False
+                )
+            # rows fetched before labels were stored keep NULL (unknown)
+            session.execute(
+                text(
+                    "UPDATE emails SET label_ids = ARRAY("
+                    "SELECT DISTINCT label FROM unnest(label_ids || CAST(:add AS varchar[])) AS label "
+                    "WHERE label <> ALL(CAST(:remove AS varchar[]))) "
+                    "WHERE account_id = :account_id AND id = ANY(:email_ids) "
+                    "AND label_ids IS NOT NULL"
+                ),
+                {
+                    "add": sorted(delta.add),
+                    "remove": sorted(delta.remove),
+                    "account_id": self.gmail_client.account_id,
+                    "email_ids": email_ids,
+                },
+            )
+        for email_id in email_ids:
+            logger.info(
+                f"Applied +{sorted(delta.add)} -{sorted(delta.remove)} to email {email_id}",
+                extra=PER_EMAIL,
+            )
+        self.stats.entries_sent += len(entries)
+
+    def _mark_failed(self, entry: OutboxEntry, error: str) -> None:
+        """Schedule a retry with exponential backoff, or give up."""
+
+        with get_db_session() as session:
+            row = session.get(ActionOutbox, entry.id)
+            row.last_error = error
+            row.lease_expires_at = None
+            if entry.attempts >= Config.OUTBOX_MAX_ATTEMPTS:
+                row.status = OUTBOX_FAILED
+                self.stats.entries_failed += 1
+                logger.error(f"Giving up on outbox entry {entry.id} for email {entry.email_id}")
+            else:
+                delay = Config.OUTBOX_RETRY_DELAY_SECONDS * (2 ** (entry.attempts - 1))
+                row.status = OUTBOX_PENDING
+                row.next_attempt_at = datetime.now(timezone.utc) + timedelta(seconds=delay)
+                self.stats.entries_retried += 1
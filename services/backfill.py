@@ -0,0 +1,322 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, fields
+from datetime import datetime, timezone
+
+from googleapiclient.errors import HttpError
+from sqlalchemy import func
+
+from database import Email, BackfillCheckpoint
+from database import get_db_session
+from database.models import BACKFILL_RUNNING, BACKFILL_DONE
+from services import GmailClient, EmailStore
+from rules import RuleProcessor
+from config import Config
+from utils import get_logger
+
+logger = get_logger(__name__)
+
+# Shards aren't split below this span, however many messages they hold
+MIN_SHARD_SECONDS = 24 * 60 * 60
+
+
+@dataclass
+class BackfillStats:
+    """Statistics for one backfill run."""
+
+    pages: int = 0
+    messages_stored: int = 0
+    messages_failed: int = 0
+    resumed_at_page: int = 0
+
+    def __str__(self) -> str:
+        return (
+            f"Resumed at page: {self.resumed_at_page}\n"
+            f"Pages: {self.pages}\n"
+            f"Stored: {self.messages_stored} emails\n"
+            f"Failed: {self.messages_failed}\n"
+        )
+
+    def add(self, other: "BackfillStats") -> None:
+        for stat in fields(self):
+            setattr(self, stat.name, getattr(self, stat.name) + getattr(other, stat.name))
+
+
+class MailboxBackfill:
+    """
+    Fetches a whole mailbox (or everything matching query), resumably.
+    Each listed page is fetched and stored as soon as it arrives, then the next
+    page token is committed to a BackfillCheckpoint row. After a crash or deploy
+    the next run continues from that token; a page interrupted half way is
+    fetched again, which the upsert makes harmless. Messages that failed are
+    kept on the checkpoint and retried when the listing is finished.
+    """
+
+    def __init__(self, gmail_client: GmailClient, processor=None, query: str = ""):
+        self.gmail_client = gmail_client
+        self.store = EmailStore(gmail_client, processor=processor)
+        self.query = query
+        self.stats = BackfillStats()
+
+    def run(self, save_sync_state: bool = True) -> BackfillStats:
+        """Backfill until the listing is finished, then retry failed messages."""
+
+        for _ in self.iter_pages():
+            pass
+        self.retry_failed()
+        if save_sync_state:
+            self.store.save_sync_state(newest_stored(self.gmail_client.account_id))
+        if self.store.processor is not None:
+            self.store.processor.rule_loader.save_condition_stats()
+        logger.info(f"Backfill of {self.query or 'the mailbox'} complete:\n{self.stats}")
+        return self.stats
+
+    def iter_pages(self):
+        """Store one listed page at a time, yielding its (stored, failed) counts."""
+
+        checkpoint_id, page_token, status, pages_done = self._load_checkpoint()
+        if status == BACKFILL_DONE:
+            logger.info(f"Backfill of {self.query or 'the mailbox'} already finished")
+            return
+        self.stats.resumed_at_page = pages_done
+        if page_token:
+            logger.info(f"Resuming backfill at page {pages_done + 1}")
+
+        while True:
+            try:
+                messages, next_token = self.gmail_client.list_message_page(self.query, page_token)
+            except HttpError as e:
+                if e.resp.status != 400 or page_token is None:
+                    raise
+                # tokens don't live forever; stored pages are only upserted again
+                logger.warning("Page token rejected, listing again from the first page")
+                page_token = None
+                continue
+
+            stored, failed_ids = self._store_page(messages)
+            self._save_checkpoint(checkpoint_id, next_token, stored, failed_ids)
+            self.stats.pages += 1
+            self.stats.messages_stored += stored
+            self.stats.messages_failed += len(failed_ids)
+            logger.info(
+                f"Backfill page {pages_done + self.stats.pages}: "
+                f"{stored} stored, {len(failed_ids)} failed"
+            )
+            yield stored, len(failed_ids)
+            if next_token is None:
+                return
+            page_token = next_token
+
+    def retry_failed(self) -> int:
+        """Fetch the checkpoint's failed messages once more. Returns how many remain."""
+
+        with get_db_session() as session:
+            checkpoint = self._checkpoint_query(session).one_or_none()
+            if checkpoint is None or not checkpoint.failed_ids:
+                return 0
+            checkpoint_id, failed_ids = checkpoint.id, list(checkpoint.failed_ids)
+
+        logger.info(f"Retrying {len(failed_ids)} messages that failed during backfill")
+        stored, still_failed = self._store_page([{"id": message_id} for message_id in failed_ids])
+        with get_db_session() as session:
+            checkpoint = session.get(BackfillCheckpoint, checkpoint_id)
+            checkpoint.failed_ids = still_failed
+            checkpoint.messages_done += stored
+        self.stats.messages_stored += stored
+        self.stats.messages_failed -= min(stored, self.stats.messages_failed)
+        if still_failed:
+            logger.warning(f"{len(still_failed)} messages still failing after retry")
+        return len(still_failed)
+
+    def _store_page(self, message_refs: list) -> tuple:
+        """Fetch and store a page in FETCH_BATCH_SIZE batches. Returns (stored, failed ids)."""
+
+        stored = 0
+        failed_ids = []
+        for i in range(0, len(message_refs), Config.FETCH_BATCH_SIZE):
+            batch = message_refs[i : i + Config.FETCH_BATCH_SIZE]
+            # fetched outside the transaction so it isn't held open during API calls
+            emails, batch_failed = self.store.fetch_messages(batch)
+            with get_db_session() as session:
+                self.store.save_messages(session, emails)
+            stored += len(emails)
+            failed_ids.extend(batch_failed)
+        return stored, failed_ids
+
+    def _checkpoint_query(self, session):
+        return session.query(BackfillCheckpoint).filter(
+            BackfillCheckpoint.account_id == self.gmail_client.account_id,
+            BackfillCheckpoint.query == self.query,
+        )
+
+    def _load_checkpoint(self) -> tuple:
+        """(id, page token, status, pages done) of this backfill, created if new."""
+
+        with get_db_session() as session:
+            checkpoint = self._checkpoint_query(session).one_or_none()
+            if checkpoint is None:
+                checkpoint = BackfillCheckpoint(
+                    account_id=self.gmail_client.account_id,
+                    query=self.query,
+                    pages_done=0,
+                    messages_done=0,
+                    failed_ids=[],
+                    status=BACKFILL_RUNNING,
+                )
+                session.add(checkpoint)
+                session.flush()
+            return checkpoint.id, checkpoint.page_token, checkpoint.status, checkpoint.pages_done
+
+    def _save_checkpoint(
+        self, checkpoint_id: int, next_token: str, stored: int, failed_ids: list
+    ) -> None:
+        with get_db_session() as session:
+            checkpoint = session.get(BackfillCheckpoint, checkpoint_id)
+            checkpoint.page_token = next_token
+            checkpoint.pages_done += 1
+            checkpoint.messages_done += stored
+            if failed_ids:
+                checkpoint.failed_ids = list(checkpoint.failed_ids) + failed_ids
+            if next_token is None:
+                checkpoint.status = BACKFILL_DONE
+
+
+def newest_stored(account_id: str):
+    """received_at of the account's newest stored email."""
+
+    with get_db_session() as session:
+        return (
+            session.query(func.max(Email.received_at))
+            .filter(Email.account_id == account_id)
+            .scalar()
+        )
+
+
+def shard_query(start: int = None, end: int = None) -> str:
+    """
+    Gmail query for messages received in [start, end) (epoch seconds); either
+    end may be open. The lower bound reaches one second back so a message on
+    a boundary is listed by both neighbours rather than by neither.
+    """
+
+    terms = []
+    if start is not None:
+        terms.append(f"after:{start - 1}")
+    if end is not None:
+        terms.append(f"before:{end}")
+    return " ".join(terms)
+
+
+class ShardedBackfill:
+    """
+    Backfill split into date-range shards that are listed and fetched in
+    parallel, since one Gmail page cursor can only be followed sequentially.
+    The history from BACKFILL_START_YEAR is halved until Gmail estimates at most
+    BACKFILL_SHARD_MESSAGES per window, then small neighbours are merged back;
+    open-ended shards before and after cover the rest. Each shard is a
+    MailboxBackfill with its own checkpoint, so the plan and every shard's
+    progress survive a restart. Emails listed by two shards are upserted once.
+    """
+
+    def __init__(self, gmail_client: GmailClient, workers: int = None, fused: bool = False):
+        self.gmail_client = gmail_client
+        self.workers = workers or Config.BACKFILL_WORKERS
+        self.fused = fused
+        self.stats = BackfillStats()
+        self.errors = []
+
+    def run(self) -> BackfillStats:
+        """Backfill every shard, BACKFILL_WORKERS at a time."""
+
+        queries = self._load_plan()
+        if queries:
+            logger.info(f"Resuming sharded backfill of {len(queries)} shards")
+        else:
+            queries = self.plan()
+            self._save_plan(queries)
+            logger.info(f"Planned backfill in {len(queries)} shards")
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self._run_shard, query): query for query in queries}
+            for future in as_completed(futures):
+                try:
+                    self.stats.add(future.result())
+                except Exception as e:
+                    logger.error(f"Backfill shard '{futures[future]}' failed: {e}")
+                    self.errors.append(f"{futures[future]}: {e}")
+        # once, so shards don't race to create the account's sync state
+        EmailStore(self.gmail_client).save_sync_state(newest_stored(self.gmail_client.account_id))
+        logger.info(f"Sharded backfill complete:\n{self.stats}")
+        return self.stats
+
+    def plan(self, now: datetime = None) -> list:
+        """Shard queries covering all time, sized by Gmail's count estimates."""
+
+        start = int(datetime(Config.BACKFILL_START_YEAR, 1, 1, tzinfo=timezone.utc).timestamp())
+        end = int((now or datetime.now(timezone.utc)).timestamp())
+        windows = self._merge(self._split(start, end))
+        return (
+            [shard_query(end=start)]
+            + [shard_query(window_start, window_end) for window_start, window_end, _ in windows]
+            + [shard_query(start=end)]
+        )
+
+    def _split(self, start: int, end: int) -> list:
+        """(start, end, estimate) windows of at most BACKFILL_SHARD_MESSAGES each."""
+
+        estimate = self.gmail_client.estimate_message_count(shard_query(start, end))
+        if estimate <= Config.BACKFILL_SHARD_MESSAGES or end - start <= MIN_SHARD_SECONDS:
+            return [(start, end, estimate)]
+        middle = (start + end) // 2
+        return self._split(start, middle) + self._split(middle, end)
+
+    @staticmethod
+    def _merge(windows: list) -> list:
+        """Join neighbouring windows while they stay within BACKFILL_SHARD_MESSAGES."""
+
+        merged = []
+        for start, end, estimate in windows:
+            if merged and merged[-1][2] + estimate <= Config.BACKFILL_SHARD_MESSAGES:
+                previous_start, _, previous_estimate = merged.pop()
+                merged.append((previous_start, end, previous_estimate + estimate))
+            else:
+                merged.append((start, end, estimate))
+        return merged
+
+    def _load_plan(self) -> list:
+        """Shard queries of an earlier sharded backfill of this account."""
+
+        with get_db_session() as session:
+            rows = (
+                session.query(BackfillCheckpoint.query)
+                .filter(
+                    BackfillCheckpoint.account_id == self.gmail_client.account_id,
+                    BackfillCheckpoint.query != "",
+                )
+                .order_by(BackfillCheckpoint.id)
+                .all()
+            )
+        return [row.query for row in rows]
+
+    def _save_plan(self, queries: list) -> None:
+        with get_db_session() as session:
+            session.add_all(
+                BackfillCheckpoint(
+                    account_id=self.gmail_client.account_id,
+                    query=query,
+                    pages_done=0,
+                    messages_done=0,
+                    failed_ids=[],
+                    status=BACKFILL_RUNNING,
+                )
+                for query in queries
+            )
+
+    def _run_shard(self, query: str) -> BackfillStats:
+        # an HTTP client can't be shared between threads: one GmailClient per
+        # shard, all drawing on the account's one quota limiter
+        gmail_client = GmailClient(
+            self.gmail_client.credentials, account_id=self.gmail_client.account_id
+        )
+        processor = RuleProcessor(gmail_client) if self.fused else None
+        backfill = MailboxBackfill(gmail_client, processor=processor, query=query)
+        return backfill.run(save_sync_state=False)
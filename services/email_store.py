@@ -1,76 +1,231 @@
+import asyncio
 from datetime import datetime, timezone
 
+from sqlalchemy import case, or_
 from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm import Session
 
 from services import GmailClient
-from database import Email
-from database import get_db_session
+from services.message_cache import get_message_cache
+from database import Email, EmailBody, AccountSyncState
+from database import get_db_session, get_async_db_session
+from database.models import EMAIL_KEY_COLUMNS
+from database.partitions import ensure_partitions_for
 from config import Config
-from utils import get_logger
+from utils import get_logger, fold, parse_sender, parse_addresses, parse_list_id
 
 logger = get_logger(__name__)
 
 
 class EmailStore:
-    """Service for fetching and storing emails."""
+    """
+    Service for fetching and storing emails.
+    Given a RuleProcessor (fused mode), each email is evaluated as it is fetched:
+    its actions are queued and it is stored already processed, in the same
+    batch transaction, so it never has to be read back for rule processing.
+    """
 
-    def __init__(self, gmail_client: GmailClient):
+    def __init__(self, gmail_client: GmailClient, processor=None):
         self.gmail_client = gmail_client
+        self.processor = processor
+        self.cache = get_message_cache(gmail_client.account_id) if Config.RAW_MESSAGE_CACHE else None
 
     def fetch_and_store(self):
         """Fetch emails from Gmail and store in database."""
 
         success_count = 0
         failure_count = 0
-        # Get the message IDs
-        message_refs = self.gmail_client.list_messages()
+        for batch_success, batch_fail in self.iter_fetch_batches():
+            success_count += batch_success
+            failure_count += batch_fail
+        if self.processor is not None:
+            self.processor.rule_loader.save_condition_stats()
+
+        logger.info(f"Fetch complete: {success_count} stored, {failure_count} failed")
+        return success_count, failure_count
+
+    def iter_fetch_batches(self):
+        """
+        Fetch and store new messages one batch at a time, yielding (stored, failed)
+        after each batch so a scheduler can interleave accounts between batches.
+        """
+
+        # Get the message IDs, plus those that failed in earlier syncs
+        failed_before = self._load_failed_ids()
+        message_refs = self._with_retries(self.gmail_client.list_messages(), failed_before)
         if not message_refs:
             logger.info("No messages found")
-            return success_count, failure_count
+            return
 
         logger.info(f"Found {len(message_refs)} messages to process")
+        newest = None
+        failed_ids = []
+        # TODO: We can optimize this by fetching messages in parallel
+        # but keeping it simple for now
+        for i in range(0, len(message_refs), Config.FETCH_BATCH_SIZE):
+            batch = message_refs[i : i + Config.FETCH_BATCH_SIZE]
+            with get_db_session() as session:
+                batch_success, batch_failed, batch_newest = self._process_batch(session, batch)
+            failed_ids.extend(batch_failed)
+            if batch_newest and (newest is None or batch_newest > newest):
+                newest = batch_newest
+            logger.info(
+                f"Batch {i//Config.FETCH_BATCH_SIZE + 1}: "
+                f"{batch_success} stored, {len(batch_failed)} failed"
+            )
+            yield batch_success, len(batch_failed)
+
+        # Failed messages would fall before the next `after:` query, so they
+        # are kept on the sync state and retried by the next sync
+        self.save_sync_state(newest, self._next_failed_ids(failed_before, failed_ids))
+
+    async def afetch_and_store(self):
+        """
+        fetch_and_store on the async engine. The Gmail client is blocking, so each
+        batch is fetched in a worker thread while the previous batch is written,
+        overlapping network I/O with database writes on one event loop.
+        """
+
+        failed_before = await asyncio.to_thread(self._load_failed_ids)
+        listed = await asyncio.to_thread(self.gmail_client.list_messages)
+        message_refs = self._with_retries(listed, failed_before)
+        if not message_refs:
+            logger.info("No messages found")
+            return 0, 0
+
+        logger.info(f"Found {len(message_refs)} messages to process")
+        failed_ids = []
+        results = []
+        pending_write = None
+        for i in range(0, len(message_refs), Config.FETCH_BATCH_SIZE):
+            batch = message_refs[i : i + Config.FETCH_BATCH_SIZE]
+            emails, batch_failed = await asyncio.to_thread(self.fetch_messages, batch)
+            failed_ids.extend(batch_failed)
+            if pending_write is not None:
+                results.append(await pending_write)
+            pending_write = asyncio.create_task(self._astore_batch(emails))
+        if pending_write is not None:
+            results.append(await pending_write)
+        success_count = sum(stored for stored, _, _ in results)
+        for _, batch_failed, _ in results:
+            failed_ids.extend(batch_failed)
+        newest = max((newest for _, _, newest in results if newest), default=None)
+
+        await asyncio.to_thread(
+            self.save_sync_state, newest, self._next_failed_ids(failed_before, failed_ids)
+        )
+        if self.processor is not None:
+            self.processor.rule_loader.save_condition_stats()
+        logger.info(f"Fetch complete: {success_count} stored, {len(failed_ids)} failed")
+        return success_count, len(failed_ids)
+
+    async def _astore_batch(self, emails: list) -> tuple:
+        """Write one fetched batch. Returns (stored, failed ids, newest received_at)."""
+
+        try:
+            async with get_async_db_session() as session:
+                if self.processor is not None:
+                    await session.run_sync(lambda sync_session: self._evaluate_fetched(sync_session, emails))
+                await self.astore_emails(session, emails)
+        except Exception as e:
+            logger.error(f"Batch commit failed: {e}")
+            return 0, [email.id for email in emails], None
+        return len(emails), [], max((email.received_at for email in emails), default=None)
+
+    def save_sync_state(self, newest, failed_ids: dict = None) -> None:
+        """
+        Record the account's newest stored email for the next incremental sync
+        and, if given, the messages to retry then (id -> failed attempts).
+        """
+
         with get_db_session() as session:
-            # TODO: We can optimize this by fetching messages in parallel
-            # but keeping it simple for now
-            for i in range(0, len(message_refs), Config.FETCH_BATCH_SIZE):
-                batch = message_refs[i : i + Config.FETCH_BATCH_SIZE]
-                batch_success, batch_fail = self._process_batch(session, batch)
-                success_count += batch_success
-                failure_count += batch_fail
-                logger.info(
-                    f"Batch {i//Config.FETCH_BATCH_SIZE + 1}: "
-                    f"{batch_success} stored, {batch_fail} failed"
-                )
+            state = session.get(AccountSyncState, self.gmail_client.account_id)
+            if state is None:
+                state = AccountSyncState(account_id=self.gmail_client.account_id)
+                session.add(state)
+            if newest and (state.last_received_at is None or newest > state.last_received_at):
+                state.last_received_at = newest
+            if failed_ids is not None:
+                state.failed_ids = failed_ids
+            state.last_synced_at = datetime.now(timezone.utc)
 
-        logger.info(f"Fetch complete: {success_count} stored, {failure_count} failed")
-        return success_count, failure_count
+    def _load_failed_ids(self) -> dict:
+        """Messages that failed in earlier syncs, with their failed attempts."""
 
-    def _process_batch(self, session, message_refs):
-        """Process batch of messages."""
+        with get_db_session() as session:
+            state = session.get(AccountSyncState, self.gmail_client.account_id)
+            return dict(state.failed_ids or {}) if state is not None else {}
 
-        success_count = 0
-        failure_count = 0
+    @staticmethod
+    def _with_retries(message_refs: list, failed_before: dict) -> list:
+        """Listed messages followed by earlier failures that weren't listed again."""
+
+        listed = {ref["id"] for ref in message_refs}
+        return message_refs + [
+            {"id": message_id} for message_id in failed_before if message_id not in listed
+        ]
+
+    @staticmethod
+    def _next_failed_ids(failed_before: dict, failed_ids: list) -> dict:
+        """Attempts of this sync's failures; ones at SYNC_RETRY_ATTEMPTS are dropped."""
+
+        attempts = {}
+        for message_id in failed_ids:
+            attempt = failed_before.get(message_id, 0) + 1
+            if attempt >= Config.SYNC_RETRY_ATTEMPTS:
+                logger.warning(f"Giving up on message {message_id} after {attempt} failed syncs")
+                continue
+            attempts[message_id] = attempt
+        return attempts
+
+    def fetch_messages(self, message_refs) -> tuple:
+        """Fetch and transform messages. Returns (emails, ids that failed)."""
+
+        failed_ids = []
+        emails = []
         for msg_ref in message_refs:
             try:
                 email = self._fetch_and_transform(msg_ref["id"])
                 if email:
-                    self._store_email(session, email)
-                    success_count += 1
+                    emails.append(email)
                 else:
-                    failure_count += 1
+                    failed_ids.append(msg_ref["id"])
             except Exception as e:
                 logger.error(f"Failed to process message {msg_ref['id']}: {e}")
-                failure_count += 1
+                failed_ids.append(msg_ref["id"])
+        return emails, failed_ids
+
+    def save_messages(self, session, emails: list) -> None:
+        """Evaluate (fused mode) and upsert fetched emails; the caller commits."""
+
+        self._evaluate_fetched(session, emails)
+        self._store_emails(session, emails)
+
+    def _evaluate_fetched(self, session, emails: list) -> None:
+        """Fused mode: evaluate rules on the emails before they are stored."""
+
+        if self.processor is not None:
+            for email in emails:
+                self.processor.process_fetched_email(session, email)
+
+    def _process_batch(self, session, message_refs):
+        """Process batch of messages. Returns (stored, failed ids, newest received_at)."""
+
+        emails, failed_ids = self.fetch_messages(message_refs)
+        self._evaluate_fetched(session, emails)
+        success_count = len(emails)
+        newest = max((email.received_at for email in emails), default=None)
         try:
+            self._store_emails(session, emails)
             session.commit()
         except Exception as e:
             logger.error(f"Batch commit failed: {e}")
             session.rollback()
-            failure_count = len(message_refs)
+            failed_ids = [msg_ref["id"] for msg_ref in message_refs]
             success_count = 0
+            newest = None
 
-        return success_count, failure_count
+        return success_count, failed_ids, newest
 
     def _fetch_and_transform(self, message_id):
         """Fetch message from Gmail and transform to Email model."""
@@ -78,57 +233,192 @@ class EmailStore:
         message = self.gmail_client.get_message(message_id)
         if not message:
             return None
+        if self.cache is not None:
+            try:
+                self.cache.put(message)
+            except OSError as e:
+                logger.warning(f"Could not cache message {message_id}: {e}")
+        return self.transform_message(message, self.gmail_client.account_id)
+
+    @staticmethod
+    def transform_message(message: dict, account_id: str):
+        """Build the Email model from a raw Gmail message, or None if it can't be parsed."""
+
+        message_id = message.get("id")
         try:
-            headers = self.gmail_client.extract_headers(message)
-            body = self.gmail_client.extract_body(message)
-            received_at = self.gmail_client.convert_to_internal_date(
-                message.get("internalDate", "0")
-            )
+            headers = GmailClient.extract_headers(message)
+            body = GmailClient.extract_body(message)
+            received_at = GmailClient.convert_to_internal_date(message.get("internalDate", "0"))
             label_ids = message.get("labelIds", [])
             is_read = "UNREAD" not in label_ids
+            sender_address, sender_domain = parse_sender(headers["from"])
+            reply_to, _ = parse_sender(headers["reply-to"])
 
             # Create Email model
             email = Email(
+                account_id=account_id,
                 id=message_id,
                 sender=headers["from"],
                 subject=headers["subject"],
-                message=body,
+                sender_folded=fold(headers["from"]),
+                subject_folded=fold(headers["subject"]),
+                sender_address=sender_address,
+                sender_domain=sender_domain,
+                list_id=parse_list_id(headers["list-id"]),
+                reply_to=reply_to or None,
+                to_addresses=parse_addresses(headers["to"]),
+                cc_addresses=parse_addresses(headers["cc"]),
+                thread_id=message.get("threadId"),
+                label_ids=label_ids,
+                message=body.text,
                 received_at=received_at,
                 is_read=is_read,
                 processed=False,
             )
+            if body.truncated:
+                email.body.truncated = True
             return email
 
         except Exception as e:
             logger.error(f"Failed to transform message {message_id}: {e}")
             return None
 
+    @classmethod
+    def reparse(cls, account_id: str) -> tuple:
+        """
+        Rebuild the account's stored emails from the raw message cache, with no
+        API calls. Only parsed columns are rewritten: labels and read state may
+        have changed since the payload was cached. Returns (stored, failed).
+        """
+
+        success_count = 0
+        failure_count = 0
+        emails = []
+        for message in get_message_cache(account_id).iter_messages():
+            email = cls.transform_message(message, account_id)
+            if email is None:
+                failure_count += 1
+                continue
+            emails.append(email)
+            if len(emails) >= Config.REPARSE_BATCH_SIZE:
+                with get_db_session() as session:
+                    cls._store_emails(session, emails, columns=cls.PARSED_COLUMNS)
+                success_count += len(emails)
+                emails = []
+        if emails:
+            with get_db_session() as session:
+                cls._store_emails(session, emails, columns=cls.PARSED_COLUMNS)
+            success_count += len(emails)
+        logger.info(f"Reparse complete: {success_count} stored, {failure_count} failed")
+        return success_count, failure_count
+
+    # Columns refreshed when a stored email is fetched again
+    UPSERT_COLUMNS = (
+        "sender",
+        "subject",
+        "sender_folded",
+        "subject_folded",
+        "sender_address",
+        "sender_domain",
+        "list_id",
+        "reply_to",
+        "to_addresses",
+        "cc_addresses",
+        "thread_id",
+        "label_ids",
+        "received_at",
+        "is_read",
+    )
+    # Columns derived only from the message itself, rewritten by reparse
+    PARSED_COLUMNS = tuple(
+        column for column in UPSERT_COLUMNS if column not in ("label_ids", "is_read")
+    )
+    BODY_COLUMNS = ("codec", "data", "folded_data", "size", "truncated")
+
+    @classmethod
+    def _store_emails(cls, session: Session, emails: list, columns: tuple = None) -> None:
+        """
+        Upsert a batch of emails and their bodies, one executemany per table.
+        With psycopg 3 the rows are pipelined and the statement is prepared once.
+        """
+
+        emails = cls._unique(emails)
+        if not emails:
+            return
+        if Config.EMAIL_PARTITIONING:
+            ensure_partitions_for(session, [email.received_at for email in emails])
+        for stmt, rows in cls._upsert_statements(emails, columns):
+            session.execute(stmt, rows)
+
+    @classmethod
+    async def astore_emails(cls, session, emails: list) -> None:
+        """_store_emails for an AsyncSession."""
+
+        emails = cls._unique(emails)
+        if not emails:
+            return
+        if Config.EMAIL_PARTITIONING:
+            dates = [email.received_at for email in emails]
+            await session.run_sync(lambda sync_session: ensure_partitions_for(sync_session, dates))
+        for stmt, rows in cls._upsert_statements(emails):
+            await session.execute(stmt, rows)
+
     @staticmethod
-    def _store_email(session: Session, email: Email) -> None:
-        """Store email in database with update or create logic."""
-
-        # TODO: Implement bulk update or create in single query
-        stmt = (
-            insert(Email)
-            .values(
-                id=email.id,
-                sender=email.sender,
-                subject=email.subject,
-                message=email.message,
-                received_at=email.received_at,
-                is_read=email.is_read,
-                processed=email.processed,
-            )
-            .on_conflict_do_update(
-                index_elements=["id"],
-                set_={
-                    "sender": email.sender,
-                    "subject": email.subject,
-                    "message": email.message,
-                    "received_at": email.received_at,
-                    "is_read": email.is_read,
-                    "updated_at": datetime.now(timezone.utc),
-                },
-            )
+    def _unique(emails: list) -> list:
+        """
+        Last copy of each email; a multi-row upsert can't touch the same row twice.
+        Sorted by key so concurrent upserts lock shared rows in the same order.
+        """
+
+        unique = {(email.account_id, email.id): email for email in emails}
+        return [unique[key] for key in sorted(unique)]
+
+    @classmethod
+    def _upsert_statements(cls, emails: list, columns: tuple = None) -> list:
+        """
+        (statement, rows) pairs upserting emails and then their bodies. columns
+        (default UPSERT_COLUMNS) are the ones refreshed on a stored email.
+        """
+
+        rows = [
+            {
+                "account_id": email.account_id,
+                "id": email.id,
+                **{column: getattr(email, column) for column in cls.UPSERT_COLUMNS},
+                "processed": bool(email.processed),
+                "ruleset_version_id": email.ruleset_version_id,
+            }
+            for email in emails
+        ]
+        stmt = insert(Email)
+        excluded = stmt.excluded
+        update = {column: excluded[column] for column in columns or cls.UPSERT_COLUMNS}
+        update["updated_at"] = datetime.now(timezone.utc)
+        # Emails evaluated in fused mode arrive processed; never un-process a stored one
+        update["processed"] = or_(Email.processed, excluded.processed)
+        update["ruleset_version_id"] = case(
+            (excluded.processed, excluded.ruleset_version_id), else_=Email.ruleset_version_id
         )
-        session.execute(stmt)
+        statements = [
+            (stmt.on_conflict_do_update(index_elements=list(EMAIL_KEY_COLUMNS), set_=update), rows)
+        ]
+
+        body_rows = [
+            {
+                "account_id": email.account_id,
+                "email_id": email.id,
+                **{column: getattr(email.body, column) for column in cls.BODY_COLUMNS},
+            }
+            for email in emails
+            if email.body is not None
+        ]
+        if body_rows:
+            body_stmt = insert(EmailBody)
+            statements.append((
+                body_stmt.on_conflict_do_update(
+                    index_elements=["account_id", "email_id"],
+                    set_={column: body_stmt.excluded[column] for column in cls.BODY_COLUMNS},
+                ),
+                body_rows,
+            ))
+        return statements
@@ -1,37 +1,71 @@
 import base64
+import codecs
+import re
 import time
-from typing import Dict, Any
+from dataclasses import dataclass
+from html import unescape
+from typing import Dict, Any, TYPE_CHECKING
 from datetime import datetime, timezone
 
-from googleapiclient.discovery import build
+import httplib2
 from googleapiclient.errors import HttpError
-from google.oauth2.credentials import Credentials
 
 from config import Config
 from database.manager import get_db_session
-from database.models import Email
+from database.models import Email, AccountSyncState
+from services.quota import get_quota_limiter, QUOTA_UNITS, DEFAULT_QUOTA_UNITS
 from utils.logger import get_logger
 
+if TYPE_CHECKING:
+    from google.oauth2.credentials import Credentials
+
 logger = get_logger(__name__)
 
-def get_recent_email_date():
-    """Return date of the recent email in the database."""
+# Base64 characters decoded per step; a multiple of 4 so chunks decode independently.
+DECODE_CHUNK_CHARS = 64 * 1024
+
+# Failures below HTTP (timeouts, dropped connections, DNS) raised by request.execute()
+TRANSPORT_ERRORS = (OSError, httplib2.HttpLib2Error)
+
+
+@dataclass
+class MessageBody:
+    """Extracted body text and whether it was cut at the size cap."""
+
+    text: str = ""
+    truncated: bool = False
+
+
+def get_recent_email_date(account_id: str = Config.DEFAULT_ACCOUNT):
+    """Return date of the recent email stored for the account."""
 
     with get_db_session() as session:
-        recent_email = session.query(Email.received_at).order_by(Email.received_at.desc()).first()
+        state = session.get(AccountSyncState, account_id)
+        if state and state.last_received_at:
+            return state.last_received_at
+        recent_email = (
+            session.query(Email.received_at)
+            .filter(Email.account_id == account_id)
+            .order_by(Email.received_at.desc())
+            .first()
+        )
         if recent_email:
             return recent_email[0]
 
 class GmailClient:
-    """This class is for fetching and modifying emails."""
+    """This class is for fetching and modifying emails of one account."""
 
-    def __init__(self, credentials: Credentials):
+    def __init__(self, credentials: "Credentials", account_id: str = Config.DEFAULT_ACCOUNT):
         self.credentials = credentials
+        self.account_id = account_id
+        self.quota = get_quota_limiter(account_id)
         self.service = self._build_service()
         self._label_cache = None
 
     def _build_service(self):
 
+        from googleapiclient.discovery import build  # slow import, only needed here
+
         try:
             service = build(
                 "gmail",
@@ -51,7 +85,7 @@ class GmailClient:
         messages = []
         extra_args = {}
         try:
-            if recent_date := get_recent_email_date():
+            if recent_date := get_recent_email_date(self.account_id):
                 timestamp = int(recent_date.timestamp())
                 extra_args = {"q":f"after:{timestamp}"}
             request = (
@@ -74,6 +108,33 @@ class GmailClient:
             logger.error(f"Failed to list messages: {e}")
             return []
 
+    def list_message_page(self, query: str = None, page_token: str = None) -> tuple:
+        """
+        One page of the message listing: (messages, next page token or None).
+        HttpError is raised, e.g. for an expired page token.
+        """
+
+        extra_args = {}
+        if query:
+            extra_args["q"] = query
+        if page_token:
+            extra_args["pageToken"] = page_token
+        response = self._execute_with_retry(
+            self.service.users()
+            .messages()
+            .list(userId="me", maxResults=min(Config.MAX_RESULTS_PER_QUERY, 500), **extra_args)
+        )
+        return response.get("messages", []), response.get("nextPageToken")
+
+    def estimate_message_count(self, query: str = None) -> int:
+        """Gmail's (rough) estimate of how many messages match query."""
+
+        extra_args = {"q": query} if query else {}
+        response = self._execute_with_retry(
+            self.service.users().messages().list(userId="me", maxResults=1, **extra_args)
+        )
+        return response.get("resultSizeEstimate", 0)
+
     def get_message(self, message_id: str):
         """Get the full message."""
 
@@ -113,6 +174,24 @@ class GmailClient:
             logger.error(f"Failed to modify message {message_id}: {e}")
             return False
 
+    def batch_modify_messages(self, message_ids, add_labels=None, remove_labels=None) -> bool:
+        """Apply the same label change to up to 1000 messages in one call."""
+
+        try:
+            body = {"ids": list(message_ids)}
+            if add_labels:
+                body["addLabelIds"] = list(add_labels)
+            if remove_labels:
+                body["removeLabelIds"] = list(remove_labels)
+            self._execute_with_retry(
+                self.service.users().messages().batchModify(userId="me", body=body)
+            )
+            logger.debug(f"Modified {len(body['ids'])} messages")
+            return True
+        except HttpError as e:
+            logger.error(f"Failed to batch modify {len(message_ids)} messages: {e}")
+            return False
+
     def get_labels(self):
         if self._label_cache is not None:
             return self._label_cache
@@ -144,9 +223,11 @@ class GmailClient:
                 'messageListVisibility': 'show'
             }
             logger.info(f"Attempting to create label: '{destination}'")
-            self._execute_with_retry(
+            label = self._execute_with_retry(
                 self.service.users().labels().create(userId='me', body=new_label)
             )
+            if self._label_cache is not None and label:
+                self._label_cache[destination.upper()] = label["id"]
 
     @staticmethod
     def extract_headers(message):
@@ -157,37 +238,107 @@ class GmailClient:
         return {
             "from": header_dict.get("from", ""),
             "to": header_dict.get("to", ""),
+            "cc": header_dict.get("cc", ""),
+            "reply-to": header_dict.get("reply-to", ""),
+            "list-id": header_dict.get("list-id", ""),
             "subject": header_dict.get("subject", ""),
             "date": header_dict.get("date", ""),
         }
 
     @staticmethod
-    def extract_body(message: Dict[str, Any]) -> str:
-        """Extract body from message."""
+    def extract_body(message: Dict[str, Any], max_bytes: int = None) -> MessageBody:
+        """
+        Extract the text body from a message, walking nested multiparts.
+        Prefers text/plain over text/html, skips attachments without decoding
+        them and stops decoding once max_bytes (default Config.MAX_BODY_BYTES) is reached.
+        """
+
+        if max_bytes is None:
+            max_bytes = Config.MAX_BODY_BYTES
+        plain_parts, html_parts = [], []
+        GmailClient._collect_text_parts(message.get("payload", {}), plain_parts, html_parts)
+        parts = plain_parts or html_parts
+
+        texts = []
+        remaining = max_bytes
+        truncated = False
+        for part in parts:
+            if max_bytes and remaining <= 0:
+                truncated = True
+                break
+            text, truncated = GmailClient._decode_body(part["body"]["data"], remaining)
+            texts.append(text)
+            if truncated:
+                break
+            if max_bytes:
+                remaining -= len(text.encode("utf-8"))
+        body = "\n".join(texts)
+        if not plain_parts and html_parts:
+            body = GmailClient._html_to_text(body)
+        return MessageBody(text=body, truncated=truncated)
 
-        payload = message.get("payload", {})
+    @staticmethod
+    def _collect_text_parts(part: Dict[str, Any], plain_parts: list, html_parts: list) -> None:
+        """Depth-first walk collecting inline text parts that carry data."""
+
+        if GmailClient._is_attachment(part):
+            return
+        mime_type = part.get("mimeType", "")
+        if part.get("parts"):
+            for sub_part in part["parts"]:
+                GmailClient._collect_text_parts(sub_part, plain_parts, html_parts)
+        elif part.get("body", {}).get("data"):
+            if mime_type == "text/html":
+                html_parts.append(part)
+            elif mime_type == "text/plain" or not mime_type:
+                plain_parts.append(part)
 
-        # Try direct body data
-        if "data" in payload.get("body", {}):
-            return GmailClient._decode_body(payload["body"]["data"])
+    @staticmethod
+    def _is_attachment(part: Dict[str, Any]) -> bool:
+        """Attachments and inline images: named parts, external data or non-text leaves."""
 
-        # Try parts (multipart message)
-        for part in payload.get("parts", []):
-            if part.get("mimeType") == "text/plain":
-                body_data = part.get("body", {}).get("data")
-                if body_data:
-                    return GmailClient._decode_body(body_data)
-        return ""
+        if part.get("filename") or part.get("body", {}).get("attachmentId"):
+            return True
+        mime_type = part.get("mimeType", "")
+        if mime_type and not mime_type.startswith(("text/", "multipart/", "message/")):
+            return True
+        for header in part.get("headers", []):
+            if header.get("name", "").lower() == "content-disposition":
+                return header.get("value", "").lower().startswith("attachment")
+        return False
 
     @staticmethod
-    def _decode_body(data: str) -> str:
-        """Decode base64 URL-safe body data."""
-
+    def _decode_body(data: str, max_bytes: int = 0) -> tuple[str, bool]:
+        """
+        Decode base64 URL-safe body data in chunks.
+        Returns the text and whether it was cut at max_bytes (0 = no limit).
+        """
+
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        texts = []
+        size = 0
         try:
-            return base64.urlsafe_b64decode(data).decode("utf-8", errors="ignore")
+            data = data + "=" * (-len(data) % 4)
+            for start in range(0, len(data), DECODE_CHUNK_CHARS):
+                raw = base64.urlsafe_b64decode(data[start : start + DECODE_CHUNK_CHARS])
+                if max_bytes and size + len(raw) > max_bytes:
+                    texts.append(decoder.decode(raw[: max_bytes - size], final=True))
+                    return "".join(texts), True
+                size += len(raw)
+                texts.append(decoder.decode(raw))
+            texts.append(decoder.decode(b"", final=True))
+            return "".join(texts), False
         except Exception as e:
             logger.warning(f"Failed to decode body: {e}")
-            return ""
+            return "", False
+
+    @staticmethod
+    def _html_to_text(html_body: str) -> str:
+        """Crude HTML to text for messages without a text/plain part."""
+
+        text = re.sub(r"(?is)<(script|style).*?</\1>", " ", html_body)
+        text = re.sub(r"<[^>]+>", " ", text)
+        return re.sub(r"\s+", " ", unescape(text)).strip()
 
     @staticmethod
     def convert_to_internal_date(internal_date_ms: str) -> datetime:
@@ -204,7 +355,9 @@ class GmailClient:
 
         max_retries = 3
         base_delay = 1
+        method = getattr(request, "methodId", "").removeprefix("gmail.users.")
         for attempt in range(max_retries):
+            self.quota.acquire(QUOTA_UNITS.get(method, DEFAULT_QUOTA_UNITS))
             try:
                 return request.execute()
             except HttpError as e:
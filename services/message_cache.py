@@ -0,0 +1,184 @@
+import hashlib
+import json
+import os
+import struct
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+from database.compression import compress, decompress
+from config import Config
+from utils import get_logger
+
+logger = get_logger(__name__)
+
+# Record: magic, header length, payload length, JSON header, compressed payload
+RECORD_MAGIC = b"GRC1"
+RECORD_PREFIX = struct.Struct(">4sII")
+SEGMENT_SUFFIX = ".seg"
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+@dataclass(frozen=True)
+class CacheEntry:
+    """Where the latest cached payload of a message is."""
+
+    history_id: int
+    sha256: str
+    codec: str
+    segment: str
+    offset: int
+    length: int
+
+
+class MessageCache:
+    """
+    Raw Gmail message payloads of one account, kept on disk so stored emails
+    can be rebuilt (--reparse) after a parsing change without calling the API.
+    Payloads are compressed and appended to segment files. Each instance writes
+    its own segments, so several processes can share a directory. A message is
+    keyed by its id and historyId: an older or identical (same sha256) payload
+    is not written again, and reads return the newest one. The index is
+    rebuilt from the record headers when the cache is opened.
+    """
+
+    def __init__(self, directory: Path, segment_bytes: int = None):
+        self.directory = Path(directory)
+        self.segment_bytes = segment_bytes or Config.RAW_CACHE_SEGMENT_BYTES
+        self._lock = threading.Lock()
+        self._index = None
+        self._segment = None
+        self._segment_seq = 0
+
+    @property
+    def index(self) -> dict:
+        """message id -> CacheEntry, loaded on first use."""
+
+        with self._lock:
+            if self._index is None:
+                self._index = self._load_index()
+            return self._index
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def put(self, message: dict) -> bool:
+        """Append a payload unless a newer or identical one is cached. Returns True if written."""
+
+        data = json.dumps(message, separators=(",", ":"), sort_keys=True).encode("utf-8")
+        sha256 = hashlib.sha256(data).hexdigest()
+        history_id = int(message.get("historyId") or 0)
+        index = self.index
+        with self._lock:
+            cached = index.get(message["id"])
+            if cached and (cached.sha256 == sha256 or cached.history_id > history_id):
+                return False
+            codec, payload = compress(data)
+            header = json.dumps(
+                {"id": message["id"], "history_id": history_id, "codec": codec, "sha256": sha256}
+            ).encode("utf-8")
+            segment = self._writable_segment()
+            with open(segment, "ab") as f:
+                offset = f.tell()
+                f.write(RECORD_PREFIX.pack(RECORD_MAGIC, len(header), len(payload)) + header + payload)
+            index[message["id"]] = CacheEntry(
+                history_id,
+                sha256,
+                codec,
+                segment.name,
+                offset + RECORD_PREFIX.size + len(header),
+                len(payload),
+            )
+            return True
+
+    def get(self, message_id: str):
+        """Newest cached payload of a message, or None."""
+
+        entry = self.index.get(message_id)
+        if entry is None:
+            return None
+        with open(self.directory / entry.segment, "rb") as f:
+            f.seek(entry.offset)
+            return self._decode(f, entry)
+
+    def iter_messages(self):
+        """Newest payload of every cached message, read segment by segment in file order."""
+
+        entries = sorted(self.index.values(), key=lambda entry: (entry.segment, entry.offset))
+        segment, f = None, None
+        try:
+            for entry in entries:
+                if entry.segment != segment:
+                    if f is not None:
+                        f.close()
+                    segment, f = entry.segment, open(self.directory / entry.segment, "rb")
+                f.seek(entry.offset)
+                yield self._decode(f, entry)
+        finally:
+            if f is not None:
+                f.close()
+
+    @staticmethod
+    def _decode(f, entry: CacheEntry) -> dict:
+        return json.loads(decompress(entry.codec, f.read(entry.length)))
+
+    def _writable_segment(self) -> Path:
+        """This instance's current segment, starting a new one when it is full."""
+
+        if self._segment is None or self._segment.stat().st_size >= self.segment_bytes:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            self._segment_seq += 1
+            name = f"{time.time_ns():020d}-{os.getpid()}-{self._segment_seq:04d}{SEGMENT_SUFFIX}"
+            self._segment = self.directory / name
+            self._segment.touch()
+        return self._segment
+
+    def _load_index(self) -> dict:
+        index = {}
+        if not self.directory.exists():
+            return index
+        for segment in sorted(self.directory.glob(f"*{SEGMENT_SUFFIX}")):
+            for header, offset, length in self._scan(segment):
+                cached = index.get(header["id"])
+                if cached is None or header["history_id"] >= cached.history_id:
+                    index[header["id"]] = CacheEntry(
+                        header["history_id"],
+                        header["sha256"],
+                        header["codec"],
+                        segment.name,
+                        offset,
+                        length,
+                    )
+        logger.info(f"Raw message cache {self.directory}: {len(index)} messages")
+        return index
+
+    @staticmethod
+    def _scan(segment: Path):
+        """(header, payload offset, payload length) of each complete record."""
+
+        with open(segment, "rb") as f:
+            while True:
+                prefix = f.read(RECORD_PREFIX.size)
+                if len(prefix) < RECORD_PREFIX.size:
+                    return
+                magic, header_length, payload_length = RECORD_PREFIX.unpack(prefix)
+                header = f.read(header_length)
+                if magic != RECORD_MAGIC or len(header) < header_length:
+                    logger.warning(f"Stopped reading damaged cache segment {segment.name}")
+                    return
+                offset = f.tell()
+                if f.seek(payload_length, os.SEEK_CUR) > os.fstat(f.fileno()).st_size:
+                    return  # record still being written, or cut off by a crash
+                yield json.loads(header), offset, payload_length
+
+
+def get_message_cache(account_id: str) -> MessageCache:
+    """Shared cache of an account, under RAW_CACHE_DIR/<account>."""
+
+    with _caches_lock:
+        if account_id not in _caches:
+            _caches[account_id] = MessageCache(Config.RAW_CACHE_DIR / account_id)
+        return _caches[account_id]
@@ -0,0 +1,54 @@
+import threading
+import time
+
+from config import Config
+
+# Gmail API quota units per method (https://developers.google.com/gmail/api/reference/quota)
+QUOTA_UNITS = {
+    "messages.list": 5,
+    "messages.get": 5,
+    "messages.modify": 5,
+    "messages.batchModify": 50,
+    "labels.list": 1,
+    "labels.create": 5,
+}
+DEFAULT_QUOTA_UNITS = 5
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+class QuotaLimiter:
+    """Token bucket holding an account's Gmail quota units per second."""
+
+    def __init__(self, units_per_second: int):
+        self.rate = units_per_second
+        self.tokens = float(units_per_second)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, units: int) -> None:
+        """Block until units are available, then spend them."""
+
+        if self.rate <= 0:
+            return
+        units = min(units, self.rate)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= units:
+                    self.tokens -= units
+                    return
+                wait = (units - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def get_quota_limiter(account_id: str) -> QuotaLimiter:
+    """Shared limiter for an account, so all its clients and workers share its quota."""
+
+    with _limiters_lock:
+        if account_id not in _limiters:
+            _limiters[account_id] = QuotaLimiter(Config.ACCOUNT_QUOTA_UNITS_PER_SECOND)
+        return _limiters[account_id]
@@ -0,0 +1,99 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass, field
+
+from auth import get_credential_provider
+from services import GmailClient, EmailStore, ActionDispatcher
+from rules import RuleProcessor
+from config import Config
+from utils import get_logger
+
+logger = get_logger(__name__)
+
+
+@dataclass
+class AccountResult:
+    """Outcome of one account's run."""
+
+    account_id: str
+    steps: int = 0
+    errors: list = field(default_factory=list)
+
+    @property
+    def ok(self) -> bool:
+        return not self.errors
+
+
+class AccountSupervisor:
+    """
+    Runs fetch, rule processing and dispatch for several accounts.
+    Each account's work is a generator of small steps (one fetch batch, one rule
+    batch, one outbox batch). Steps are scheduled round-robin so a large mailbox
+    can't starve the others, with at most MAX_CONCURRENT_ACCOUNTS steps in flight
+    and never two steps of the same account at once. Every account has its own
+    GmailClient and quota limiter; all share the database connection pool.
+    """
+
+    def __init__(self, account_ids: list, max_workers: int = None):
+        self.account_ids = list(dict.fromkeys(account_ids))
+        self.max_workers = max_workers or Config.MAX_CONCURRENT_ACCOUNTS
+        self.results = {account_id: AccountResult(account_id) for account_id in self.account_ids}
+
+    def run(
+        self, fetch: bool = True, process: bool = True, dispatch: bool = True, fused: bool = False
+    ) -> dict:
+        """Run every account to completion. Returns {account_id: AccountResult}."""
+
+        ready = deque(
+            (account_id, self._account_steps(account_id, fetch, process, dispatch, fused))
+            for account_id in self.account_ids
+        )
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while ready or running:
+                while ready and len(running) < self.max_workers:
+                    account_id, steps = ready.popleft()
+                    running[executor.submit(next, steps, None)] = (account_id, steps)
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    account_id, steps = running.pop(future)
+                    result = self.results[account_id]
+                    try:
+                        step = future.result()
+                    except Exception as e:
+                        logger.error(f"Account {account_id} failed: {e}")
+                        result.errors.append(str(e))
+                        continue
+                    if step is None:
+                        logger.info(f"Account {account_id} finished after {result.steps} steps")
+                        continue
+                    result.steps += 1
+                    ready.append((account_id, steps))  # back of the queue
+        return self.results
+
+    def _account_steps(
+        self, account_id: str, fetch: bool, process: bool, dispatch: bool, fused: bool = False
+    ):
+        """Yield after each unit of work for one account."""
+
+        credentials = get_credential_provider(account_id, interactive=False).credentials()
+        gmail_client = GmailClient(credentials, account_id=account_id)
+        yield "authenticated"
+
+        processor = RuleProcessor(gmail_client) if process else None
+        if fetch:
+            store = EmailStore(gmail_client, processor=processor if fused else None)
+            for _ in store.iter_fetch_batches():
+                yield "fetch"
+        if process:
+            while processor.process_batch():
+                yield "process"
+            processor.rule_loader.save_condition_stats()
+        if dispatch:
+            dispatcher = ActionDispatcher(gmail_client)
+            while dispatcher.dispatch_batch():
+                yield "dispatch"
+            if dispatcher.stats.entries_failed:
+                logger.warning(
+                    f"Account {account_id}: {dispatcher.stats.entries_failed} actions failed"
+                )
@@ -0,0 +1,75 @@
+from unittest.mock import MagicMock, patch
+
+from actions import LabelDelta
+from database.models import OUTBOX_DONE
+from services.action_dispatcher import ActionDispatcher, OutboxEntry
+
+READ = LabelDelta(remove=frozenset({"UNREAD"}))
+MOVE = LabelDelta(add=frozenset({"Label_1"}), remove=frozenset({"INBOX"}))
+
+
+class TestActionDispatcher:
+    """grouping and fallback when sending outbox entries."""
+
+    def test_identical_changes_share_one_call(self):
+        gmail_client = MagicMock()
+        gmail_client.batch_modify_messages.return_value = True
+        dispatcher = ActionDispatcher(gmail_client)
+        entries = [
+            OutboxEntry(1, "a", READ, 1),
+            OutboxEntry(2, "b", READ, 1),
+            OutboxEntry(3, "c", MOVE, 1),
+        ]
+        with patch.object(dispatcher, "_mark_done") as mark_done:
+            dispatcher._send(entries)
+        assert gmail_client.batch_modify_messages.call_count == 2
+        assert mark_done.call_count == 2
+        assert dispatcher.stats.api_calls == 2
+
+    def test_failed_batch_retried_per_message(self):
+        gmail_client = MagicMock()
+        gmail_client.batch_modify_messages.return_value = False
+        gmail_client.modify_message.side_effect = [True, False]
+        dispatcher = ActionDispatcher(gmail_client)
+        entries = [OutboxEntry(1, "a", READ, 1), OutboxEntry(2, "b", READ, 1)]
+        with patch.object(dispatcher, "_mark_done") as mark_done, \
+                patch.object(dispatcher, "_mark_failed") as mark_failed:
+            dispatcher._send(entries)
+        mark_done.assert_called_once_with([entries[0]], READ)
+        mark_failed.assert_called_once()
+
+    def test_transport_error_fails_chunk_with_backoff(self):
+        gmail_client = MagicMock()
+        gmail_client.batch_modify_messages.side_effect = TimeoutError("timed out")
+        dispatcher = ActionDispatcher(gmail_client)
+        entries = [OutboxEntry(1, "a", READ, 1), OutboxEntry(2, "b", READ, 1)]
+        with patch.object(dispatcher, "_mark_failed") as mark_failed:
+            dispatcher._send(entries)
+        assert [call.args[0] for call in mark_failed.call_args_list] == entries
+        gmail_client.modify_message.assert_not_called()
+
+    def test_transport_error_on_single_message(self):
+        gmail_client = MagicMock()
+        gmail_client.batch_modify_messages.return_value = False
+        gmail_client.modify_message.side_effect = [ConnectionResetError(), True]
+        dispatcher = ActionDispatcher(gmail_client)
+        entries = [OutboxEntry(1, "a", READ, 1), OutboxEntry(2, "b", READ, 1)]
+        with patch.object(dispatcher, "_mark_done") as mark_done, \
+                patch.object(dispatcher, "_mark_failed") as mark_failed:
+            dispatcher._send(entries)
+        mark_failed.assert_called_once()
+        assert mark_failed.call_args.args[0] == entries[0]
+        mark_done.assert_called_once_with([entries[1]], READ)
+
+    def test_done_entries_purged_when_idle(self):
+        dispatcher = ActionDispatcher(MagicMock())
+        with patch.object(dispatcher, "_claim_batch", return_value=[]), \
+                patch("services.action_dispatcher.get_db_session") as get_session:
+            query = get_session.return_value.__enter__.return_value.query.return_value
+            query.filter.return_value.delete.return_value = 3
+            assert dispatcher.dispatch_batch() is False
+            assert dispatcher.dispatch_batch() is False  # not again within the hour
+        query.filter.return_value.delete.assert_called_once()
+        status, = [c for c in query.filter.call_args.args if "status" in str(c)]
+        assert status.right.value == OUTBOX_DONE
+        assert dispatcher.stats.entries_purged == 3
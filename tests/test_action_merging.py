@@ -0,0 +1,203 @@
+import asyncio
+import json
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+from sqlalchemy.dialects import postgresql
+
+from actions import LabelDelta
+from config import Config
+from rules import RuleProcessor
+from tests.common import create_test_email
+
+RULES = [
+    {
+        "description": "File security alerts",
+        "predicate": "Any",
+        "conditions": [{"field": "subject", "predicate": "contains", "value": "security alert"}],
+        "actions": [{"action": "mark_as_read"}, {"action": "move_message", "destination": "Security"}],
+    },
+    {
+        "description": "Read invoices",
+        "predicate": "All",
+        "conditions": [{"field": "subject", "predicate": "contains", "value": "invoice"}],
+        "actions": [{"action": "mark_as_read"}],
+    },
+]
+
+
+@pytest.fixture(autouse=True)
+def rules_file(tmp_path):
+    path = tmp_path / "rules.json"
+    path.write_text(json.dumps({"rules": RULES}))
+    with patch.object(Config, "RULES_FILE", path):
+        yield path
+
+
+def make_processor():
+    gmail_client = MagicMock()
+    gmail_client.get_label_id.return_value = "Label_9"
+    return RuleProcessor(gmail_client)
+
+
+class TestLabelDelta:
+    """merging label changes from several actions."""
+
+    def test_contradictory_changes_cancel(self):
+        merged = LabelDelta.combine([
+            LabelDelta(remove=frozenset({"UNREAD"})),
+            LabelDelta(add=frozenset({"UNREAD"})),
+        ])
+        assert merged.is_empty()
+
+    def test_noops_dropped_using_read_state(self):
+        delta = LabelDelta(add=frozenset({"Label_1"}), remove=frozenset({"UNREAD"}))
+        assert delta.without_noops(is_read=True) == LabelDelta(add=frozenset({"Label_1"}))
+
+    def test_noops_dropped_using_stored_labels(self):
+        delta = LabelDelta(add=frozenset({"Label_1"}), remove=frozenset({"INBOX", "UNREAD"}))
+        assert delta.without_noops(is_read=False, label_ids=["Label_1", "UNREAD"]) == LabelDelta(
+            remove=frozenset({"UNREAD"})
+        )
+
+
+class TestEvaluateEmail:
+    """per-email net change across all matched rules."""
+
+    def test_read_and_move_become_one_change(self):
+        email = create_test_email(subject="Security alert on your account")
+        outcome = make_processor().evaluate_email(email, make_processor().rules)
+        assert outcome.delta == LabelDelta(
+            add=frozenset({"Label_9"}), remove=frozenset({"UNREAD", "INBOX"})
+        )
+
+    def test_already_read_email_skips_unread_removal(self):
+        email = create_test_email(subject="Security alert on your account")
+        email.is_read = True
+        processor = make_processor()
+        outcome = processor.evaluate_email(email, processor.rules)
+        assert "UNREAD" not in outcome.delta.remove
+        assert processor.stats.label_changes_elided == 1
+
+
+class TestRuleWorker:
+    """worker loop draining batches."""
+
+    def test_stops_when_idle(self):
+        processor = make_processor()
+        dispatcher = MagicMock()
+        dispatcher.dispatch_batch.side_effect = [False, True, False]
+        with patch.object(processor, "process_batch", side_effect=[500, 0, 0]) as process_batch:
+            processor.run_worker(dispatcher=dispatcher, stop_when_idle=True)
+        assert process_batch.call_count == 3
+
+
+class TestFusedEvaluation:
+    """evaluating emails during fetch."""
+
+    def test_fetched_email_queued_and_marked_processed(self):
+        processor = make_processor()
+        processor.ruleset_version = MagicMock(id=7)
+        email = create_test_email(subject="Security alert on your account")
+        email.account_id = "default"
+        session = MagicMock()
+        processor.process_fetched_email(session, email)
+        assert email.processed is True
+        assert email.ruleset_version_id == 7
+        assert processor.stats.actions_queued == 1
+        session.execute.assert_called_once()
+
+
+class TestRulesetVersions:
+    """which emails a rules change sends back for evaluation."""
+
+    def make_versioned(self, versions):
+        processor = make_processor()
+        current = {rule.rule_hash for rule in processor.rules}
+        processor._get_ruleset_version = MagicMock(return_value=MagicMock(id=3))
+        processor._version_hashes[3] = current
+        session = MagicMock()
+        session.query.return_value = [(3, sorted(current))] + [
+            (version_id, sorted(hashes(current))) for version_id, hashes in versions.items()
+        ]
+        processor._load_versions(session)
+        return processor, session
+
+    def test_covered_versions_restamped_stale_ones_claimed(self):
+        processor, session = self.make_versioned({
+            1: lambda current: set(list(current)[1:]),
+            2: lambda current: current | {"removed-rule"},
+        })
+        assert processor._stale_version_ids == [1]
+        restamp = session.execute.call_args.args[0].compile()
+        assert restamp.params["ruleset_version_id_1"] == [2]
+        assert restamp.params["ruleset_version_id"] == 3
+
+    def test_unprocessed_claimed_first(self):
+        processor, _ = self.make_versioned({1: lambda current: set()})
+        sql = str(processor.pending_emails_statement())
+        assert "emails.processed = false OR emails.ruleset_version_id IN" in sql
+        assert "ORDER BY emails.processed" in sql
+
+    def test_no_stale_versions_only_unprocessed(self):
+        processor, session = self.make_versioned({})
+        sql = str(processor.pending_emails_statement())
+        assert "ruleset_version_id" not in sql.split("WHERE")[1]
+        session.execute.assert_not_called()
+
+    def test_async_pending_query_loads_versions_once(self):
+        processor = make_processor()
+        session = AsyncMock()
+        session.run_sync.side_effect = lambda load: setattr(
+            processor, "ruleset_version", MagicMock(id=3)
+        )
+        session.execute.return_value.scalars = MagicMock(
+            return_value=MagicMock(all=MagicMock(return_value=["email"]))
+        )
+        assert asyncio.run(processor.apending_emails(session)) == ["email"]
+        assert asyncio.run(processor.apending_emails(session)) == ["email"]
+        session.run_sync.assert_awaited_once_with(processor._load_versions)
+        sql = str(session.execute.await_args.args[0].compile(dialect=postgresql.dialect()))
+        assert "FOR UPDATE OF emails SKIP LOCKED" in sql
+
+    def test_pending_rules(self):
+        processor = make_processor()
+        first, *rest = processor.rules
+        processor._version_hashes[1] = {rule.rule_hash for rule in rest}
+        email = create_test_email()
+        assert processor._pending_rules(MagicMock(), email) == processor.rules
+        email.processed, email.ruleset_version_id = True, 1
+        assert processor._pending_rules(MagicMock(), email) == [first]
+
+    def test_pending_rules_loads_unknown_version(self):
+        processor = make_processor()
+        session = MagicMock()
+        session.query.return_value.filter_by.return_value.scalar.return_value = [
+            rule.rule_hash for rule in processor.rules
+        ]
+        email = create_test_email()
+        email.processed, email.ruleset_version_id = True, 5
+        assert processor._pending_rules(session, email) == []
+        assert 5 in processor._version_hashes
+
+
+class TestEvaluationFailures:
+    """emails whose evaluation keeps failing."""
+
+    def test_failure_counted_and_success_resets(self):
+        processor = make_processor()
+        processor.ruleset_version = MagicMock(id=7)
+        email = create_test_email(subject="Security alert on your account")
+        email.rule_failures = 1
+        with patch.object(processor, "evaluate_email", side_effect=RuntimeError("boom")):
+            processor._process_single_email(MagicMock(), email, processor.rules)
+        assert email.rule_failures == 2 and email.processed is False
+        processor._process_single_email(MagicMock(), email, processor.rules)
+        assert email.rule_failures == 0 and email.processed is True
+
+    def test_given_up_emails_not_claimed(self):
+        processor = make_processor()
+        with patch("rules.processor.Config.RULE_MAX_ATTEMPTS", 3):
+            stmt = processor.pending_emails_statement().compile()
+        assert "emails.rule_failures < " in str(stmt)
+        assert 3 in stmt.params.values()
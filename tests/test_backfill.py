@@ -0,0 +1,144 @@
+from datetime import datetime, timezone
+from unittest.mock import MagicMock, patch
+
+from googleapiclient.errors import HttpError
+
+from database.models import BACKFILL_RUNNING, BACKFILL_DONE
+from services.backfill import BackfillStats, MailboxBackfill, ShardedBackfill, shard_query
+
+
+def make_backfill(pages, checkpoint=(1, None, BACKFILL_RUNNING, 0)):
+    """Backfill over fake pages {token: (ids, next token)}; the first page's token is None."""
+
+    gmail_client = MagicMock()
+    gmail_client.account_id = "default"
+
+    def list_page(query, page_token):
+        if isinstance(pages.get(page_token), Exception):
+            raise pages[page_token]
+        ids, next_token = pages[page_token]
+        return [{"id": message_id} for message_id in ids], next_token
+
+    gmail_client.list_message_page.side_effect = list_page
+    backfill = MailboxBackfill(gmail_client)
+    backfill._load_checkpoint = MagicMock(return_value=checkpoint)
+    backfill._save_checkpoint = MagicMock()
+    backfill._store_page = MagicMock(side_effect=lambda refs: (len(refs), []))
+    return backfill
+
+
+class TestMailboxBackfill:
+    """page-by-page backfill with a resumable checkpoint."""
+
+    def test_checkpoint_saved_after_each_page(self):
+        backfill = make_backfill({None: (["a", "b"], "p2"), "p2": (["c"], None)})
+        assert list(backfill.iter_pages()) == [(2, 0), (1, 0)]
+        saved = [call.args for call in backfill._save_checkpoint.call_args_list]
+        assert saved == [(1, "p2", 2, []), (1, None, 1, [])]
+
+    def test_resumes_from_saved_token(self):
+        backfill = make_backfill(
+            {None: (["a"], "p2"), "p2": (["b"], "p3"), "p3": (["c"], None)},
+            checkpoint=(1, "p3", BACKFILL_RUNNING, 2),
+        )
+        list(backfill.iter_pages())
+        backfill.gmail_client.list_message_page.assert_called_once_with("", "p3")
+        assert backfill.stats.resumed_at_page == 2
+
+    def test_finished_backfill_lists_nothing(self):
+        backfill = make_backfill({}, checkpoint=(1, None, BACKFILL_DONE, 3))
+        assert list(backfill.iter_pages()) == []
+        backfill.gmail_client.list_message_page.assert_not_called()
+
+    def test_rejected_token_restarts_listing(self):
+        expired = HttpError(resp=MagicMock(status=400), content=b"Invalid pageToken")
+        backfill = make_backfill(
+            {"old": expired, None: (["a"], None)},
+            checkpoint=(1, "old", BACKFILL_RUNNING, 5),
+        )
+        assert list(backfill.iter_pages()) == [(1, 0)]
+        backfill._save_checkpoint.assert_called_once_with(1, None, 1, [])
+
+    def test_failed_ids_recorded(self):
+        backfill = make_backfill({None: (["a", "b"], None)})
+        backfill._store_page.side_effect = lambda refs: (1, ["b"])
+        list(backfill.iter_pages())
+        backfill._save_checkpoint.assert_called_once_with(1, None, 1, ["b"])
+        assert backfill.stats.messages_failed == 1
+
+    def test_page_stored_in_fetch_batches(self):
+        backfill = make_backfill({})
+        del backfill._store_page
+        backfill.store = MagicMock()
+        backfill.store.fetch_messages.side_effect = lambda refs: (refs[:1], [ref["id"] for ref in refs[1:]])
+        with patch("services.backfill.Config.FETCH_BATCH_SIZE", 2), \
+                patch("services.backfill.get_db_session"):
+            stored, failed = backfill._store_page([{"id": str(i)} for i in range(5)])
+        assert backfill.store.fetch_messages.call_count == 3
+        assert stored == 3
+        assert failed == ["1", "3"]
+
+
+DAY = 24 * 60 * 60
+START = int(datetime(2020, 1, 1, tzinfo=timezone.utc).timestamp())
+
+
+def estimate_from(counts):
+    """Estimate for a shard query from {day offset: messages received that day}."""
+
+    def estimate(query):
+        terms = dict(term.split(":") for term in query.split())
+        start, end = int(terms["after"]) + 1, int(terms["before"])
+        return sum(n for day, n in counts.items() if start <= START + day * DAY < end)
+    return estimate
+
+
+class TestShardedBackfill:
+    """date-range shard planning and parallel shard runs."""
+
+    def make_sharded(self, counts):
+        gmail_client = MagicMock()
+        gmail_client.account_id = "default"
+        gmail_client.estimate_message_count.side_effect = estimate_from(counts)
+        return ShardedBackfill(gmail_client, workers=2)
+
+    def test_shard_query_overlaps_boundary(self):
+        assert shard_query(100, 200) == "after:99 before:200"
+        assert shard_query(end=100) == "before:100"
+        assert shard_query(start=200) == "after:199"
+
+    def test_busy_periods_split_quiet_ones_merged(self):
+        sharded = self.make_sharded({0: 30, 1: 30, 5: 10, 6: 10})
+        with patch("services.backfill.Config.BACKFILL_SHARD_MESSAGES", 40), \
+                patch("services.backfill.Config.BACKFILL_START_YEAR", 2020):
+            queries = sharded.plan(now=datetime.fromtimestamp(START + 8 * DAY, timezone.utc))
+        assert queries[0] == shard_query(end=START)
+        assert queries[-1] == shard_query(start=START + 8 * DAY)
+        windows = queries[1:-1]
+        assert len(windows) == 3
+        assert [sharded.gmail_client.estimate_message_count(query) for query in windows] == [30, 30, 20]
+
+    def test_windows_cover_history_without_gaps(self):
+        sharded = self.make_sharded({day: 7 for day in range(0, 64, 3)})
+        with patch("services.backfill.Config.BACKFILL_SHARD_MESSAGES", 20):
+            windows = sharded._merge(sharded._split(START, START + 64 * DAY))
+        assert windows[0][0] == START and windows[-1][1] == START + 64 * DAY
+        assert all(left[1] == right[0] for left, right in zip(windows, windows[1:]))
+        assert all(estimate <= 20 for _, _, estimate in windows)
+
+    def test_shards_run_and_failures_collected(self):
+        sharded = self.make_sharded({})
+
+        def run_shard(query):
+            if query == "bad":
+                raise RuntimeError("boom")
+            return BackfillStats(pages=1, messages_stored=10)
+
+        with patch.object(sharded, "_load_plan", return_value=["a", "bad", "b"]), \
+                patch.object(sharded, "_run_shard", side_effect=run_shard), \
+                patch("services.backfill.newest_stored"), \
+                patch("services.backfill.EmailStore") as store:
+            stats = sharded.run()
+        assert stats.pages == 2 and stats.messages_stored == 20
+        assert sharded.errors == ["bad: boom"]
+        store.return_value.save_sync_state.assert_called_once()
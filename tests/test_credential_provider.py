@@ -0,0 +1,90 @@
+import pickle
+import threading
+from datetime import datetime, timedelta, timezone
+from unittest.mock import MagicMock, patch
+
+import pytest
+from google.oauth2.credentials import Credentials
+
+from auth import CredentialProvider, GmailAuthenticator, get_credential_provider
+
+
+def make_credentials(token, expires_in=3600):
+    expiry = datetime.now(timezone.utc).replace(tzinfo=None) + timedelta(seconds=expires_in)
+    return Credentials(token=token, refresh_token="refresh", expiry=expiry)
+
+
+def make_provider(margin_seconds=600):
+    authenticator = MagicMock()
+    authenticator.account_id = "default"
+    tokens = iter(f"token-{i}" for i in range(1, 100))
+    authenticator.refresh.side_effect = lambda: make_credentials(next(tokens))
+    provider = CredentialProvider(authenticator, margin_seconds=margin_seconds)
+    provider.current = make_credentials("token-0")
+    return provider
+
+
+class TestCredentialProvider:
+    """shared credentials with locked, proactive refresh."""
+
+    def test_requests_use_current_token(self):
+        provider = make_provider()
+        credentials = provider.credentials()
+        headers = {}
+        credentials.before_request(None, "GET", "https://gmail", headers)
+        assert headers["authorization"] == "Bearer token-0"
+        provider.current = make_credentials("token-9")
+        credentials.before_request(None, "GET", "https://gmail", headers)
+        assert headers["authorization"] == "Bearer token-9"
+        provider.authenticator.refresh.assert_not_called()
+
+    def test_expired_token_refreshed_before_request(self):
+        provider = make_provider()
+        provider.current = make_credentials("token-0", expires_in=-60)
+        headers = {}
+        provider.credentials().before_request(None, "GET", "https://gmail", headers)
+        assert headers["authorization"] == "Bearer token-1"
+
+    def test_concurrent_refreshes_collapse(self):
+        provider = make_provider()
+        credentials = provider.credentials()
+        credentials.before_request(None, "GET", "https://gmail", {})
+        threads = [
+            threading.Thread(target=provider.refresh, kwargs={"stale_token": "token-0"})
+            for _ in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert provider.authenticator.refresh.call_count == 1
+        credentials.refresh(None)  # a 401 on the old token after it was replaced
+        assert provider.authenticator.refresh.call_count == 1
+        assert provider.current.token == "token-1"
+
+    def test_refresh_due_before_expiry(self):
+        provider = make_provider(margin_seconds=600)
+        provider.current = make_credentials("token-0", expires_in=3600)
+        assert 2990 < provider._refresh_due_in() <= 3000
+
+    def test_shared_provider_keeps_its_mode(self):
+        with patch("auth.credential_provider._providers", {}), \
+                patch.object(CredentialProvider, "start", lambda self: self):
+            provider = get_credential_provider("work", interactive=False)
+            assert get_credential_provider("work", interactive=False) is provider
+            with pytest.raises(ValueError):
+                get_credential_provider("work", interactive=True)
+
+
+class TestTokenFile:
+    """atomic token writes."""
+
+    def test_token_replaced_without_leftovers(self, tmp_path):
+        with patch("auth.gmail_auth.Config.token_path", return_value=tmp_path / "token.pkl"):
+            authenticator = GmailAuthenticator()
+        for token in ("a", "b"):
+            authenticator._credentials = make_credentials(token)
+            authenticator._save_token()
+        assert [path.name for path in tmp_path.iterdir()] == ["token.pkl"]
+        with open(tmp_path / "token.pkl", "rb") as token_file:
+            assert pickle.load(token_file).token == "b"
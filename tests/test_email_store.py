@@ -0,0 +1,152 @@
+import asyncio
+from datetime import datetime, timezone
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from database import Email
+from services import EmailStore
+
+
+def make_email(email_id, subject="Hi"):
+    return Email(
+        account_id="default",
+        id=email_id,
+        sender="a@b.com",
+        subject=subject,
+        message="body",
+        received_at=datetime(2025, 1, 1, tzinfo=timezone.utc),
+        is_read=False,
+        processed=False,
+    )
+
+
+class TestStoreEmails:
+    """batched upserts of fetched emails."""
+
+    def test_one_statement_per_table(self):
+        session = MagicMock()
+        EmailStore._store_emails(session, [make_email("a"), make_email("b")])
+        assert session.execute.call_count == 2
+        email_rows = session.execute.call_args_list[0].args[1]
+        body_rows = session.execute.call_args_list[1].args[1]
+        assert [row["id"] for row in email_rows] == ["a", "b"]
+        assert [row["email_id"] for row in body_rows] == ["a", "b"]
+
+    def test_duplicate_ids_collapsed(self):
+        session = MagicMock()
+        EmailStore._store_emails(session, [make_email("a", "old"), make_email("a", "new")])
+        email_rows = session.execute.call_args_list[0].args[1]
+        assert [row["subject"] for row in email_rows] == ["new"]
+
+    def test_async_upsert_matches_sync(self):
+        session = AsyncMock()
+        emails = [make_email("b"), make_email("a"), make_email("a", "new")]
+        asyncio.run(EmailStore.astore_emails(session, emails))
+        assert session.execute.await_count == 2
+        email_rows = session.execute.await_args_list[0].args[1]
+        assert [(row["id"], row["subject"]) for row in email_rows] == [("a", "new"), ("b", "Hi")]
+        session.run_sync.assert_not_awaited()
+
+    def test_async_upsert_creates_partitions(self):
+        session = AsyncMock()
+        with patch("services.email_store.Config.EMAIL_PARTITIONING", True), \
+                patch("services.email_store.ensure_partitions_for") as ensure_partitions_for:
+            session.run_sync.side_effect = lambda fn: fn("sync-session")
+            asyncio.run(EmailStore.astore_emails(session, [make_email("a")]))
+        ensure_partitions_for.assert_called_once_with(
+            "sync-session", [datetime(2025, 1, 1, tzinfo=timezone.utc)]
+        )
+
+
+class TestAsyncFetch:
+    """overlapping fetch and write on the async path."""
+
+    def test_batches_written_and_counted(self):
+        gmail_client = MagicMock()
+        gmail_client.list_messages.return_value = [{"id": str(i)} for i in range(5)]
+        store = EmailStore(gmail_client)
+        store._load_failed_ids = MagicMock(return_value={})
+        written = []
+
+        async def store_batch(emails):
+            written.append([email.id for email in emails])
+            return len(emails), [], emails[-1].received_at
+
+        with patch("services.email_store.Config.FETCH_BATCH_SIZE", 2), \
+                patch.object(store, "_fetch_and_transform", side_effect=make_email), \
+                patch.object(store, "_astore_batch", side_effect=store_batch), \
+                patch.object(store, "save_sync_state") as save_sync_state:
+            assert asyncio.run(store.afetch_and_store()) == (5, 0)
+        assert written == [["0", "1"], ["2", "3"], ["4"]]
+        save_sync_state.assert_called_once()
+
+
+class TestReparse:
+    """rebuilding stored emails from the raw message cache."""
+
+    def test_parsed_columns_rewritten_labels_kept(self):
+        message = {
+            "id": "a",
+            "threadId": "t",
+            "labelIds": ["INBOX"],
+            "internalDate": "1735689600000",
+            "payload": {
+                "mimeType": "text/plain",
+                "headers": [{"name": "From", "value": "Ann <ann@example.com>"}],
+                "body": {},
+            },
+        }
+        cache = MagicMock()
+        cache.iter_messages.return_value = [message, {"id": "broken", "payload": {"headers": None}}]
+        with patch("services.email_store.get_message_cache", return_value=cache), \
+                patch("services.email_store.get_db_session"), \
+                patch.object(EmailStore, "_store_emails") as store_emails:
+            assert EmailStore.reparse("default") == (1, 1)
+        (_, emails), kwargs = store_emails.call_args
+        assert [email.sender_address for email in emails] == ["ann@example.com"]
+        assert "label_ids" not in kwargs["columns"] and "is_read" not in kwargs["columns"]
+        assert "sender_address" in kwargs["columns"]
+
+
+class TestSyncRetries:
+    """failed messages kept on the sync state instead of holding it back."""
+
+    def make_store(self, listed, failed_before):
+        gmail_client = MagicMock()
+        gmail_client.list_messages.return_value = [{"id": message_id} for message_id in listed]
+        store = EmailStore(gmail_client)
+        store._load_failed_ids = MagicMock(return_value=failed_before)
+        return store
+
+    def fetch(self, message_id):
+        return None if message_id.startswith("bad") else make_email(message_id)
+
+    def test_cursor_advances_and_failures_kept(self):
+        store = self.make_store(["a", "bad1"], {"bad2": 1, "b": 2})
+        with patch("services.email_store.get_db_session"), \
+                patch.object(store, "_fetch_and_transform", side_effect=self.fetch), \
+                patch.object(store, "save_sync_state") as save_sync_state:
+            assert store.fetch_and_store() == (2, 2)
+        newest, failed_ids = save_sync_state.call_args.args
+        assert newest == datetime(2025, 1, 1, tzinfo=timezone.utc)
+        assert failed_ids == {"bad1": 1, "bad2": 2}
+
+    def test_gives_up_after_retry_attempts(self):
+        store = self.make_store([], {"bad": 4})
+        with patch("services.email_store.Config.SYNC_RETRY_ATTEMPTS", 5), \
+                patch("services.email_store.get_db_session"), \
+                patch.object(store, "_fetch_and_transform", side_effect=self.fetch), \
+                patch.object(store, "save_sync_state") as save_sync_state:
+            store.fetch_and_store()
+        save_sync_state.assert_called_once_with(None, {})
+
+    def test_async_fetch_keeps_failures(self):
+        store = self.make_store(["a", "bad1"], {})
+
+        async def store_batch(emails):
+            return len(emails), [], emails[-1].received_at
+
+        with patch.object(store, "_fetch_and_transform", side_effect=self.fetch), \
+                patch.object(store, "_astore_batch", side_effect=store_batch), \
+                patch.object(store, "save_sync_state") as save_sync_state:
+            assert asyncio.run(store.afetch_and_store()) == (1, 1)
+        assert save_sync_state.call_args.args[1] == {"bad1": 1}
@@ -0,0 +1,38 @@
+import base64
+
+from services import GmailClient
+
+
+def encode(text):
+    return base64.urlsafe_b64encode(text.encode("utf-8")).decode("ascii")
+
+
+class TestExtractBody:
+    """MIME walking in GmailClient.extract_body."""
+
+    def test_nested_plain_preferred_over_html(self):
+        message = {"payload": {"mimeType": "multipart/mixed", "parts": [
+            {"mimeType": "multipart/alternative", "parts": [
+                {"mimeType": "text/plain", "body": {"data": encode("plain body")}},
+                {"mimeType": "text/html", "body": {"data": encode("<p>html body</p>")}},
+            ]},
+        ]}}
+        assert GmailClient.extract_body(message).text == "plain body"
+
+    def test_html_fallback(self):
+        message = {"payload": {"mimeType": "text/html", "body": {"data": encode("<p>Hi &amp; bye</p>")}}}
+        assert GmailClient.extract_body(message).text == "Hi & bye"
+
+    def test_attachments_skipped(self):
+        message = {"payload": {"mimeType": "multipart/mixed", "parts": [
+            {"mimeType": "text/plain", "body": {"data": encode("body")}},
+            {"mimeType": "text/plain", "filename": "notes.txt", "body": {"data": encode("attached")}},
+            {"mimeType": "image/png", "filename": "logo.png", "body": {"attachmentId": "abc"}},
+        ]}}
+        assert GmailClient.extract_body(message).text == "body"
+
+    def test_size_cap_truncates(self):
+        message = {"payload": {"mimeType": "text/plain", "body": {"data": encode("x" * 100_000)}}}
+        body = GmailClient.extract_body(message, max_bytes=1000)
+        assert len(body.text) == 1000
+        assert body.truncated is True
@@ -0,0 +1,107 @@
+import io
+import json
+import logging
+import queue
+import sys
+from unittest.mock import patch
+
+from utils.logger import BatchingStreamHandler, EmailLogSampler, JsonFormatter, _LazyQueueHandler
+
+
+def make_record(message="hello", level=logging.INFO, per_email=False):
+    record = logging.LogRecord("test", level, __file__, 1, message, None, None)
+    if per_email:
+        record.per_email = True
+    return record
+
+
+class StubStream(io.StringIO):
+    """Stream that counts write calls."""
+
+    def __init__(self):
+        super().__init__()
+        self.writes = 0
+
+    def write(self, text):
+        self.writes += 1
+        return super().write(text)
+
+
+class TestEmailLogSampler:
+    """sampling and rate limiting of per-email records."""
+
+    def test_other_records_always_pass(self):
+        sampler = EmailLogSampler(sample_rate=0.0, rate_limit=1)
+        assert all(sampler.filter(make_record()) for _ in range(5))
+        assert sampler.filter(make_record(level=logging.WARNING, per_email=True))
+
+    def test_sample_rate(self):
+        sampler = EmailLogSampler(sample_rate=0.5)
+        with patch("utils.logger.random.random", side_effect=[0.1, 0.9, 0.4, 0.6]):
+            passed = [sampler.filter(make_record(per_email=True)) for _ in range(4)]
+        assert passed == [True, False, True, False]
+
+    def test_rate_limit_per_second(self):
+        sampler = EmailLogSampler(rate_limit=2)
+        with patch("utils.logger.time.monotonic", side_effect=[10.0, 10.1, 10.2, 11.5]):
+            passed = [sampler.filter(make_record(per_email=True)) for _ in range(4)]
+        assert passed == [True, True, False, True]
+
+
+class TestJsonFormatter:
+    """one JSON object per record."""
+
+    def test_fields(self):
+        line = JsonFormatter().format(make_record("stored 5 emails", level=logging.WARNING))
+        payload = json.loads(line)
+        assert payload["message"] == "stored 5 emails"
+        assert payload["level"] == "WARNING"
+        assert payload["name"] == "test"
+        assert "time" in payload
+
+    def test_exception_included(self):
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            record = logging.LogRecord("test", logging.ERROR, __file__, 1, "failed", None, sys.exc_info())
+        assert "ValueError: boom" in json.loads(JsonFormatter().format(record))["exc_info"]
+
+    def test_exception_logged_through_queue(self):
+        log_queue = queue.SimpleQueue()
+        logger = logging.getLogger("tests.queued")
+        logger.addHandler(_LazyQueueHandler(log_queue))
+        try:
+            with patch("utils.logger._start_listener"):
+                try:
+                    raise ValueError("boom")
+                except ValueError:
+                    logger.exception("failed %s", "email")
+        finally:
+            logger.handlers.clear()
+        queued = log_queue.get_nowait()
+        payload = json.loads(JsonFormatter().format(queued))
+        assert payload["message"] == "failed email"
+        assert "ValueError: boom" in payload["exc_info"]
+        assert "ValueError: boom" in logging.Formatter().format(queued)
+
+
+class TestBatchingHandler:
+    """batched writes to the stream."""
+
+    def test_written_once_per_batch(self):
+        stream = StubStream()
+        handler = BatchingStreamHandler(stream, batch_size=3)
+        for i in range(5):
+            handler.emit(make_record(f"line {i}"))
+        assert stream.writes == 1
+        handler.flush()
+        assert stream.writes == 2
+        assert stream.getvalue().splitlines() == [f"line {i}" for i in range(5)]
+
+    def test_closed_stream_drops_batch(self):
+        stream = StubStream()
+        handler = BatchingStreamHandler(stream, batch_size=10)
+        handler.emit(make_record())
+        stream.close()
+        handler.flush()  # no ValueError at interpreter exit
+        assert handler._buffer == []
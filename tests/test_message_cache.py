@@ -0,0 +1,53 @@
+from services.message_cache import MessageCache
+
+
+def make_message(message_id, history_id, subject="Hi"):
+    return {
+        "id": message_id,
+        "historyId": str(history_id),
+        "payload": {"headers": [{"name": "Subject", "value": subject}]},
+    }
+
+
+class TestMessageCache:
+    """append-only raw payload cache."""
+
+    def test_round_trip(self, tmp_path):
+        cache = MessageCache(tmp_path)
+        message = make_message("a", 1)
+        assert cache.put(message)
+        assert cache.get("a") == message
+        assert cache.get("missing") is None
+
+    def test_identical_and_older_payloads_skipped(self, tmp_path):
+        cache = MessageCache(tmp_path)
+        assert cache.put(make_message("a", 5))
+        assert not cache.put(make_message("a", 5))
+        assert not cache.put(make_message("a", 4, subject="old"))
+        assert cache.put(make_message("a", 6, subject="new"))
+        assert cache.get("a")["payload"]["headers"][0]["value"] == "new"
+
+    def test_index_rebuilt_from_segments(self, tmp_path):
+        cache = MessageCache(tmp_path)
+        cache.put(make_message("a", 1))
+        cache.put(make_message("b", 1))
+        cache.put(make_message("a", 2, subject="new"))
+        reopened = MessageCache(tmp_path)
+        assert len(reopened) == 2
+        assert reopened.get("a")["payload"]["headers"][0]["value"] == "new"
+        assert sorted(message["id"] for message in reopened.iter_messages()) == ["a", "b"]
+
+    def test_segments_rotate(self, tmp_path):
+        cache = MessageCache(tmp_path, segment_bytes=1)
+        for i in range(3):
+            cache.put(make_message(str(i), 1))
+        assert len(list(tmp_path.glob("*.seg"))) == 3
+        assert len(list(MessageCache(tmp_path).iter_messages())) == 3
+
+    def test_cut_off_record_ignored(self, tmp_path):
+        cache = MessageCache(tmp_path)
+        cache.put(make_message("a", 1))
+        cache.put(make_message("b", 1))
+        segment = next(tmp_path.glob("*.seg"))
+        segment.write_bytes(segment.read_bytes()[:-3])
+        assert list(MessageCache(tmp_path).index) == ["a"]
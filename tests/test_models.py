@@ -0,0 +1,112 @@
+from contextlib import contextmanager
+from unittest.mock import MagicMock, patch
+
+from sqlalchemy import Text, VARCHAR
+from sqlalchemy.dialects.postgresql import TEXT
+
+from database import Email, EmailBody
+from database.compression import ZLIB, ZSTD
+from database.manager import DatabaseManager
+from utils import fold
+
+
+class TestEmailBody:
+    """compressed body storage."""
+
+    def test_zstd_round_trip(self):
+        body = EmailBody.from_text("Hello Wörld " * 100)
+        assert body.codec == ZSTD
+        assert body.size == len(("Hello Wörld " * 100).encode("utf-8"))
+        assert len(body.data) < body.size
+        stored = EmailBody(codec=body.codec, data=body.data, folded_data=body.folded_data)
+        assert stored.text == "Hello Wörld " * 100
+        assert stored.folded_text == "hello wörld " * 100
+
+    def test_zlib_fallback(self):
+        with patch("database.compression.zstandard", None):
+            body = EmailBody.from_text("plain body")
+        assert body.codec == ZLIB
+        assert EmailBody(codec=body.codec, data=body.data).text == "plain body"
+
+    def test_folded_text_of_old_rows(self):
+        body = EmailBody.from_text("MiXeD")
+        assert EmailBody(codec=body.codec, data=body.data, folded_data=None).folded_text == "mixed"
+
+    def test_truncated_at_max_body_bytes(self):
+        with patch("database.models.Config.MAX_BODY_BYTES", 5):
+            body = EmailBody.from_text("abcdéfgh")  # é is two bytes, cut in half
+        assert body.truncated
+        assert body.size == 5
+        assert EmailBody(codec=body.codec, data=body.data).text == "abcd"
+
+    def test_not_truncated_under_cap(self):
+        with patch("database.models.Config.MAX_BODY_BYTES", 100):
+            body = EmailBody.from_text("short")
+        assert not body.truncated
+        assert body.text == "short"
+
+
+class TestMigrateLegacyBodies:
+    """moving bodies out of emails.message."""
+
+    def make_manager(self, columns, batches):
+        manager = DatabaseManager()
+        session = MagicMock()
+        selects = iter(batches)
+        session.execute.side_effect = (
+            lambda statement, params=None: MagicMock(all=MagicMock(return_value=next(selects)))
+            if "SELECT" in str(statement) else MagicMock()
+        )
+
+        @contextmanager
+        def get_session():
+            yield session
+
+        manager.get_session = get_session
+        manager._engine = MagicMock()
+        inspector = MagicMock()
+        inspector.get_columns.return_value = [{"name": name} for name in columns]
+        return manager, session, inspector
+
+    def test_bodies_moved_and_column_dropped(self):
+        manager, session, inspector = self.make_manager(
+            ["id", "message"],
+            [[("default", "a", "first"), ("work", "b", "second")], []],
+        )
+        with patch("database.manager.inspect", return_value=inspector):
+            manager._migrate_legacy_bodies()
+        bodies = [call.args[0] for call in session.add.call_args_list]
+        assert [(body.account_id, body.email_id, body.text) for body in bodies] == [
+            ("default", "a", "first"),
+            ("work", "b", "second"),
+        ]
+        assert "DROP COLUMN message" in str(session.execute.call_args_list[-1].args[0])
+
+    def test_nothing_to_do_without_message_column(self):
+        manager, session, inspector = self.make_manager(["id"], [])
+        with patch("database.manager.inspect", return_value=inspector):
+            manager._migrate_legacy_bodies()
+        session.execute.assert_not_called()
+
+
+class TestWidenFoldedColumns:
+    """folded columns that casefolding may lengthen."""
+
+    def test_varchar_columns_altered(self):
+        manager = DatabaseManager()
+        manager._engine = MagicMock()
+        conn = manager._engine.begin.return_value.__enter__.return_value
+        inspector = MagicMock()
+        inspector.get_columns.return_value = [
+            {"name": "sender_folded", "type": VARCHAR(500)},
+            {"name": "subject_folded", "type": TEXT()},
+        ]
+        with patch("database.manager.inspect", return_value=inspector):
+            manager._widen_folded_columns()
+        statements = [str(call.args[0]) for call in conn.execute.call_args_list]
+        assert statements == ["ALTER TABLE emails ALTER COLUMN sender_folded TYPE TEXT"]
+
+    def test_folded_columns_unbounded(self):
+        assert len(fold("ß" * 500)) > Email.__table__.c.sender.type.length
+        assert isinstance(Email.__table__.c.sender_folded.type, Text)
+        assert isinstance(Email.__table__.c.subject_folded.type, Text)
@@ -0,0 +1,102 @@
+from datetime import datetime, timezone
+from unittest.mock import MagicMock, patch
+
+import pytest
+from sqlalchemy.orm import Session
+
+from database import partitions
+from database.partitions import (
+    apply_retention,
+    ensure_partition,
+    ensure_partitions_for,
+    ensure_upcoming_partitions,
+)
+
+
+@pytest.fixture(autouse=True)
+def known_partitions():
+    with patch.object(partitions, "_known_partitions", set()) as known:
+        yield known
+
+
+def make_session():
+    """A real Session, so commit/rollback events fire, with DDL recorded instead of run."""
+
+    session = Session()
+    session.execute = MagicMock()
+    return session
+
+
+def statements(session):
+    return [str(call.args[0]) for call in session.execute.call_args_list]
+
+
+def created(session):
+    return [statement for statement in statements(session) if statement.startswith("CREATE TABLE")]
+
+
+class TestEnsurePartition:
+    """creating monthly partitions on demand."""
+
+    def test_created_once_per_month(self, known_partitions):
+        session = make_session()
+        name = ensure_partition(session, datetime(2025, 3, 17, tzinfo=timezone.utc))
+        ensure_partitions_for(session, [datetime(2025, 3, 1, tzinfo=timezone.utc)])
+        assert name == "emails_y2025m03"
+        assert len(created(session)) == 1
+        assert "FROM ('2025-03-01T00:00:00+00:00') TO ('2025-04-01T00:00:00+00:00')" in created(session)[0]
+        session.commit()
+        assert known_partitions == {"emails_y2025m03"}
+
+    def test_creation_serialized_per_partition(self):
+        session = make_session()
+        ensure_partition(session, datetime(2025, 3, 1, tzinfo=timezone.utc))
+        lock, create = session.execute.call_args_list
+        assert "pg_advisory_xact_lock" in str(lock.args[0])
+        assert lock.args[1] == {"name": "emails_y2025m03"}
+        assert str(create.args[0]).startswith("CREATE TABLE IF NOT EXISTS emails_y2025m03")
+
+    def test_forgotten_when_transaction_rolls_back(self, known_partitions):
+        session = make_session()
+        session.begin()
+        ensure_partition(session, datetime(2025, 3, 1, tzinfo=timezone.utc))
+        session.rollback()
+        assert known_partitions == set()
+        ensure_partition(session, datetime(2025, 3, 1, tzinfo=timezone.utc))
+        assert len(created(session)) == 2  # issued again in the next transaction
+
+    def test_upcoming_months(self):
+        session = make_session()
+        with patch("database.partitions.datetime") as clock:
+            clock.now.return_value = datetime(2025, 11, 5, tzinfo=timezone.utc)
+            clock.side_effect = datetime
+            ensure_upcoming_partitions(session, months_ahead=3)
+        names = [statement.split()[5] for statement in created(session)]
+        assert names == ["emails_y2025m11", "emails_y2025m12", "emails_y2026m01", "emails_y2026m02"]
+
+
+class TestApplyRetention:
+    """detaching old partitions."""
+
+    def run_retention(self, archive):
+        session = make_session()
+        old = ("emails_y2020m01", datetime(2020, 1, 1, tzinfo=timezone.utc))
+        recent = ("emails_y2099m01", datetime(2099, 1, 1, tzinfo=timezone.utc))
+        with patch("database.partitions.list_partitions", return_value=[old, recent]):
+            removed = apply_retention(session, keep_months=12, archive=archive)
+        assert removed == ["emails_y2020m01"]
+        return statements(session)
+
+    def test_dropped_with_bodies(self):
+        executed = self.run_retention(archive=False)
+        assert any(s.startswith("DELETE FROM email_bodies") for s in executed)
+        assert executed[-1] == "DROP TABLE emails_y2020m01"
+        assert not any("emails_y2099m01" in s for s in executed)
+
+    def test_archived_with_bodies(self):
+        executed = self.run_retention(archive=True)
+        archive_insert = next(i for i, s in enumerate(executed) if s.startswith("INSERT INTO archive.email_bodies"))
+        delete = next(i for i, s in enumerate(executed) if s.startswith("DELETE FROM email_bodies"))
+        assert archive_insert < delete
+        assert executed[-1] == "ALTER TABLE emails_y2020m01 SET SCHEMA archive"
+        assert not any(s.startswith("DROP TABLE") for s in executed)
@@ -0,0 +1,56 @@
+from rules import RuleLoader
+from rules.index import RuleIndex
+from tests.common import create_test_email
+
+
+def make_rule(description, conditions, predicate="All"):
+    return RuleLoader().get_rule_obj({
+        "description": description,
+        "predicate": predicate,
+        "conditions": conditions,
+        "actions": [{"action": "mark_as_read"}],
+    })
+
+
+RULES = [
+    make_rule("vip", [{"field": "sender", "predicate": "equals", "value": "Boss@Corp.com"}]),
+    make_rule("invoice", [
+        {"field": "subject", "predicate": "contains", "value": ["invoice", "receipt"]},
+        {"field": "received_at", "predicate": "greater_than", "value": 30, "unit": "days"},
+    ]),
+    make_rule("recent", [{"field": "received_at", "predicate": "less_than", "value": 2, "unit": "days"}]),
+    make_rule("not spam", [{"field": "subject", "predicate": "does_not_contain", "value": "spam"}]),
+]
+
+
+def descriptions(rules):
+    return [rule.description for rule in rules]
+
+
+class TestRuleIndex:
+    """candidate rule lookup."""
+
+    def test_only_candidate_rules_returned(self):
+        index = RuleIndex(RULES)
+        email = create_test_email(sender="boss@corp.com", subject="Hello", days_ago=10)
+        assert descriptions(index.candidates(email)) == ["vip", "not spam"]
+
+    def test_keyword_and_date_window(self):
+        index = RuleIndex(RULES)
+        email = create_test_email(sender="a@b.com", subject="Your RECEIPT", days_ago=1)
+        assert descriptions(index.candidates(email)) == ["invoice", "recent", "not spam"]
+
+    def test_candidates_agree_with_full_evaluation(self):
+        index = RuleIndex(RULES)
+        for email in [
+            create_test_email(sender="boss@corp.com", subject="invoice", days_ago=40),
+            create_test_email(sender="x@y.com", subject="spam receipt", days_ago=0),
+            create_test_email(sender="x@y.com", subject="hi", days_ago=100),
+        ]:
+            candidates = index.candidates(email)
+            assert [r for r in RULES if r.matches(email)] == [r for r in candidates if r.matches(email)]
+
+    def test_restricted_to_pending_rules(self):
+        index = RuleIndex(RULES)
+        email = create_test_email(sender="boss@corp.com", days_ago=1)
+        assert descriptions(index.candidates(email, RULES[1:])) == ["recent", "not spam"]
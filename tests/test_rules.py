@@ -1,4 +1,10 @@
 import pytest
+from datetime import datetime, timedelta, timezone
+from rules import RuleLoader
+from rules.base import compute_rule_hash
+from rules.cache import ConditionCache, attach_condition_cache
+from rules.regex import RegexScanner, build_regex_scanners, validate_pattern
+from utils import parse_list_id
 from tests.common import create_test_email, check_condition, check_rule
 
 
@@ -60,6 +66,106 @@ class TestStringConditions:
         }
         assert check_condition(email, condition) is True
 
+    def test_sender_domain_equals(self):
+        """sender_domain is parsed from the From header."""
+
+        email = create_test_email(sender="Build Bot <Bot@CI.Example.com>")
+        condition = {
+            "field": "sender_domain",
+            "predicate": "equals",
+            "value": "ci.example.com"
+        }
+        assert check_condition(email, condition) is True
+
+    def test_uses_stored_folded_value(self):
+        """folded columns written at ingest are used when present."""
+
+        email = create_test_email(subject="Straße")
+        email.subject_folded = "strasse"
+        condition = {
+            "field": "subject",
+            "predicate": "equals",
+            "value": "STRASSE"
+        }
+        assert check_condition(email, condition) is True
+
+class TestRegexConditions:
+    """matches_regex predicate."""
+
+    def test_matches_case_insensitively(self):
+        email = create_test_email(subject="Order #A-1234 shipped")
+        condition = {"field": "subject", "predicate": "matches_regex", "value": r"#a-\d+"}
+        assert check_condition(email, condition) is True
+
+    def test_shadowed_patterns_found_on_rescan(self):
+        rule_loader = RuleLoader()
+        rules = [
+            rule_loader.get_rule_obj({
+                "predicate": "All",
+                "conditions": [{"field": "subject", "predicate": "matches_regex", "value": pattern}],
+                "actions": [{"action": "mark_as_read"}],
+            })
+            for pattern in (r"invoice \d+", r"\d+", r"paid")
+        ]
+        build_regex_scanners(rules)
+        email = create_test_email(subject="Invoice 42 paid")
+        assert [rule.matches(email) for rule in rules] == [True, True, True]
+        assert rules[0].conditions[0].scanner is rules[1].conditions[0].scanner
+
+    @pytest.mark.parametrize(
+        "pattern", [r"(a+)+$", r"(\w*x)*", "x" * 1000, r"(a)\1", "(?i)abc", "a)|(b", "x)|(?:y"]
+    )
+    def test_unsafe_patterns_rejected(self, pattern):
+        with pytest.raises(ValueError):
+            validate_pattern(pattern)
+
+    def test_scan_ignores_pattern_escaping_its_group(self):
+        scanner = RegexScanner("subject")
+        scanner.add("a)|(b")  # rejected by validate_pattern; added directly here
+        scanner.add("x)|(?:y")
+        assert scanner.scan("zzb y") == frozenset()
+
+    def test_patterns_reusing_group_name_rejected_at_load(self):
+        rule_dict = {
+            "predicate": "Any",
+            "conditions": [
+                {"field": "subject", "predicate": "matches_regex", "value": pattern}
+                for pattern in (r"(?P<n>\d+) items", r"order (?P<n>\w+)")
+            ],
+            "actions": [{"action": "mark_as_read"}],
+        }
+        with pytest.raises(ValueError):
+            RuleLoader().get_rule_obj(rule_dict)
+
+    def test_rejected_regex_rejects_all_rule(self):
+        rule_dict = {
+            "predicate": "All",
+            "conditions": [
+                {"field": "sender", "predicate": "contains", "value": "x.com"},
+                {"field": "subject", "predicate": "matches_regex", "value": r"(a+)+$"},
+            ],
+            "actions": [{"action": "mark_as_read"}],
+        }
+        with pytest.raises(ValueError):
+            RuleLoader().get_rule_obj(rule_dict)
+        with pytest.raises(ValueError):
+            RuleLoader().get_rule_obj(dict(rule_dict, predicate="Any"))
+
+    def test_any_rule_skips_other_invalid_conditions(self):
+        rule_dict = {
+            "predicate": "Any",
+            "conditions": [
+                {"field": "sender", "predicate": "contains", "value": "x.com"},
+                {"field": "sender", "predicate": "contains"},
+            ],
+            "actions": [{"action": "mark_as_read"}],
+        }
+        rule = RuleLoader().get_rule_obj(rule_dict)
+        assert len(rule.conditions) == 1
+        with pytest.raises(ValueError):
+            RuleLoader().get_rule_obj(dict(rule_dict, predicate="All"))
+
+
 class TestDateConditions:
     """date-based conditions (received_at)."""
     
@@ -199,5 +305,147 @@ class TestRuleMatching:
         }
         assert check_rule(email, rule) is False
 
+class TestReferencedFields:
+    """fields a rule reads, used to project columns."""
+
+    def test_referenced_fields(self):
+        rule = RuleLoader().get_rule_obj({
+            "predicate": "All",
+            "conditions": [
+                {"field": "sender", "predicate": "contains", "value": "bot"},
+                {"field": "received_at", "predicate": "less_than", "value": 2, "unit": "days"}
+            ],
+            "actions": [{"action": "mark_as_read"}]
+        })
+        assert rule.referenced_fields() == {"sender", "sender_folded", "received_at"}
+
+class TestEarliestMatchDate:
+    """date bounds used to skip old partitions."""
+
+    def test_all_rule_bounded_by_less_than(self):
+        now = datetime(2024, 5, 20, tzinfo=timezone.utc)
+        rule = RuleLoader().get_rule_obj({
+            "predicate": "All",
+            "conditions": [
+                {"field": "subject", "predicate": "contains", "value": "hiring"},
+                {"field": "received_at", "predicate": "less_than", "value": 3, "unit": "days"}
+            ],
+            "actions": [{"action": "mark_as_read"}]
+        })
+        assert rule.earliest_match_date(now) == now - timedelta(days=3)
+
+    def test_any_rule_with_unbounded_condition(self):
+        now = datetime(2024, 5, 20, tzinfo=timezone.utc)
+        rule = RuleLoader().get_rule_obj({
+            "predicate": "Any",
+            "conditions": [
+                {"field": "subject", "predicate": "contains", "value": "hiring"},
+                {"field": "received_at", "predicate": "less_than", "value": 2, "unit": "months"}
+            ],
+            "actions": [{"action": "mark_as_read"}]
+        })
+        assert rule.earliest_match_date(now) is None
+
+class TestRuleHash:
+    """per-rule hashes used by the ruleset ledger."""
+
+    RULE = {
+        "description": "old description",
+        "predicate": "All",
+        "conditions": [{"field": "sender", "predicate": "contains", "value": "bot"}],
+        "actions": [{"action": "mark_as_read"}]
+    }
+
+    def test_description_does_not_change_hash(self):
+        renamed = dict(self.RULE, description="new description")
+        assert compute_rule_hash(renamed) == compute_rule_hash(self.RULE)
+
+    def test_condition_change_changes_hash(self):
+        changed = dict(self.RULE, conditions=[{"field": "sender", "predicate": "contains", "value": "robot"}])
+        assert compute_rule_hash(changed) != compute_rule_hash(self.RULE)
+
+
+class TestConditionOrdering:
+    """cost and pass-rate based evaluation order."""
+
+    RULE = {
+        "predicate": "All",
+        "conditions": [
+            {"field": "message", "predicate": "contains", "value": "invoice"},
+            {"field": "subject", "predicate": "contains", "value": "paid"},
+            {"field": "received_at", "predicate": "less_than", "value": 2, "unit": "days"},
+        ],
+        "actions": [{"action": "mark_as_read"}],
+    }
+
+    def test_cheap_conditions_first(self):
+        rule = RuleLoader().get_rule_obj(self.RULE)
+        assert [c.field for c in rule.evaluation_order] == ["received_at", "subject", "message"]
+
+    def test_all_short_circuits_on_cheap_rejection(self):
+        rule = RuleLoader().get_rule_obj(self.RULE)
+        assert rule.matches(create_test_email(subject="paid", message="invoice", days_ago=10)) is False
+        assert [c.evaluations for c in rule.conditions] == [0, 0, 1]
+
+    def test_observed_pass_rates_reorder(self):
+        rule = RuleLoader().get_rule_obj(self.RULE)
+        # the subject almost always passes, the body almost never does
+        rule.load_condition_stats([[1000, 1], [1000, 999], [1000, 999]])
+        assert rule.evaluation_order[0].field == "message"
+        assert rule.condition_stats() == [[1000, 1], [1000, 999], [1000, 999]]
+
+
+class TestConditionCache:
+    """memoized string condition results."""
+
+    def test_repeated_values_hit_cache(self):
+        rule = RuleLoader().get_rule_obj({
+            "predicate": "Any",
+            "conditions": [{"field": "sender", "predicate": "contains", "value": "noreply"}],
+            "actions": [{"action": "mark_as_read"}],
+        })
+        cache = attach_condition_cache([rule], max_size=10)
+        results = [rule.matches(create_test_email(sender=s)) for s in ["noreply@x.com", "a@b.com", "NoReply@x.com"]]
+        assert results == [True, False, True]
+        assert (cache.hits, cache.misses) == (1, 2)
+
+    def test_lru_bound(self):
+        cache = ConditionCache(max_size=2)
+        condition = RuleLoader().get_rule_obj({
+            "predicate": "All",
+            "conditions": [{"field": "subject", "predicate": "equals", "value": "a"}],
+            "actions": [{"action": "mark_as_read"}],
+        }).conditions[0]
+        for value in ["a", "b", "c", "a"]:
+            cache.lookup(condition, value)
+        assert cache.misses == 4 and len(cache._results) == 2
+
+
+class TestHeaderFields:
+    """conditions on stored headers."""
+
+    def test_recipient_array_equals_any_element(self):
+        email = create_test_email()
+        email.to_addresses = ["me@corp.com", "Team@Corp.com"]
+        condition = {"field": "to", "predicate": "equals", "value": "team@corp.com"}
+        assert check_condition(email, condition) is True
+
+    def test_recipient_array_not_equals_all_elements(self):
+        email = create_test_email()
+        email.cc_addresses = ["me@corp.com", "team@corp.com"]
+        condition = {"field": "cc", "predicate": "not_equals", "value": "team@corp.com"}
+        assert check_condition(email, condition) is False
+
+    def test_list_id(self):
+        email = create_test_email()
+        email.list_id = parse_list_id("Dev Team <DEV.lists.example.com>")
+        condition = {"field": "list_id", "predicate": "equals", "value": "dev.lists.example.com"}
+        assert check_condition(email, condition) is True
+
+    def test_missing_labels_never_match(self):
+        condition = {"field": "labels", "predicate": "does_not_contain", "value": "spam"}
+        assert check_condition(create_test_email(), condition) is False
+
+
 if __name__ == "__main__":
     pytest.main([__file__, "-v"])
@@ -0,0 +1,73 @@
+from datetime import datetime, timedelta, timezone
+
+import pyarrow as pa
+
+from rules import RuleLoader
+from rules.simulation import simulate
+
+NOW = datetime(2025, 6, 15, 12, tzinfo=timezone.utc)
+
+
+def make_batch(rows):
+    """rows of (id, sender, subject, days_ago)"""
+    return pa.RecordBatch.from_pydict({
+        "id": pa.array([row[0] for row in rows]),
+        "sender": pa.array([row[1] for row in rows], type=pa.string()),
+        "subject": pa.array([row[2] for row in rows], type=pa.string()),
+        "received_at": pa.array(
+            [NOW - timedelta(days=row[3]) for row in rows], type=pa.timestamp("us", tz="UTC")
+        ),
+    })
+
+
+def make_rule(conditions, predicate="All"):
+    return RuleLoader().get_rule_obj({
+        "description": "test",
+        "predicate": predicate,
+        "conditions": conditions,
+        "actions": [{"action": "mark_as_read"}],
+    })
+
+
+class TestSimulation:
+    """vectorized evaluation matches Rule.matches semantics."""
+
+    def test_contains_and_date(self):
+        rule = make_rule([
+            {"field": "subject", "predicate": "contains", "value": "Invoice"},
+            {"field": "received_at", "predicate": "greater_than", "value": 30, "unit": "days"},
+        ])
+        batch = make_batch([
+            ("a", "x", "your invoice", 40),
+            ("b", "x", "your invoice", 5),
+            ("c", "x", "hello", 40),
+        ])
+        report = simulate([rule], [batch], now=NOW)
+        assert report.emails_scanned == 3
+        assert report.rules[0].matches == 1
+        assert report.rules[0].sample_ids == ["a"]
+
+    def test_null_never_matches_negated_predicate(self):
+        rule = make_rule([{"field": "sender", "predicate": "not_equals", "value": "a@b.com"}])
+        batch = make_batch([("a", None, "s", 1), ("b", "c@d.com", "s", 1)])
+        assert simulate([rule], [batch], now=NOW).rules[0].matches == 1
+
+    def test_any_predicate_across_batches(self):
+        rule = make_rule([
+            {"field": "subject", "predicate": "equals", "value": "ping"},
+            {"field": "received_at", "predicate": "less_than", "value": 1, "unit": "months"},
+        ], predicate="Any")
+        batches = [make_batch([("a", "x", "ping", 90)]), make_batch([("b", "x", "pong", 2)])]
+        assert simulate([rule], batches, now=NOW).rules[0].matches == 2
+
+    def test_regex_condition(self):
+        rule = make_rule([{"field": "subject", "predicate": "matches_regex", "value": r"inv-\d{4}"}])
+        batch = make_batch([("a", "x", "re: INV-2024 due", 1), ("b", "x", "inv-20", 1)])
+        assert simulate([rule], [batch], now=NOW).rules[0].sample_ids == ["a"]
+
+    def test_array_field_equals_element(self):
+        rule = make_rule([{"field": "to", "predicate": "equals", "value": "team@corp.com"}])
+        batch = make_batch([("a", "x", "s", 1), ("b", "x", "s", 1), ("c", "x", "s", 1)])
+        to = pa.array(["\x00me@corp.com\x00team@corp.com\x00", "\x00team@corp.com.evil\x00", None])
+        batch = batch.append_column("to", to)
+        assert simulate([rule], [batch], now=NOW).rules[0].sample_ids == ["a"]
@@ -0,0 +1,65 @@
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+PROJECT_ROOT = Path(__file__).parent.parent
+
+# Import budget for `import main` in a fresh interpreter, in seconds.
+STARTUP_BUDGET = 1.5
+
+HEAVY_MODULES = [
+    "googleapiclient.discovery",
+    "google_auth_oauthlib.flow",
+    "google.auth.transport.requests",
+    "jsonschema",
+    "pyarrow",
+]
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import main
+from database import db_manager
+print(json.dumps({
+    "elapsed": time.perf_counter() - start,
+    "loaded": [m for m in %r if m in sys.modules],
+    "engine_created": db_manager._engine is not None,
+}))
+""" % (HEAVY_MODULES,)
+
+
+@pytest.fixture(scope="module")
+def startup(tmp_path_factory):
+    cwd = tmp_path_factory.mktemp("startup")
+    result = subprocess.run(
+        [sys.executable, "-c", PROBE],
+        cwd=cwd,
+        env={"PYTHONPATH": str(PROJECT_ROOT), "PATH": ""},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1]), cwd
+
+
+class TestStartup:
+    """Importing the app should stay cheap."""
+
+    def test_heavy_modules_not_imported(self, startup):
+        report, _ = startup
+        assert report["loaded"] == []
+
+    def test_engine_created_lazily(self, startup):
+        report, _ = startup
+        assert report["engine_created"] is False
+
+    def test_no_log_files_on_import(self, startup):
+        _, cwd = startup
+        assert not (cwd / "logs").exists()
+
+    def test_within_budget(self, startup):
+        report, _ = startup
+        assert report["elapsed"] < STARTUP_BUDGET
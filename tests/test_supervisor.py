@@ -0,0 +1,55 @@
+from unittest.mock import patch
+
+from services.quota import QuotaLimiter
+from services.supervisor import AccountSupervisor
+
+
+class TestQuotaLimiter:
+    """token bucket for per-account Gmail quota."""
+
+    def test_waits_when_bucket_empty(self):
+        limiter = QuotaLimiter(100)
+        with patch("services.quota.time.sleep") as sleep:
+            limiter.acquire(100)
+            sleep.assert_not_called()
+            sleep.side_effect = lambda seconds: setattr(limiter, "tokens", 100)
+            limiter.acquire(50)
+        assert sleep.call_count == 1
+
+    def test_zero_rate_disables_limit(self):
+        limiter = QuotaLimiter(0)
+        with patch("services.quota.time.sleep") as sleep:
+            for _ in range(10):
+                limiter.acquire(50)
+        sleep.assert_not_called()
+
+
+class TestAccountSupervisor:
+    """round-robin scheduling across accounts."""
+
+    def _fake_steps(self, order, counts):
+        def steps(account_id, fetch, process, dispatch, fused=False):
+            for i in range(counts[account_id]):
+                order.append(account_id)
+                yield i
+        return steps
+
+    def test_accounts_interleave(self):
+        order = []
+        supervisor = AccountSupervisor(["big", "small"], max_workers=1)
+        with patch.object(supervisor, "_account_steps", self._fake_steps(order, {"big": 5, "small": 2})):
+            results = supervisor.run()
+        assert order[:4] == ["big", "small", "big", "small"]
+        assert results["big"].steps == 5 and results["small"].steps == 2
+
+    def test_failing_account_does_not_stop_others(self):
+        def steps(account_id, fetch, process, dispatch, fused=False):
+            if account_id == "broken":
+                raise PermissionError("no token")
+            yield "fetch"
+
+        supervisor = AccountSupervisor(["broken", "ok"], max_workers=2)
+        with patch.object(supervisor, "_account_steps", steps):
+            results = supervisor.run()
+        assert not results["broken"].ok
+        assert results["ok"].ok and results["ok"].steps == 1
@@ -1,2 +1,3 @@
 from .arg_parser import parse_arguments
-from .logger import get_logger
\ No newline at end of file
+from .logger import get_logger, PER_EMAIL
+from .text import fold, parse_sender, parse_addresses, parse_list_id
@@ -17,7 +17,72 @@ def parse_arguments():
         action="store_true",
         help="Only process rules, don't fetch new emails",
     )
+    parser.add_argument(
+        "--dispatch-only",
+        action="store_true",
+        help="Only send queued actions from the outbox to Gmail",
+    )
+    parser.add_argument(
+        "--fused",
+        action="store_true",
+        help="Apply rules to emails while fetching them instead of reading them back afterwards",
+    )
+    parser.add_argument(
+        "--async-fetch",
+        action="store_true",
+        help="Write fetched batches through the async (asyncpg) engine while the next batch downloads",
+    )
+    parser.add_argument(
+        "--worker",
+        action="store_true",
+        help="Keep claiming pending emails and sending their actions until interrupted; "
+        "several workers can run at once",
+    )
+    parser.add_argument(
+        "--backfill",
+        action="store_true",
+        help="Fetch the whole mailbox page by page, resuming where an interrupted backfill stopped",
+    )
+    parser.add_argument(
+        "--reparse",
+        action="store_true",
+        help="Rebuild stored emails from the raw message cache (RAW_MESSAGE_CACHE) and exit; "
+        "no Gmail API calls",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Report how many stored emails each rule would match and exit; no actions are taken",
+    )
+    parser.add_argument(
+        "--rules",
+        metavar="PATH",
+        help="With --dry-run, the rules file to try instead of RULES_FILE",
+    )
     parser.add_argument(
         "--init-db", action="store_true", help="Initialize database and exit"
     )
+    parser.add_argument(
+        "--retention-months",
+        type=int,
+        metavar="N",
+        help="Remove email partitions older than N months and exit",
+    )
+    parser.add_argument(
+        "--archive",
+        action="store_true",
+        help="With --retention-months, move old partitions to the archive schema instead of dropping them",
+    )
+    accounts = parser.add_mutually_exclusive_group()
+    accounts.add_argument(
+        "--account",
+        default=None,
+        metavar="ID",
+        help="Account (mailbox) to run for; its token is authorized interactively if missing",
+    )
+    accounts.add_argument(
+        "--all-accounts",
+        action="store_true",
+        help="Run every account in ACCOUNTS concurrently with fair scheduling",
+    )
     return parser.parse_args()
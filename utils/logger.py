@@ -1,33 +1,228 @@
+import atexit
+import copy
+import json
 import logging
 import os
+import queue
+import random
 import sys
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+
 from config import Config
 
+# Pass as `extra=` on log lines emitted once per email so they can be sampled.
+PER_EMAIL = {"per_email": True}
 
-def setup_logger(name: str) -> logging.Logger:
-    """Function to create and configure a logger."""
+_queue_handler = None
+_listener = None
+_stopped = False
+_lock = threading.Lock()
 
-    logger = logging.getLogger(name)
-    if logger.handlers:
-        return logger
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as one JSON object per line."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "time": self.formatTime(record),
+            "name": record.name,
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        exc_text = record.exc_text  # already formatted when the record came through the queue
+        if record.exc_info and not exc_text:
+            exc_text = self.formatException(record.exc_info)
+        if exc_text:
+            payload["exc_info"] = exc_text
+        return json.dumps(payload)
+
+
+class EmailLogSampler(logging.Filter):
+    """
+    Samples and rate limits per-email records.
+    Records without the PER_EMAIL marker (summaries, errors) always pass.
+    """
+
+    def __init__(self, sample_rate: float = 1.0, rate_limit: int = 0):
+        super().__init__()
+        self.sample_rate = sample_rate
+        self.rate_limit = rate_limit  # max per-email records per second, 0 = unlimited
+        self._window_start = 0.0
+        self._window_count = 0
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not getattr(record, "per_email", False) or record.levelno >= logging.WARNING:
+            return True
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return False
+        if self.rate_limit <= 0:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            if now - self._window_start >= 1.0:
+                self._window_start = now
+                self._window_count = 0
+            self._window_count += 1
+            return self._window_count <= self.rate_limit
+
+
+class _BatchingMixin:
+    """Buffers formatted records and writes them to the stream in a single call."""
+
+    def _init_batching(self, batch_size: int) -> None:
+        self.batch_size = batch_size
+        self._buffer = []
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            self._buffer.append(self.format(record) + self.terminator)
+        except Exception:
+            self.handleError(record)
+        if len(self._buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        self.acquire()
+        try:
+            if self._buffer:
+                if self.stream is None and hasattr(self, "_open"):
+                    self.stream = self._open()
+                self.stream.write("".join(self._buffer))
+            if self.stream and hasattr(self.stream, "flush"):
+                self.stream.flush()
+        except (OSError, ValueError):
+            pass  # stream closed or unwritable (e.g. at interpreter exit); drop the batch
+        finally:
+            self._buffer.clear()
+            self.release()
+
+    def close(self) -> None:
+        self.flush()
+        super().close()
+
+
+class BatchingStreamHandler(_BatchingMixin, logging.StreamHandler):
+
+    def __init__(self, stream=None, batch_size: int = 100):
+        logging.StreamHandler.__init__(self, stream)
+        self._init_batching(batch_size)
+
+
+class BatchingFileHandler(_BatchingMixin, logging.FileHandler):
+
+    def __init__(self, filename, batch_size: int = 100):
+        logging.FileHandler.__init__(self, filename, encoding="utf-8", delay=True)
+        self._init_batching(batch_size)
+
+
+class _LazyQueueHandler(QueueHandler):
+    """Queue handler that starts the listener, and so creates the log files, on the first record."""
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        _start_listener(self.queue)
+        super().enqueue(record)
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """
+        Resolve the message and traceback to text before queueing. Unlike the
+        default, the traceback is kept apart in exc_text so formatters can
+        still tell it from the message.
+        """
+
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class _BatchingQueueListener(QueueListener):
+    """Flushes the batching handlers whenever the queue has been drained."""
+
+    def handle(self, record: logging.LogRecord) -> None:
+        super().handle(record)
+        if self.queue.empty():
+            for handler in self.handlers:
+                handler.flush()
+
+
+def _build_handlers():
+    """Create the console and file handlers driven by the listener thread."""
 
     log_level = getattr(logging, Config.LOG_LEVEL)
-    logger.setLevel(log_level)
+    if Config.LOG_JSON:
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter(Config.LOG_FORMAT)
+
+    console_handler = BatchingStreamHandler(sys.stdout, Config.LOG_BATCH_SIZE)
+    os.makedirs(os.path.dirname(Config.LOG_FILE), exist_ok=True)
+    file_handler = BatchingFileHandler(Config.LOG_FILE, Config.LOG_BATCH_SIZE)
+    for handler in (console_handler, file_handler):
+        handler.setLevel(log_level)
+        handler.setFormatter(formatter)
+    return console_handler, file_handler
+
 
-    formatter = logging.Formatter(Config.LOG_FORMAT)
+def _start_listener(log_queue) -> None:
+    """Start the listener thread once."""
 
-    console_handler = logging.StreamHandler(sys.stdout)
-    console_handler.setLevel(log_level)
-    console_handler.setFormatter(formatter)
+    global _listener
+    if _listener is not None:
+        return
+    with _lock:
+        if _listener is None:
+            _listener = _BatchingQueueListener(
+                log_queue, *_build_handlers(), respect_handler_level=True
+            )
+            _listener.start()
+            atexit.register(stop_logging)
 
-    os.makedirs("logs", exist_ok=True)
-    file_handler = logging.FileHandler("logs/app.log")
-    file_handler.setLevel(log_level)
-    file_handler.setFormatter(formatter)
 
-    logger.addHandler(console_handler)
-    logger.addHandler(file_handler)
+def _get_queue_handler() -> QueueHandler:
+    """Return the shared queue handler."""
+
+    global _queue_handler
+    with _lock:
+        if _queue_handler is None:
+            _queue_handler = _LazyQueueHandler(queue.SimpleQueue())
+            _queue_handler.addFilter(
+                EmailLogSampler(
+                    sample_rate=Config.LOG_EMAIL_SAMPLE_RATE,
+                    rate_limit=Config.LOG_EMAIL_RATE_LIMIT,
+                )
+            )
+        return _queue_handler
+
+
+def stop_logging() -> None:
+    """Drain the log queue and flush all handlers."""
+
+    global _stopped
+    with _lock:
+        if _listener is None or _stopped:
+            return
+        _stopped = True
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+
+
+def setup_logger(name: str) -> logging.Logger:
+    """Function to create and configure a logger."""
+
+    logger = logging.getLogger(name)
+    if logger.handlers:
+        return logger
 
+    logger.setLevel(getattr(logging, Config.LOG_LEVEL))
+    logger.addHandler(_get_queue_handler())
     return logger
 
 
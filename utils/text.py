@@ -0,0 +1,34 @@
+from email.utils import getaddresses, parseaddr
+
+
+def fold(value) -> str:
+    """Casefold a value for case-insensitive matching."""
+
+    return str(value).casefold()
+
+
+def parse_sender(sender: str) -> tuple[str, str]:
+    """Return the casefolded (address, domain) of a From header."""
+
+    _, address = parseaddr(sender or "")
+    address = address.casefold()
+    domain = address.rpartition("@")[2] if "@" in address else ""
+    return address, domain
+
+
+def parse_addresses(header: str) -> list:
+    """Casefolded addresses of a To/Cc header, in order, without duplicates."""
+
+    addresses = [address.casefold() for _, address in getaddresses([header or ""]) if address]
+    return list(dict.fromkeys(addresses))
+
+
+def parse_list_id(header: str):
+    """Casefolded list identifier of a List-Id header ("Name <id>" -> "id")."""
+
+    if not header:
+        return None
+    start, end = header.rfind("<"), header.rfind(">")
+    if 0 <= start < end:
+        header = header[start + 1 : end]
+    return header.strip().casefold() or None